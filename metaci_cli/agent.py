@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+"""A background agent that keeps a warm metaci process per working directory.
+
+`metaci-client <args>` forwards its arguments to the agent over a Unix domain
+socket and streams the output back, starting the agent on first use.  The
+agent keeps the CumulusCI project config, decrypted keychain, API schema and
+pooled HTTP connections in memory between commands and exits after
+METACI_AGENT_IDLE_TIMEOUT seconds (default 600) without a request.  The
+client's CUMULUSCI_* and METACI_* environment variables are applied to each
+command, and the configs are reloaded whenever they or the git HEAD change.
+
+Interactive prompts can't be answered through the agent.  Commands that need
+them should be run with plain `metaci`.
+
+The client half of this module only uses the standard library so that
+forwarding a command costs little more than starting the interpreter.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# Mirrors BaseGlobalConfig.config_local_dir without importing cumulusci
+AGENT_DIR = os.path.join(os.path.expanduser('~'), '.cumulusci', 'metaci', 'agent')
+START_TIMEOUT = 15
+
+# Environment variables forwarded from the client to the command it runs
+ENV_PREFIXES = ('CUMULUSCI_', 'METACI_')
+
+
+def get_socket_path(cwd):
+    """ Each working directory gets its own agent since the project config,
+    and so the keychain, depends on it """
+    key = hashlib.sha1(os.path.realpath(cwd).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(AGENT_DIR, '{}.sock'.format(key))
+
+
+def connect(socket_path):
+    """ returns a connected socket or None if no agent is listening """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def send_message(sock, message):
+    sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def iter_messages(sock):
+    """ yields the newline delimited JSON messages sent over a socket """
+    f = sock.makefile('rb')
+    try:
+        for line in f:
+            yield json.loads(line.decode('utf-8'))
+    finally:
+        f.close()
+
+
+def get_forwarded_env(environ=None):
+    if environ is None:
+        environ = os.environ
+    return dict((name, value) for name, value in environ.items() if name.startswith(ENV_PREFIXES))
+
+
+def read_git_head(cwd):
+    """ returns the contents of HEAD and the ref it points to for the git
+    repo containing cwd, or None outside a repo.  Cheap enough to read on
+    every request so a git checkout is noticed. """
+    path = os.path.realpath(cwd)
+    while True:
+        git_dir = os.path.join(path, '.git')
+        if os.path.exists(git_dir):
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    if os.path.isfile(git_dir):
+        # Worktrees and submodules point to their git dir with a gitdir: line
+        with open(git_dir, 'r') as f:
+            git_dir = os.path.join(path, f.read().strip().split(':', 1)[-1].strip())
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+    except IOError:
+        return None
+    if head.startswith('ref: '):
+        try:
+            with open(os.path.join(git_dir, head[5:]), 'r') as f:
+                head += ' ' + f.read().strip()
+        except IOError:
+            # Packed refs, the branch name alone is enough for repo_branch
+            pass
+    return head
+
+
+class ConfigState(object):
+    """ Tracks what the loaded configs were built from and reloads them
+    when a request comes from a different environment or git HEAD.  Requests
+    with the same state run concurrently.  A request needing a different
+    state waits for the running ones to finish since os.environ and the
+    configs are shared by the whole process. """
+
+    def __init__(self, cwd):
+        import threading
+        self.cwd = cwd
+        self.key = None
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, env):
+        key = (read_git_head(self.cwd), sorted(env.items()))
+        with self.condition:
+            while self.active and key != self.key:
+                self.condition.wait()
+            if key != self.key:
+                self._apply(env)
+                self.key = key
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def _apply(self, env):
+        from metaci_cli.cli.config import CLI_CONFIG
+        for name in list(get_forwarded_env()):
+            if name not in env:
+                del os.environ[name]
+        os.environ.update(env)
+        CLI_CONFIG.reset()
+
+
+def start_agent(cwd):
+    """ starts an agent for cwd in the background and waits for it to listen """
+    socket_path = get_socket_path(cwd)
+    if not os.path.isdir(AGENT_DIR):
+        os.makedirs(AGENT_DIR)
+    with open(os.devnull, 'r+b') as devnull:
+        kwargs = {}
+        if hasattr(os, 'setsid'):
+            kwargs['preexec_fn'] = os.setsid
+        subprocess.Popen(
+            [sys.executable, '-m', 'metaci_cli.agent', 'serve', cwd],
+            cwd=cwd,
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            **kwargs
+        )
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        sock = connect(socket_path)
+        if sock:
+            return sock
+        time.sleep(0.05)
+
+
+def run_in_process(argv):
+    from metaci_cli.cli import main
+    main(args=argv, prog_name='metaci')
+
+
+def client_main(argv=None):
+    """ Entry point for metaci-client """
+    if argv is None:
+        argv = sys.argv[1:]
+    # metaci agent commands manage the agent itself so never go through it
+    if not hasattr(socket, 'AF_UNIX') or argv[:1] == ['agent']:
+        return run_in_process(argv)
+
+    cwd = os.getcwd()
+    sock = connect(get_socket_path(cwd)) or start_agent(cwd)
+    if sock is None:
+        # Never leave the user without a result because the agent won't start
+        return run_in_process(argv)
+
+    exit_code = 1
+    try:
+        send_message(sock, {
+            'argv': argv,
+            'color': sys.stdout.isatty(),
+            'env': get_forwarded_env(),
+        })
+        streams = {'out': sys.stdout, 'err': sys.stderr}
+        for message in iter_messages(sock):
+            if 'exit' in message:
+                exit_code = message['exit']
+                break
+            stream = streams[message['stream']]
+            stream.write(message['data'])
+            stream.flush()
+    finally:
+        sock.close()
+    sys.exit(exit_code)
+
+
+class SocketWriter(object):
+    """ A file-like object that forwards writes to the client as messages """
+
+    def __init__(self, sock, stream):
+        self.sock = sock
+        self.stream = stream
+        self.encoding = 'utf-8'
+        self.errors = 'replace'
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        if data:
+            send_message(self.sock, {'stream': self.stream, 'data': data})
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def serve(cwd, idle_timeout=None):
+    """ Runs the agent for cwd until it has been idle for idle_timeout seconds """
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+    from metaci_cli.cli.runner import invoke
+
+    if idle_timeout is None:
+        idle_timeout = int(os.environ.get('METACI_AGENT_IDLE_TIMEOUT', 600))
+    os.chdir(cwd)
+    socket_path = get_socket_path(cwd)
+    state = {'last_request': time.time(), 'stop': False}
+    config_state = ConfigState(cwd)
+
+    class AgentHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            state['last_request'] = time.time()
+            line = self.rfile.readline()
+            if not line:
+                # A bare connect, e.g. metaci agent status checking liveness
+                return
+            request = json.loads(line.decode('utf-8'))
+            if request.get('command') == 'stop':
+                state['stop'] = True
+                send_message(self.request, {'exit': 0})
+                return
+            config_state.acquire(request.get('env', {}))
+            try:
+                exit_code = invoke(
+                    request.get('argv', []),
+                    stdout=SocketWriter(self.request, 'out'),
+                    stderr=SocketWriter(self.request, 'err'),
+                    color=request.get('color'),
+                )
+                send_message(self.request, {'exit': exit_code})
+            except socket.error:
+                # The client went away, e.g. on Ctrl-C
+                pass
+            finally:
+                config_state.release()
+            state['last_request'] = time.time()
+
+    # A stale socket file from an agent that died would block binding
+    if os.path.exists(socket_path):
+        sock = connect(socket_path)
+        if sock:
+            sock.close()
+            return
+        os.remove(socket_path)
+
+    old_umask = os.umask(0o077)
+    try:
+        # Each command runs in its own thread so a long build tail doesn't
+        # hold up other commands
+        server = socketserver.ThreadingUnixStreamServer(socket_path, AgentHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    server.timeout = 1
+    try:
+        while not state['stop'] and (config_state.active or time.time() - state['last_request'] < idle_timeout):
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def stop(cwd):
+    """ asks the agent for cwd to exit.  Returns False if none was running. """
+    sock = connect(get_socket_path(cwd))
+    if sock is None:
+        return False
+    try:
+        send_message(sock, {'command': 'stop'})
+        for message in iter_messages(sock):
+            break
+    finally:
+        sock.close()
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'serve':
+        serve(sys.argv[2])
+    else:
+        sys.exit('Usage: python -m metaci_cli.agent serve <cwd>')
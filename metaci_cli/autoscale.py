@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""Queue depth autoscaling policy for build worker dynos"""
+
+import json
+import math
+from collections import OrderedDict
+
+class ScalingPolicy(object):
+    """ Decides how many worker dynos to run from the number of queued and in
+    progress builds.
+
+    Workers scale up towards the demand at most scale_up_step dynos at a
+    time.  They only scale down once demand has stayed below the current
+    count for scale_down_delay seconds, so a short lull between builds
+    doesn't stop dynos that are about to be needed again, and only while no
+    builds are queued.  The target never drops below the workers the in
+    progress builds need, but Heroku picks which dynos to stop, so a dyno
+    running a build can still be stopped on a scale down.  No change is made
+    within cooldown seconds of the last one, giving new dynos time to pick up
+    builds before the queue is read again. """
+
+    def __init__(self, min_workers=0, max_workers=4, builds_per_worker=1,
+                 scale_up_step=2, cooldown=120, scale_down_delay=600):
+        if min_workers > max_workers:
+            raise ValueError('min_workers must not be greater than max_workers')
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.builds_per_worker = builds_per_worker
+        self.scale_up_step = scale_up_step
+        self.cooldown = cooldown
+        self.scale_down_delay = scale_down_delay
+        self.last_change = None
+        self.below_since = None
+
+    def demand(self, queued, in_progress):
+        """ returns the number of workers needed for the builds, within the
+        policy's bounds """
+        needed = int(math.ceil(float(queued + in_progress) / self.builds_per_worker))
+        return max(self.min_workers, min(self.max_workers, needed))
+
+    def decide(self, workers, queued, in_progress, now):
+        """ returns the number of workers to run at time now, given the
+        current number, and remembers the change if there is one """
+        demand = self.demand(queued, in_progress)
+        if demand < workers:
+            if self.below_since is None:
+                self.below_since = now
+        else:
+            self.below_since = None
+
+        if demand == workers:
+            return workers
+        if self.last_change is not None and now - self.last_change < self.cooldown:
+            return workers
+        if demand > workers:
+            target = min(demand, workers + self.scale_up_step)
+        elif queued == 0 and now - self.below_since >= self.scale_down_delay:
+            target = demand
+        else:
+            return workers
+
+        self.last_change = now
+        self.below_since = None
+        return target
+
+def read_trace(lines):
+    """ Parses a recorded queue trace, one JSON object per line with the
+    time in epoch seconds and the queued and in_progress build counts, as
+    written by metaci site autoscale --record.  Returns a list of (time,
+    queued, in_progress) in time order. """
+    samples = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            sample = json.loads(line)
+            samples.append((float(sample['time']), int(sample['queued']), int(sample['in_progress'])))
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError('Invalid sample on line {}: {}'.format(number, e))
+    return sorted(samples)
+
+def trace_sample(now, queued, in_progress):
+    """ returns a sample as a line for a recorded trace """
+    return json.dumps(OrderedDict([
+        ('time', now),
+        ('queued', queued),
+        ('in_progress', in_progress),
+    ])) + '\n'
+
+def simulate(policy, samples, workers=0):
+    """ Replays samples through the policy and returns a row per sample with
+    the workers it would run.  Dynos are assumed to start instantly, so
+    worker_seconds and queued_seconds (build seconds spent waiting for a
+    worker) are for comparing policies rather than predicting costs. """
+    rows = []
+    for index, (now, queued, in_progress) in enumerate(samples):
+        target = policy.decide(workers, queued, in_progress, now)
+        if index + 1 < len(samples):
+            elapsed = samples[index + 1][0] - now
+        else:
+            elapsed = 0
+        rows.append(OrderedDict([
+            ('time', now),
+            ('queued', queued),
+            ('in_progress', in_progress),
+            ('workers', target),
+            ('change', target - workers),
+            ('worker_seconds', target * elapsed),
+            ('queued_seconds', max(0, queued + in_progress - target * policy.builds_per_worker) * elapsed),
+        ]))
+        workers = target
+    return rows
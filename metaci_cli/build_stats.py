@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""Grouped build statistics computed over columnar arrays"""
+
+import calendar
+import datetime
+import math
+from array import array
+from collections import OrderedDict
+
+# numpy is optional.  When installed the aggregation runs vectorized,
+# otherwise it falls back to plain Python over the same arrays.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STATUS_CODES = {
+    'success': 0,
+    'fail': 1,
+    'error': 2,
+}
+
+PERCENTILES = [50, 90, 99]
+
+NAN = float('nan')
+
+# Epoch seconds of midnight for each day seen, since most builds share days
+_days = {}
+
+def parse_time(value):
+    """ returns the epoch seconds of an ISO 8601 timestamp like
+    2017-10-12T17:23:45.123456Z or 2017-10-12T17:23:45+02:00, or NaN if the
+    value is empty.  Much faster than strptime for the fixed format the API
+    returns. """
+    if not value:
+        return NAN
+    day = value[:10]
+    midnight = _days.get(day)
+    if midnight is None:
+        midnight = _days[day] = calendar.timegm((int(day[0:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+    seconds = midnight + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+    rest = value[19:]
+    end = len(rest)
+    if rest.endswith(('Z', 'z')):
+        end -= 1
+    elif end >= 6 and rest[-6] in '+-':
+        end -= 6
+        offset = int(rest[-5:-3]) * 3600 + int(rest[-2:]) * 60
+        seconds -= offset if rest[-6] == '+' else -offset
+    if end:
+        # Fractional seconds, e.g. .123456
+        seconds += float(rest[:end])
+    return seconds
+
+def related_name(value):
+    """ returns the name of a related record the API returns either as a
+    nested object or as an id """
+    if isinstance(value, dict):
+        return value.get('name')
+    return value
+
+def iso_week(value):
+    if not value:
+        return None
+    year, week, day = datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10])).isocalendar()
+    return '{}-W{:02}'.format(year, week)
+
+# Fields builds can be grouped by, as functions returning a build's label
+GROUP_BY = OrderedDict([
+    ('repo', lambda build: related_name(build.get('repo'))),
+    ('plan', lambda build: related_name(build.get('plan'))),
+    ('branch', lambda build: related_name(build.get('branch'))),
+    ('day', lambda build: (build.get('time_queue') or '')[:10] or None),
+    ('week', lambda build: iso_week(build.get('time_queue'))),
+])
+
+def group_key(fields):
+    """ returns a group_key function for BuildColumns grouping by fields """
+    getters = [GROUP_BY[field] for field in fields]
+    return lambda build: u' / '.join(u'{}'.format(getter(build)) for getter in getters)
+
+def percentile(sorted_values, percent):
+    """ returns the percentile of a sorted list with linear interpolation
+    between closest ranks, the same as numpy's default, or None if there
+    are no values """
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * percent / 100.0
+    low = int(math.floor(rank))
+    high = int(math.ceil(rank))
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+def round_or_none(value):
+    return None if value is None else round(value, 1)
+
+class BuildColumns(object):
+    """ Holds finished builds as typed columns rather than records so 100k+
+    builds take a few megabytes.  group_key is called with each build and
+    returns the label of the group it belongs to. """
+
+    def __init__(self, group_key):
+        self.group_key = group_key
+        self.groups = OrderedDict()
+        self.group = array('i')
+        self.status = array('b')
+        self.duration = array('d')
+        self.queue_wait = array('d')
+
+    def __len__(self):
+        return len(self.group)
+
+    def add(self, build):
+        """ adds a build, returning False if it hasn't finished """
+        status = STATUS_CODES.get(build.get('status'))
+        if status is None:
+            return False
+        label = self.group_key(build)
+        if label not in self.groups:
+            self.groups[label] = len(self.groups)
+        queued = parse_time(build.get('time_queue'))
+        started = parse_time(build.get('time_start'))
+        ended = parse_time(build.get('time_end'))
+        self.group.append(self.groups[label])
+        self.status.append(status)
+        self.duration.append(ended - started)
+        self.queue_wait.append(started - queued)
+        return True
+
+    def aggregate(self):
+        """ returns a list of stats dicts, one per group, sorted by group """
+        if numpy is not None:
+            stats = self._aggregate_numpy()
+        else:
+            stats = self._aggregate_python()
+        return sorted(stats, key=lambda row: row['group'])
+
+    def _row(self, label, counts, durations, queue_waits):
+        """ builds the stats for a group from its success, fail and error
+        counts and the percentiles of its durations and queue waits """
+        builds = sum(counts)
+        row = OrderedDict([
+            ('group', label),
+            ('builds', builds),
+            ('success', counts[0]),
+            ('fail', counts[1]),
+            ('error', counts[2]),
+        ])
+        row['success_rate'] = round(100.0 * row['success'] / builds, 1)
+        for percent, value in zip(PERCENTILES, durations):
+            row['duration_p{}'.format(percent)] = round_or_none(value)
+        for percent, value in zip(PERCENTILES[:2], queue_waits):
+            row['queue_wait_p{}'.format(percent)] = round_or_none(value)
+        return row
+
+    def _aggregate_python(self):
+        labels = list(self.groups)
+        counts = [[0, 0, 0] for label in labels]
+        durations = [[] for label in labels]
+        queue_waits = [[] for label in labels]
+        for group, status, duration, queue_wait in zip(self.group, self.status, self.duration, self.queue_wait):
+            counts[group][status] += 1
+            # NaN != NaN, which skips builds missing a timestamp
+            if duration == duration:
+                durations[group].append(duration)
+            if queue_wait == queue_wait:
+                queue_waits[group].append(queue_wait)
+        rows = []
+        for group, label in enumerate(labels):
+            group_durations = sorted(durations[group])
+            group_queue_waits = sorted(queue_waits[group])
+            rows.append(self._row(
+                label,
+                counts[group],
+                [percentile(group_durations, percent) for percent in PERCENTILES],
+                [percentile(group_queue_waits, percent) for percent in PERCENTILES[:2]],
+            ))
+        return rows
+
+    def _aggregate_numpy(self):
+        groups = len(self.groups)
+        group = numpy.frombuffer(self.group, dtype=numpy.int32)
+        status = numpy.frombuffer(self.status, dtype=numpy.int8)
+        duration = numpy.frombuffer(self.duration, dtype=numpy.float64)
+        queue_wait = numpy.frombuffer(self.queue_wait, dtype=numpy.float64)
+
+        # One bin per group and status
+        counts = numpy.bincount(group * 3 + status, minlength=groups * 3).reshape(groups, 3)
+        durations = group_percentiles(group, duration, groups, PERCENTILES)
+        queue_waits = group_percentiles(group, queue_wait, groups, PERCENTILES[:2])
+        return [
+            self._row(label, counts[index].tolist(), nan_to_none(durations[index]), nan_to_none(queue_waits[index]))
+            for label, index in self.groups.items()
+        ]
+
+def group_percentiles(group, values, groups, percents):
+    """ returns a groups by percents numpy array of the percentiles of values
+    within each group, computed like percentile() without looping over the
+    groups.  NaN values are skipped and groups without values get NaN. """
+    keep = ~numpy.isnan(values)
+    group = group[keep]
+    # Sorts by group, then by value, so each group is a sorted slice
+    order = numpy.lexsort((values[keep], group))
+    values = values[keep][order]
+    counts = numpy.bincount(group, minlength=groups)
+    result = numpy.full((groups, len(percents)), NAN)
+    if not len(values):
+        return result
+    starts = numpy.cumsum(counts) - counts
+    rank = (counts - 1)[:, None] * numpy.array(percents) / 100.0
+    low = numpy.floor(rank)
+    high = numpy.ceil(rank)
+    # Empty groups have a negative rank, clipped here and masked below
+    last = len(values) - 1
+    low_values = values[numpy.clip(starts[:, None] + low.astype(numpy.intp), 0, last)]
+    high_values = values[numpy.clip(starts[:, None] + high.astype(numpy.intp), 0, last)]
+    filled = counts > 0
+    result[filled] = (low_values + (high_values - low_values) * (rank - low))[filled]
+    return result
+
+def nan_to_none(values):
+    return [None if math.isnan(value) else value for value in values.tolist()]
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""Local on-disk caches for data fetched from a MetaCI site"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+# Build statuses, shared by the caches which only keep finished builds and
+# the commands that follow builds
+ACTIVE_STATUSES = ['queued', 'waiting', 'in_progress']
+TERMINAL_STATUSES = ['success', 'fail', 'error']
+
+
+def get_cache_dir(*parts):
+    """ returns the metaci cache directory inside the CumulusCI config dir,
+    creating it if needed """
+    from cumulusci.core.config import BaseGlobalConfig
+    path = os.path.join(
+        os.path.expanduser('~'),
+        BaseGlobalConfig.config_local_dir,
+        'metaci',
+        *parts
+    )
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def get_site_key(site_url):
+    """ returns a filesystem safe key for a site url,
+    e.g. https://metaci.herokuapp.com -> metaci.herokuapp.com """
+    key = re.sub(r'^\w+://', '', site_url.strip().rstrip('/'))
+    return re.sub(r'[^A-Za-z0-9.-]+', '_', key)
+
+
+def get_site_cache_dir(site_url, *parts):
+    """ returns the cache directory for a single MetaCI site """
+    return get_cache_dir('sites', get_site_key(site_url), *parts)
+
+
+def write_atomic(path, data):
+    """ writes data to path via a temp file so readers never see a partial
+    file """
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class SchemaCache(object):
+    """ Caches the raw /api/schema response for a site along with its ETag
+    so ApiClient can skip the schema round trip on every command """
+
+    def __init__(self, site_url, ttl=None):
+        if ttl is None:
+            ttl = int(os.environ.get('METACI_SCHEMA_TTL', 3600))
+        self.ttl = ttl
+        self.path = os.path.join(get_site_cache_dir(site_url), 'schema.json')
+
+    def get(self):
+        """ returns the cached entry or None if there is no usable entry """
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            # A corrupt cache file is the same as no cache file
+            return None
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched'] < self.ttl
+
+    def save(self, url, content, content_type=None, etag=None):
+        entry = {
+            'url': url,
+            'content': content,
+            'content_type': content_type,
+            'etag': etag,
+            'fetched': time.time(),
+        }
+        write_atomic(self.path, json.dumps(entry))
+        return entry
+
+    def touch(self, entry):
+        """ marks a revalidated (304 Not Modified) entry as fresh again """
+        return self.save(
+            entry['url'],
+            entry['content'],
+            content_type=entry['content_type'],
+            etag=entry['etag'],
+        )
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+# The only fields the index keeps from a record.  Org and service records
+# carry their config json, tokens included, which must not be copied out of
+# the keychain into a plaintext file.
+INDEX_FIELDS = ['id', 'name', 'owner', 'org']
+
+
+def index_fields(record):
+    """ returns the part of a record needed to resolve names to ids """
+    entry = {}
+    for field in INDEX_FIELDS:
+        value = record.get(field)
+        if value is not None and not isinstance(value, (dict, list)):
+            entry[field] = value
+    if isinstance(record.get('repo'), dict):
+        entry['repo'] = {'id': record['repo'].get('id')}
+    return entry
+
+
+class ResolutionIndex(object):
+    """ A local index of name to id lookups (repos by OwnerName/RepoName,
+    orgs and branches by repo and name, plans by id, services by name) so
+    commands can resolve the ids they need without a list call each time.
+
+    Only the fields in INDEX_FIELDS are kept, so commands which display a
+    record should read it from the server instead.  Entries expire after
+    METACI_INDEX_TTL seconds (default one hour) and misses always fall
+    through to the server. """
+
+    def __init__(self, site_url, ttl=None):
+        if ttl is None:
+            ttl = int(os.environ.get('METACI_INDEX_TTL', 3600))
+        self.ttl = ttl
+        site_dir = get_site_cache_dir(site_url)
+        self.path = os.path.join(site_dir, 'index-v2.json')
+        self._entries = None
+        self._lock = threading.RLock()
+
+        # Earlier versions indexed whole records, configs and all
+        legacy_path = os.path.join(site_dir, 'index.json')
+        if os.path.isfile(legacy_path):
+            os.remove(legacy_path)
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = {}
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path, 'r') as f:
+                        self._entries = json.load(f)
+                except ValueError:
+                    pass
+        return self._entries
+
+    def _save(self):
+        write_atomic(self.path, json.dumps(self.entries))
+
+    def get(self, kind, key):
+        """ returns the indexed record or None if missing or expired """
+        with self._lock:
+            entry = self.entries.get(kind, {}).get(key)
+        if entry is None or time.time() - entry['ts'] >= self.ttl:
+            return None
+        return entry['record']
+
+    def put(self, kind, key, record):
+        with self._lock:
+            self.entries.setdefault(kind, {})[key] = {
+                'ts': time.time(),
+                'record': index_fields(record),
+            }
+            self._save()
+
+    def invalidate(self, kind=None, key=None):
+        """ drops a single entry, every entry of a kind, or the whole index """
+        with self._lock:
+            if kind is None:
+                self._entries = {}
+            elif key is None:
+                self.entries.pop(kind, None)
+            else:
+                self.entries.get(kind, {}).pop(key, None)
+            self._save()
+
+    def resolve(self, kind, key, fetch):
+        """ returns the indexed fields of the record for key, calling fetch()
+        to look it up on the server on a miss.  fetch() should return None if
+        not found. """
+        record = self.get(kind, key)
+        if record is None:
+            record = fetch()
+            if record is not None:
+                self.put(kind, key, record)
+                record = index_fields(record)
+        return record
+
+
+def config_hash(params):
+    """ returns a stable hash of the params pushed to the site for a config """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SyncHashes(object):
+    """ Remembers the hash of each org or service config last pushed to a
+    site by metaci org sync and metaci service sync so configs which haven't
+    changed locally are skipped without being sent again """
+
+    def __init__(self, site_url, kind):
+        self.path = os.path.join(get_site_cache_dir(site_url), 'synced_{}.json'.format(kind))
+        self.hashes = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.hashes = json.load(f)
+            except ValueError:
+                pass
+
+    def __contains__(self, key):
+        return key in self.hashes
+
+    def changed(self, key, params):
+        return self.hashes.get(key) != config_hash(params)
+
+    def update(self, key, params):
+        self.hashes[key] = config_hash(params)
+
+    def save(self):
+        write_atomic(self.path, json.dumps(self.hashes))
@@ -1,7 +1 @@
 from metaci_cli.cli.commands.main import main
-from metaci_cli.cli.commands.build import build
-from metaci_cli.cli.commands.org import org
-from metaci_cli.cli.commands.plan import plan
-from metaci_cli.cli.commands.repo import repo
-from metaci_cli.cli.commands.service import service
-from metaci_cli.cli.commands.site import site
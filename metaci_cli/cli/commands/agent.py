@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+"""agent command subgroup for metaci CLI"""
+
+import click
+import os
+from metaci_cli import agent as metaci_agent
+
+@click.group('agent', short_help='Manage the background agent used by metaci-client', help='Manage the background agent that keeps metaci warm for metaci-client.  Run any command as metaci-client <command> to use the agent, which starts automatically on first use.')
+def agent():
+    pass
+
+@click.command(name='start', help='Starts the agent for the current directory')
+def agent_start():
+    cwd = os.getcwd()
+    sock = metaci_agent.connect(metaci_agent.get_socket_path(cwd))
+    if sock:
+        sock.close()
+        click.echo('Agent is already running')
+        return
+    sock = metaci_agent.start_agent(cwd)
+    if sock is None:
+        raise click.ClickException('The agent did not start within {} seconds'.format(metaci_agent.START_TIMEOUT))
+    sock.close()
+    click.echo('Agent started')
+
+@click.command(name='status', help='Shows whether the agent for the current directory is running')
+def agent_status():
+    socket_path = metaci_agent.get_socket_path(os.getcwd())
+    sock = metaci_agent.connect(socket_path)
+    if sock:
+        sock.close()
+        click.echo(click.style('Agent is running on {}'.format(socket_path), fg='green'))
+    else:
+        click.echo('Agent is not running')
+
+@click.command(name='stop', help='Stops the agent for the current directory')
+def agent_stop():
+    if metaci_agent.stop(os.getcwd()):
+        click.echo('Agent stopped')
+    else:
+        click.echo('Agent is not running')
+
+agent.add_command(agent_start)
+agent.add_command(agent_status)
+agent.add_command(agent_stop)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""apply command for metaci CLI"""
+
+import click
+from metaci_cli.cli.commands.org import org_config_params
+from metaci_cli.cli.commands.service import service_config_params
+from metaci_cli.cli.config import pass_config
+from metaci_cli.cli.output import OutputWriter
+from metaci_cli.cli.output import output_option
+from metaci_cli.cli.util import push_record
+from metaci_cli.metaci_api import ApiClient
+from metaci_cli.site_spec import STAGES
+from metaci_cli.site_spec import SpecError
+from metaci_cli.site_spec import change_name
+from metaci_cli.site_spec import diff_spec
+from metaci_cli.site_spec import index_state
+from metaci_cli.site_spec import load_spec
+
+RESOURCES = {
+    'repo': 'repos',
+    'org': 'orgs',
+    'service': 'services',
+    'plan': 'plans',
+    'plan_repo': 'plan_repos',
+}
+
+def list_all(api_client, resource):
+    return list(api_client.iter_results(resource, 'list'))
+
+def fetch_state(api_client):
+    """ lists every record of every kind on the site, one list call per kind
+    running concurrently """
+    resources = list(RESOURCES.values())
+    pending = [api_client.spawn(list_all, api_client, resource) for resource in resources]
+    return dict(zip(resources, api_client.gather(*pending)))
+
+def read_keychain(config, changes):
+    """ adds the json of each org and service to create from the local cci
+    keychain, so a missing one fails before anything is created """
+    from cumulusci.core.exceptions import OrgNotFound
+    from cumulusci.core.exceptions import ServiceNotConfigured
+    from cumulusci.core.exceptions import ServiceNotValid
+    for change in changes:
+        if change['action'] != 'create':
+            continue
+        if change['kind'] == 'org':
+            name = change['item']['org']
+            try:
+                org_config = config.keychain.get_org(name)
+            except OrgNotFound:
+                raise click.ClickException('The org {} is not configured in the local cci keychain'.format(name))
+            change['params'] = org_config_params(org_config)
+        elif change['kind'] == 'service':
+            name = change['item']['name']
+            try:
+                service_config = config.keychain.get_service(name)
+            except (ServiceNotConfigured, ServiceNotValid):
+                raise click.ClickException('The service {} is not configured in the local cci keychain.  Use cci service connect {}'.format(name, name))
+            change['params'] = service_config_params(service_config)
+
+def apply_change(api_client, change, ids):
+    """ creates the object for a change and returns (record, None) or (None,
+    error message).  ids maps (kind, key) to the id of each repo and plan
+    created or found so far """
+    kind = change['kind']
+    item = change['item']
+    try:
+        if kind == 'org':
+            params = {
+                'repo_id': ids[('repo', item['repo'])],
+                'name': item['name'],
+            }
+        elif kind == 'plan_repo':
+            params = {
+                'plan_id': ids[('plan', item['plan'])],
+                'repo_id': ids[('repo', item['repo'])],
+            }
+        else:
+            params = dict(item)
+    except KeyError as e:
+        return None, 'skipped, {} {} was not created'.format(*e.args[0])
+    params.update(change.get('params') or {})
+    return push_record(api_client, RESOURCES[kind], None, params)
+
+def index_record(api_client, change, record):
+    kind = change['kind']
+    if kind == 'repo':
+        api_client.index.put('repo', change['key'], record)
+    elif kind == 'org':
+        api_client.index.put('org', '{}:{}'.format(record['repo']['id'], record['name']), record)
+        api_client.index.invalidate('org', '*:{}'.format(record['name']))
+    elif kind == 'service':
+        api_client.index.put('service', change['key'], record)
+    elif kind == 'plan':
+        api_client.index.put('plan', str(record['id']), record)
+
+@click.command(name='apply', short_help='Create the repos, orgs, services and plans in a YAML spec', help='Creates the repos, orgs, services and plans described in a YAML spec which do not exist on the site yet')
+@click.argument('spec_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help="Print what would be created without creating anything")
+@output_option
+@pass_config
+def apply(config, spec_file, dry_run, output_format):
+    try:
+        spec = load_spec(spec_file)
+    except SpecError as e:
+        raise click.UsageError(str(e))
+
+    api_client = ApiClient(config)
+    state = fetch_state(api_client)
+    try:
+        changes = diff_spec(spec, state)
+    except SpecError as e:
+        raise click.UsageError(str(e))
+    read_keychain(config, changes)
+
+    if not dry_run:
+        ids = {}
+        existing = index_state(state)
+        for kind in ('repo', 'plan'):
+            for key, record in existing[kind].items():
+                ids[(kind, key)] = record['id']
+
+        # Each stage only needs the ids created by earlier stages, so the
+        # creates within a stage all run at once, bounded by
+        # METACI_MAX_CONCURRENCY
+        for stage in STAGES:
+            creates = [change for change in changes if change['kind'] in stage and change['action'] == 'create']
+            pending = [api_client.spawn(apply_change, api_client, change, ids) for change in creates]
+            for change, (record, error) in zip(creates, api_client.gather(*pending)):
+                change['record'] = record
+                change['error'] = error
+                if record:
+                    ids[(change['kind'], change['key'])] = record['id']
+                    index_record(api_client, change, record)
+
+    apply_fmt = '{kind:10} {name:48.48} {status}'
+    headers = {
+        'kind': 'Kind',
+        'name': 'Name',
+        'status': 'Status',
+    }
+    colors = {
+        'create': 'yellow',
+        'created': 'green',
+        'exists': None,
+    }
+    style = lambda row, line: click.style(line, fg=colors.get(row['status'], 'red'))
+    counts = dict.fromkeys(['create', 'created', 'exists', 'failed'], 0)
+    with OutputWriter(output_format, apply_fmt, headers, style) as writer:
+        for change in changes:
+            if change['action'] == 'exists' or dry_run:
+                status = change['action']
+            elif change['record']:
+                status = 'created'
+            else:
+                status = change['error']
+            counts[status if status in counts else 'failed'] += 1
+            writer.write_record({
+                'kind': change['kind'],
+                'name': change_name(change),
+                'id': change['record']['id'] if change['record'] else None,
+                'status': status,
+            })
+
+    if counts['failed']:
+        raise click.ClickException('{} of {} objects could not be created'.format(counts['failed'], counts['failed'] + counts['created']))
+    if output_format == 'table':
+        click.echo()
+        if dry_run:
+            click.echo('Dry run: {create} to create, {exists} already exist'.format(**counts))
+        else:
+            click.echo('{created} created, {exists} already exist'.format(**counts))
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""batch command for metaci CLI"""
+
+import click
+import io
+import json
+import shlex
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from metaci_cli.cli.config import pass_config
+from metaci_cli.cli.runner import invoke
+
+def parse_line(line):
+    """ Parses one line of a batch file into a list of metaci arguments, or
+    None for blank and comment lines.  A line is either a command as it would
+    be typed after metaci, e.g. `build info 123`, or a JSON object with the
+    arguments as a list, e.g. {"args": ["build", "info", "123"]} """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.startswith('{'):
+        try:
+            command = json.loads(line)
+        except ValueError as e:
+            raise ValueError('Invalid JSON: {}'.format(e))
+        args = command.get('args')
+        if not isinstance(args, list):
+            raise ValueError('JSON commands must have an "args" list')
+        return [u'{}'.format(arg) for arg in args]
+    args = shlex.split(line)
+    if args[:1] == ['metaci']:
+        args = args[1:]
+    return args
+
+def read_commands(lines):
+    """ returns a list of (line number, args, error) for each command line """
+    commands = []
+    for number, line in enumerate(lines, 1):
+        try:
+            args = parse_line(line)
+        except ValueError as e:
+            commands.append((number, None, str(e)))
+            continue
+        if args is None:
+            continue
+        if args[:1] == ['batch']:
+            commands.append((number, None, 'batch commands can not be nested'))
+            continue
+        commands.append((number, args, None))
+    return commands
+
+def format_result(result):
+    if result['status'] == 'skipped':
+        status = click.style('skipped', fg='yellow')
+    elif result['exit_code'] == 0:
+        status = click.style('ok', fg='green')
+    else:
+        status = click.style('failed ({})'.format(result['exit_code']), fg='red')
+    lines = ['[line {}] {} {} ({:.2f}s)'.format(
+        result['line'],
+        ' '.join(result['args'] or []),
+        status,
+        result['duration'],
+    )]
+    for output in (result['stdout'], result['stderr']):
+        for line in output.rstrip('\n').splitlines():
+            lines.append('    ' + line)
+    return '\n'.join(lines)
+
+@click.command(name='batch', short_help='Run many metaci commands from a file in one process', help='Runs metaci commands read one per line from a file, or - for stdin, in a single process.  Each line is either a command as typed after metaci, e.g. build info 123, or a JSON object like {"args": ["build", "info", "123"]}.  Blank lines and lines starting with # are ignored.  Prompts can not be answered so pass every option a command needs.')
+@click.argument('path', type=click.File('r'))
+@click.option('--parallel', type=int, default=1, help="Run up to this many lines at once.  Only use this when lines don't depend on each other.")
+@click.option('--stop-on-error', is_flag=True, help="Skip remaining lines after a line fails")
+@click.option('--json', 'as_json', is_flag=True, help="Report results as one JSON object per line")
+@pass_config
+def batch(config, path, parallel, stop_on_error, as_json):
+    commands = read_commands(path)
+    if parallel < 1:
+        raise click.UsageError('--parallel must be at least 1')
+
+    # Load the keychain up front so threads share one instead of racing to
+    # decrypt it.  Lines that need a project will report the error themselves.
+    try:
+        config.keychain
+    except click.ClickException:
+        pass
+
+    failed = threading.Event()
+
+    def run(command):
+        number, args, error = command
+        result = {
+            'line': number,
+            'args': args,
+            'status': 'failed',
+            'exit_code': 1,
+            'stdout': u'',
+            'stderr': error or u'',
+            'duration': 0.0,
+        }
+        if error:
+            failed.set()
+            return result
+        if stop_on_error and failed.is_set():
+            result.update({'status': 'skipped', 'exit_code': None})
+            return result
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        start = time.time()
+        exit_code = invoke(args, stdout=stdout, stderr=stderr, banner=False)
+        result.update({
+            'status': 'ok' if exit_code == 0 else 'failed',
+            'exit_code': exit_code,
+            'stdout': stdout.getvalue(),
+            'stderr': stderr.getvalue(),
+            'duration': time.time() - start,
+        })
+        if exit_code != 0:
+            failed.set()
+        return result
+
+    # Commands use the shared API pool for their own requests, so lines get a
+    # pool of their own to avoid waiting on themselves
+    pool = ThreadPool(parallel) if parallel > 1 else None
+    try:
+        results = pool.imap(run, commands) if pool else (run(command) for command in commands)
+        counts = {'ok': 0, 'failed': 0, 'skipped': 0}
+        for result in results:
+            counts[result['status']] += 1
+            if as_json:
+                click.echo(json.dumps(result))
+            else:
+                click.echo(format_result(result))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if not as_json:
+        click.echo()
+        click.echo('{ok} succeeded, {failed} failed, {skipped} skipped'.format(**counts))
+    click.get_current_context().exit(1 if counts['failed'] else 0)
@@ -4,23 +4,79 @@
 
 import click
 import coreapi
-import webbrowser
-from metaci_cli.cli.commands.main import main
+import time
+from metaci_cli.cli.util import BUILD_EXIT_CODES
+from metaci_cli.cli.util import Backoff
+from metaci_cli.cli.util import TERMINAL_STATUSES
 from metaci_cli.cli.util import color_status
 from metaci_cli.cli.util import check_current_site
+from metaci_cli.cli.util import iter_list
+from metaci_cli.cli.util import iter_local
+from metaci_cli.cli.util import local_option
+from metaci_cli.cli.util import lookup_branch
 from metaci_cli.cli.util import lookup_repo
-from metaci_cli.cli.util import render_recursive
+from metaci_cli.cli.util import open_mirror
+from metaci_cli.cli.util import pagination_options
 from metaci_cli.cli.config import pass_config
+from metaci_cli.cli.output import OutputWriter
+from metaci_cli.cli.output import echo_record
+from metaci_cli.cli.output import output_option
+from metaci_cli.build_stats import BuildColumns
+from metaci_cli.build_stats import GROUP_BY
+from metaci_cli.build_stats import group_key
+from metaci_cli.log_cache import LogCache
+from metaci_cli.log_index import LogIndex
 from metaci_cli.metaci_api import ApiClient
 
-@click.group('build')
+@click.group('build', short_help='List, inspect and follow builds')
 def build():
     pass
 
+def echo_log(chunks):
+    for chunk in chunks:
+        click.echo(chunk, nl=False)
+    click.echo()
+
+def read_build(api_client, build_id):
+    """ returns a build without its log, or None if it doesn't exist """
+    try:
+        return api_client('builds', 'read', params={'id': build_id}, omit=['log'])
+    except coreapi.exceptions.ErrorMessage:
+        return None
+
+def read_builds(api_client, build_ids):
+    """ Returns a dict of build id to build, without logs, for the given ids.
+    Uses one list call filtered by id when the API supports it and
+    concurrent reads otherwise, so the cost depends on the number of ids
+    rather than on how busy the site is. """
+    build_ids = sorted(build_ids)
+    if api_client.has_param(['builds', 'list'], 'id__in'):
+        builds = api_client.iter_results('builds', 'list', params={'id__in': ','.join(build_ids)}, omit=['log'])
+        found = dict((str(build_res['id']), build_res) for build_res in builds)
+    else:
+        pending = [api_client.spawn(read_build, api_client, build_id) for build_id in build_ids]
+        found = dict(
+            (build_id, build_res)
+            for build_id, build_res in zip(build_ids, api_client.gather(*pending))
+            if build_res is not None
+        )
+    missing = [build_id for build_id in build_ids if build_id not in found]
+    if missing:
+        raise click.ClickException('Build(s) with id {} not found.  Use metaci build list to see a list of latest builds and their ids'.format(', '.join(missing)))
+    return found
+
+def fetch_build_logs(api_client, build_id):
+    """ returns the log of a build and a list of (flow name, log) pairs for
+    each of its flows """
+    build_res = api_client('builds', 'read', params={'id': build_id})
+    build_flows = api_client.iter_results('build_flows', 'list', params={'build': build_id})
+    return build_res['log'], [(build_flow['flow'], build_flow['log']) for build_flow in build_flows]
+
 @click.command(name='browser', help='Opens the build on the MetaCI site in a browser tab')
 @click.argument('build_id')
 @pass_config
 def build_browser(config, build_id):
+    import webbrowser
     api_client = ApiClient(config)
 
     params = {
@@ -43,48 +99,89 @@ def build_browser(config, build_id):
 @click.option('--log', is_flag=True, help="If set, only outputs the build log")
 @click.option('--flow-log', is_flag=True, help="If set, only outputs logs from all CumulusCI flows run by this build")
 @click.option('--flow', help="Used with --flow-log, limits the log output to only the specified flow")
+@local_option
+@output_option
 @pass_config
-def build_info(config, build_id, log, flow_log, flow):
+def build_info(config, build_id, log, flow_log, flow, local, output_format):
+    if local and not (log or flow_log):
+        build_res = open_mirror(config).get('builds', build_id)
+        if build_res is None:
+            raise click.ClickException('Build with id {} not found in the local mirror.  Use metaci mirror sync to update the mirror'.format(build_id))
+        echo_record(build_res, output_format)
+        return
+
+    service = check_current_site(config)
+    log_cache = LogCache(service.url)
+
+    # Logs of finished builds never change so serve them from the cache
+    if log and log_cache.has_log(build_id):
+        echo_log(log_cache.iter_log(build_id))
+        return
+    if flow_log and log_cache.has_flows(build_id):
+        for build_flow in log_cache.get_flows(build_id):
+            if flow and build_flow != flow:
+                continue
+            click.echo()
+            click.echo(click.style('{}:'.format(build_flow), bold=True, fg='blue'))
+            echo_log(log_cache.iter_log(build_id, build_flow))
+        return
+
     api_client = ApiClient(config)
 
     params = {
         'id': build_id,
     }
 
-    # Look up the build
+    # Look up the build, only downloading the log if it will be shown
+    omit = None if log else ['log']
     try:
-        build_res = api_client('builds', 'read', params=params)
+        build_res = api_client('builds', 'read', params=params, omit=omit)
     except coreapi.exceptions.ErrorMessage as e:
         raise click.ClickException('Build with id {} not found.  Use metaci build list to see a list of latest builds and their ids'.format(build_id))
+    finished = build_res['status'] in TERMINAL_STATUSES
 
     if log:
+        if finished:
+            log_cache.put_log(build_id, build_res['log'])
         click.echo(build_res['log'])
     elif flow_log:
         params = {
             'build': build_id
         }
-        if flow:
+        # Finished builds cache every flow even if only one was asked for
+        if flow and not finished:
             params['flow'] = flow
-        build_flow_res = api_client('build_flows', 'list', params=params)
-        for build_flow in build_flow_res['results']:
+        build_flows = list(api_client.iter_results('build_flows', 'list', params=params))
+        if finished:
+            log_cache.put_flows(
+                build_id,
+                [(build_flow['flow'], build_flow['log']) for build_flow in build_flows],
+            )
+        for build_flow in build_flows:
+            if flow and build_flow['flow'] != flow:
+                continue
             click.echo()
             click.echo(click.style('{}:'.format(build_flow['flow']), bold=True, fg='blue'))
             click.echo(build_flow['log'])
         
     else:
-        click.echo(render_recursive(build_res))
+        echo_record(build_res, output_format)
 
 @click.command(name='list', help='Lists builds')
 @click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
 @click.option('--status', help="Filter by build status, options: queued, waiting, in_progress, success, failed, error")
+@pagination_options
+@local_option
+@output_option
 @pass_config
-def build_list(config, repo, status):
-    api_client = ApiClient(config)
+def build_list(config, repo, status, limit, all_pages, local, output_format):
+    api_client = None if local else ApiClient(config)
+    mirror = open_mirror(config) if local else None
 
     params = {}
 
     # Filter by repository
-    repo_data = lookup_repo(api_client, config, repo)
+    repo_data = lookup_repo(api_client, config, repo, no_output=output_format != 'table', mirror=mirror)
     if repo_data:
         params['repo'] = repo_data['id']
 
@@ -92,7 +189,13 @@ def build_list(config, repo, status):
     if status:
         params['status'] = status
 
-    res = api_client('builds', 'list', params=params)
+    if local:
+        filters = {'status': status} if status else {}
+        if repo_data:
+            filters['repo_id'] = repo_data['id']
+        builds = iter_local(mirror, 'builds', filters, limit, all_pages)
+    else:
+        builds = iter_list(api_client, 'builds', params, limit, all_pages, omit=['log'])
 
     build_list_fmt = '{id:<5} {status:8.8} {plan[name]:24.24} {branch[name]:24.24} {commit}'
     headers = {
@@ -102,17 +205,289 @@ def build_list(config, repo, status):
         'branch': {'name': 'Branch'},
         'commit': 'Commit',
     }
-    click.echo(build_list_fmt.format(**headers))
-    for build in res['results']:
-        click.echo(
-            color_status(
-                status = build['status'],
-                line = build_list_fmt.format(**build),
-            )
-        )
+    style = lambda build, line: color_status(status=build['status'], line=line)
+    with OutputWriter(output_format, build_list_fmt, headers, style) as writer:
+        writer.write_records(builds)
     
 
+@click.command(name='tail', help='Follows the log output of a build until it completes.  The API can only return whole logs, so each poll downloads the full log of every flow still running and prints the part not yet shown.')
+@click.argument('build_id')
+@click.option('--interval', type=float, default=1, help="Initial seconds between polls.  Polling slows down while the build is quiet.")
+@click.option('--max-interval', type=float, default=30, help="Maximum seconds between polls")
+@pass_config
+def build_tail(config, build_id, interval, max_interval):
+    api_client = ApiClient(config)
+    backoff = Backoff(interval, max_interval)
+
+    # Offsets into the build log (None) and each flow log already printed,
+    # keyed by build flow id since a plan can run the same flow twice
+    offsets = {}
+    # Flows whose final log has been printed, so they are not read again
+    finished_flows = set()
+
+    def echo_new_output(key, log):
+        log = log or ''
+        offset = offsets.get(key, 0)
+        if len(log) <= offset:
+            return False
+        click.echo(log[offset:], nl=False)
+        offsets[key] = len(log)
+        return True
+
+    def read_build(omit=None):
+        try:
+            return api_client('builds', 'read', params={'id': build_id}, omit=omit)
+        except coreapi.exceptions.ErrorMessage as e:
+            raise click.ClickException('Build with id {} not found.  Use metaci build list to see a list of latest builds and their ids'.format(build_id))
+
+    # Each poll lists the flows without their logs and then reads the log of
+    # each flow that hasn't finished yet, so only the active flow's log is
+    # downloaded again.  The build log is only read until the first flow
+    # starts and once more when the build finishes.
+    while True:
+        build_res = read_build(omit=['log'])
+        build_flows = list(api_client.iter_results('build_flows', 'list', params={'build': build_id}, omit=['log']))
+        finished = build_res['status'] in TERMINAL_STATUSES
+
+        changed = False
+        for build_flow in build_flows:
+            flow_id = build_flow['id']
+            if flow_id in finished_flows:
+                continue
+            if flow_id not in offsets:
+                click.echo()
+                click.echo(click.style('{}:'.format(build_flow['flow']), bold=True, fg='blue'))
+                offsets[flow_id] = 0
+            log = api_client('build_flows', 'read', params={'id': flow_id})['log']
+            changed = echo_new_output(flow_id, log) or changed
+            if build_flow['status'] in TERMINAL_STATUSES:
+                finished_flows.add(flow_id)
+        if not build_flows or finished:
+            changed = echo_new_output(None, read_build()['log']) or changed
+
+        if finished:
+            break
+        if changed:
+            backoff.reset()
+        time.sleep(backoff.next())
+
+    status = build_res['status']
+    click.echo()
+    click.echo(color_status(status, 'Build {} finished with status {}'.format(build_id, status)))
+    click.get_current_context().exit(BUILD_EXIT_CODES[status])
+
+
+@click.command(name='wait', help='Waits for one or more builds to complete')
+@click.argument('build_ids', nargs=-1, required=True)
+@click.option('--interval', type=float, default=5, help="Initial seconds between polls")
+@click.option('--max-interval', type=float, default=60, help="Maximum seconds between polls")
+@click.option('--expected-duration', type=float, help="Expected build duration in seconds.  Polls are never spaced further apart than the expected time left on a running build.")
+@click.option('--timeout', type=float, help="Give up waiting after this many seconds")
+@pass_config
+def build_wait(config, build_ids, interval, max_interval, expected_duration, timeout):
+    api_client = ApiClient(config)
+    backoff = Backoff(interval, max_interval)
+    started = time.time()
+    pending = set(build_ids)
+    statuses = {}
+    running_since = {}
+    finished = {}
+
+    while True:
+        builds = read_builds(api_client, pending)
+        changed = False
+        for build_id, build_res in builds.items():
+            status = build_res['status']
+            if statuses.get(build_id) != status:
+                changed = True
+                statuses[build_id] = status
+                click.echo(color_status(status, 'Build {}: {}'.format(build_id, status)))
+            if status == 'in_progress':
+                running_since.setdefault(build_id, time.time())
+            if status in TERMINAL_STATUSES:
+                finished[build_id] = build_res
+
+        pending -= set(finished)
+        if not pending:
+            break
+
+        now = time.time()
+        if timeout and now - started > timeout:
+            raise click.ClickException('Timed out waiting for builds: {}'.format(', '.join(sorted(pending))))
+        if changed:
+            backoff.reset()
+        sleep = backoff.next()
+        if expected_duration:
+            # Don't sleep past the point where a running build should finish
+            for build_id in pending.intersection(running_since):
+                remaining = expected_duration - (now - running_since[build_id])
+                sleep = min(sleep, max(remaining, interval))
+        time.sleep(sleep)
+
+    exit_code = max(BUILD_EXIT_CODES[build_res['status']] for build_res in finished.values())
+    click.echo()
+    if exit_code:
+        click.echo(click.style('One or more builds did not succeed', fg='red', bold=True))
+    else:
+        click.echo(click.style('All builds succeeded', fg='green', bold=True))
+    click.get_current_context().exit(exit_code)
+
+
+GREP_FILL_BATCH_SIZE = 32
+
+@click.command(name='grep', help='Searches the logs of finished builds for lines containing TEXT, ignoring case.  Logs are fetched and indexed locally the first time they are searched, so later searches are fast.  Matching is word based, so TEXT should start at the beginning of a word.')
+@click.argument('text')
+@click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
+@click.option('--plan', 'plan_id', type=int, help="Only search builds of the plan with this id")
+@click.option('--branch', help="Only search builds of this branch")
+@click.option('--status', type=click.Choice(TERMINAL_STATUSES), help="Only search builds that finished with this status")
+@click.option('--limit', type=int, default=500, help="Search the logs of this many of the most recent builds.  Defaults to 500")
+@click.option('--all', 'all_pages', is_flag=True, help="Search the logs of every matching build")
+@local_option
+@output_option
+@pass_config
+def build_grep(config, text, repo, plan_id, branch, status, limit, all_pages, local, output_format):
+    api_client = ApiClient(config)
+    mirror = open_mirror(config) if local else None
+    log_cache = LogCache(api_client.service.url)
+    log_index = LogIndex(api_client.service.url)
+
+    params = {}
+    repo_data = lookup_repo(api_client, config, repo, no_output=output_format != 'table', mirror=mirror)
+    if repo_data:
+        params['repo'] = repo_data['id']
+    if plan_id:
+        params['plan'] = plan_id
+    if branch:
+        if not repo_data:
+            raise click.UsageError('--branch requires a repository.  Use --repo OwnerName/RepoName or run from a local git repository configured for CumulusCI')
+        if local:
+            branch_data = next(mirror.query('branches', {'repo_id': repo_data['id'], 'name': branch}), None)
+        else:
+            branch_data = lookup_branch(api_client, branch, repo_data['id'])
+        if branch_data is None:
+            raise click.ClickException('Branch {} not found'.format(branch))
+        params['branch'] = branch_data['id']
+    if status:
+        params['status'] = status
+
+    # Find the finished builds to search
+    if all_pages:
+        limit = None
+    if local:
+        filters = {'status': status or TERMINAL_STATUSES}
+        for key in ('repo', 'plan', 'branch'):
+            if key in params:
+                filters[key + '_id'] = params[key]
+        builds = mirror.query('builds', filters, limit)
+    else:
+        builds = (
+            build_res for build_res in api_client.iter_results('builds', 'list', params=params, omit=['log'])
+            if build_res['status'] in TERMINAL_STATUSES
+        )
+    build_ids = []
+    for build_res in builds:
+        build_ids.append(build_res['id'])
+        if limit is not None and len(build_ids) >= limit:
+            break
+
+    # Index any logs not yet indexed, fetching those not yet cached
+    indexed = log_index.indexed_builds()
+    missing = [build_id for build_id in build_ids if build_id not in indexed]
+    if missing:
+        click.echo('- Indexing logs of {} builds'.format(len(missing)), err=True)
+    to_fetch = []
+    for build_id in missing:
+        if log_cache.has_log(build_id) and log_cache.has_flows(build_id):
+            logs = [('', log_cache.read_log(build_id))]
+            logs.extend((flow, log_cache.read_log(build_id, flow)) for flow in log_cache.get_flows(build_id))
+            log_index.add(build_id, logs)
+        else:
+            to_fetch.append(build_id)
+    for start in range(0, len(to_fetch), GREP_FILL_BATCH_SIZE):
+        batch = to_fetch[start:start + GREP_FILL_BATCH_SIZE]
+        pending = [api_client.spawn(fetch_build_logs, api_client, build_id) for build_id in batch]
+        for build_id, (log, flows) in zip(batch, api_client.gather(*pending)):
+            log_cache.put_log(build_id, log, prune=False)
+            log_cache.put_flows(build_id, flows, prune=False)
+            log_index.add(build_id, [('', log)] + flows)
+    if to_fetch:
+        log_cache.prune()
+    # Drop builds the cache has evicted so the index stays within its limit
+    log_index.prune(log_cache.cached_builds() | set(build_ids))
+
+    grep_fmt = '{build:<6} {flow:20.20} {line:<6} {text}'
+    headers = {
+        'build': 'Build',
+        'flow': 'Flow',
+        'line': 'Line',
+        'text': 'Text',
+    }
+    with OutputWriter(output_format, grep_fmt, headers) as writer:
+        for build_id, flow, line_number, line in log_index.search(text, set(build_ids)):
+            writer.write_record({
+                'build': build_id,
+                'flow': flow,
+                'line': line_number,
+                'text': line,
+            })
+
+@click.command(name='stats', help='Shows success rates, duration percentiles and queue waits of finished builds grouped by plan, branch, repo, day or week.  Durations and waits are in seconds.')
+@click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
+@click.option('--plan', 'plan_id', type=int, help="Only include builds of the plan with this id")
+@click.option('--group-by', 'group_by', type=click.Choice(list(GROUP_BY)), multiple=True, help="Group by these fields.  Can be repeated, e.g. --group-by plan --group-by week for trends.  Defaults to plan")
+@click.option('--limit', type=int, default=1000, help="Include this many of the most recent builds.  Defaults to 1000")
+@click.option('--all', 'all_pages', is_flag=True, help="Include every matching build")
+@local_option
+@output_option
+@pass_config
+def build_stats(config, repo, plan_id, group_by, limit, all_pages, local, output_format):
+    api_client = None if local else ApiClient(config)
+    mirror = open_mirror(config) if local else None
+
+    params = {}
+    repo_data = lookup_repo(api_client, config, repo, no_output=output_format != 'table', mirror=mirror)
+    if repo_data:
+        params['repo'] = repo_data['id']
+    if plan_id:
+        params['plan'] = plan_id
+
+    if all_pages:
+        limit = None
+    if local:
+        filters = {'status': TERMINAL_STATUSES}
+        for key in ('repo', 'plan'):
+            if key in params:
+                filters[key + '_id'] = params[key]
+        builds = mirror.query('builds', filters, limit)
+    else:
+        builds = api_client.iter_results('builds', 'list', params=params, omit=['log'])
+
+    # Builds are reduced to columns as they stream in, so memory stays small
+    # however many builds are included
+    columns = BuildColumns(group_key(group_by or ['plan']))
+    for build_res in builds:
+        if columns.add(build_res) and limit is not None and len(columns) >= limit:
+            break
+
+    stats_fmt = '{group:40.40} {builds!s:>6} {success_rate!s:>6} {duration_p50!s:>8} {duration_p90!s:>8} {duration_p99!s:>8} {queue_wait_p50!s:>8} {queue_wait_p90!s:>8}'
+    headers = {
+        'group': ' / '.join(field.capitalize() for field in group_by or ['plan']),
+        'builds': 'Builds',
+        'success_rate': 'Pass %',
+        'duration_p50': 'p50',
+        'duration_p90': 'p90',
+        'duration_p99': 'p99',
+        'queue_wait_p50': 'Wait p50',
+        'queue_wait_p90': 'Wait p90',
+    }
+    with OutputWriter(output_format, stats_fmt, headers) as writer:
+        writer.write_records(columns.aggregate())
+
 build.add_command(build_browser)
+build.add_command(build_grep)
 build.add_command(build_info)
 build.add_command(build_list)
-main.add_command(build)
+build.add_command(build_stats)
+build.add_command(build_tail)
+build.add_command(build_wait)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""cache command subgroup for metaci CLI"""
+
+import click
+from metaci_cli.cli.util import check_current_site
+from metaci_cli.cli.config import pass_config
+from metaci_cli.cache import ResolutionIndex
+from metaci_cli.cache import SchemaCache
+from metaci_cli.log_cache import LogCache
+from metaci_cli.log_index import LogIndex
+
+@click.group('cache', short_help='Manage locally cached build logs')
+def cache():
+    pass
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f} GB'.format(size)
+
+@click.command(name='info', help='Shows the size of the local build log cache for the current site')
+@pass_config
+def cache_info(config):
+    service = check_current_site(config)
+    log_cache = LogCache(service.url)
+    entries = log_cache.entries()
+    click.echo('Site: {}'.format(service.url))
+    click.echo('Location: {}'.format(log_cache.path))
+    click.echo('Files: {}'.format(len(entries)))
+    click.echo('Size: {} of {} max'.format(
+        format_size(sum(size for path, size, mtime in entries)),
+        format_size(log_cache.max_size),
+    ))
+
+@click.command(name='prune', help='Evicts least recently used build logs until the cache fits its size limit')
+@click.option('--max-size', type=int, help="Prune to this many megabytes instead of METACI_LOG_CACHE_MAX_MB")
+@pass_config
+def cache_prune(config, max_size):
+    service = check_current_site(config)
+    log_cache = LogCache(service.url)
+    if max_size is not None:
+        max_size = max_size * 1024 * 1024
+    removed = log_cache.prune(max_size)
+    LogIndex(service.url).prune(log_cache.cached_builds())
+    click.echo('Removed {} files, {} remaining'.format(removed, format_size(log_cache.size())))
+
+@click.command(name='clear', help='Deletes cached build logs and their search index for the current site')
+@click.option('--all', 'clear_all', is_flag=True, help="Also delete the cached API schema and name lookups for the site.  The build mirror and org and service sync state are kept.")
+@pass_config
+def cache_clear(config, clear_all):
+    service = check_current_site(config)
+    removed = LogCache(service.url).clear()
+    LogIndex(service.url).clear()
+    click.echo('Removed {} cached log files for {}'.format(removed, service.url))
+    if clear_all:
+        SchemaCache(service.url).clear()
+        ResolutionIndex(service.url).invalidate()
+        click.echo('Cleared the cached API schema and name lookups for {}'.format(service.url))
+
+cache.add_command(cache_info)
+cache.add_command(cache_prune)
+cache.add_command(cache_clear)
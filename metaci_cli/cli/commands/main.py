@@ -3,8 +3,8 @@
 """metaci: The command line interface to MetaCI"""
 
 import click
+import importlib
 import metaci_cli
-import requests
 #from metaci_cli.cli.config import check_latest_version
 
 # Check for latest version and notify user how to upgrade if new version exists
@@ -14,11 +14,68 @@ import requests
 #    click.echo('Error checking cci version:')
 #    click.echo(e.message)
 
-@click.group()
-def main():
+class LazyGroup(click.Group):
+    """ A click group whose subcommands are only imported when invoked so
+    metaci --help and simple commands don't pay for every command's imports.
+
+    lazy_commands maps a command name to a tuple of
+    ('module.path:attribute', 'short help shown in the command list').  The
+    short help must match the command's own short_help, which
+    tests/test_startup.py checks. """
+
+    def __init__(self, *args, **kwargs):
+        self.lazy_commands = kwargs.pop('lazy_commands', {})
+        super(LazyGroup, self).__init__(*args, **kwargs)
+
+    def list_commands(self, ctx):
+        commands = set(super(LazyGroup, self).list_commands(ctx))
+        return sorted(commands.union(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        command = super(LazyGroup, self).get_command(ctx, name)
+        if command is None and name in self.lazy_commands:
+            module_name, attr = self.lazy_commands[name][0].split(':')
+            command = getattr(importlib.import_module(module_name), attr)
+            self.add_command(command, name)
+        return command
+
+    def format_commands(self, ctx, formatter):
+        # List lazy commands by their registered help rather than importing them
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.commands:
+                command = self.commands[name]
+                if getattr(command, 'hidden', False):
+                    continue
+                rows.append((name, command.short_help or ''))
+            else:
+                rows.append((name, self.lazy_commands[name][1]))
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+@click.group(cls=LazyGroup, lazy_commands={
+    'agent': ('metaci_cli.cli.commands.agent:agent', 'Manage the background agent used by metaci-client'),
+    'apply': ('metaci_cli.cli.commands.apply:apply', 'Create the repos, orgs, services and plans in a YAML spec'),
+    'batch': ('metaci_cli.cli.commands.batch:batch', 'Run many metaci commands from a file in one process'),
+    'build': ('metaci_cli.cli.commands.build:build', 'List, inspect and follow builds'),
+    'cache': ('metaci_cli.cli.commands.cache:cache', 'Manage locally cached build logs'),
+    'mirror': ('metaci_cli.cli.commands.mirror:mirror', 'Keep a local copy of the site for fast queries'),
+    'org': ('metaci_cli.cli.commands.org:org', 'Manage MetaCI orgs'),
+    'plan': ('metaci_cli.cli.commands.plan:plan', 'Manage and run build plans'),
+    'repo': ('metaci_cli.cli.commands.repo:repo', 'Manage MetaCI repositories'),
+    'service': ('metaci_cli.cli.commands.service:service', 'Manage MetaCI services'),
+    'site': ('metaci_cli.cli.commands.site:site', 'Deploy, connect to and shape MetaCI sites'),
+})
+@click.pass_context
+def main(ctx):
     """Console script for metaci_cli."""
-    click.echo("MetaCI CLI v{}".format(metaci_cli.__version__))
-    click.echo()
+    # Commands run in-process by metaci batch leave the banner out
+    if ctx.obj and not ctx.obj.get('banner', True):
+        return
+    # The banner goes to stderr so --format json and friends can be piped
+    click.echo("MetaCI CLI v{}".format(metaci_cli.__version__), err=True)
+    click.echo(err=True)
 
 if __name__ == "__main__":
     main()
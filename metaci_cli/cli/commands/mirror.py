@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""mirror command subgroup for metaci CLI"""
+
+import click
+import datetime
+import time
+from metaci_cli.cli.util import check_current_site
+from metaci_cli.cli.config import pass_config
+from metaci_cli.metaci_api import ApiClient
+from metaci_cli.mirror import Mirror
+from metaci_cli.mirror import TABLES
+
+@click.group('mirror', short_help='Keep a local copy of the site for fast queries', help='Keep a local copy of the current site for fast queries with --local')
+def mirror():
+    pass
+
+@click.command(name='sync', help='Fetches records created or changed since the last sync into the local mirror')
+@click.option('--full', is_flag=True, help="Fetch every record instead of only those changed since the last sync")
+@pass_config
+def mirror_sync(config, full):
+    api_client = ApiClient(config)
+    site_mirror = Mirror(api_client.service.url)
+    start = time.time()
+    stats = site_mirror.sync(api_client, full=full)
+    for table, count in stats.items():
+        click.echo('{:12} {} fetched'.format(table, count))
+    click.echo(click.style('Synced in {:.1f}s'.format(time.time() - start), fg='green'))
+
+@click.command(name='info', help='Shows the record counts and last sync time of the local mirror')
+@pass_config
+def mirror_info(config):
+    service = check_current_site(config)
+    site_mirror = Mirror(service.url)
+    synced = site_mirror.last_synced()
+    click.echo('Site: {}'.format(service.url))
+    click.echo('Location: {}'.format(site_mirror.path))
+    click.echo('Last sync: {}'.format(
+        datetime.datetime.fromtimestamp(synced).strftime('%Y-%m-%d %H:%M:%S') if synced else 'never'
+    ))
+    for table in TABLES:
+        click.echo('{:12} {}'.format(table, site_mirror.count(table)))
+
+mirror.add_command(mirror_sync)
+mirror.add_command(mirror_info)
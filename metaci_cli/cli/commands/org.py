@@ -5,18 +5,26 @@
 import click
 import coreapi
 import json
-import webbrowser
-from cumulusci.core.config import ScratchOrgConfig
 from cumulusci.core.exceptions import OrgNotFound
-from metaci_cli.cli.commands.main import main
+from metaci_cli.cache import SyncHashes
 from metaci_cli.cli.util import check_current_site
+from metaci_cli.cli.util import iter_list
+from metaci_cli.cli.util import iter_local
+from metaci_cli.cli.util import local_option
+from metaci_cli.cli.util import lookup_org
 from metaci_cli.cli.util import lookup_repo
-from metaci_cli.cli.util import render_recursive
+from metaci_cli.cli.util import open_mirror
+from metaci_cli.cli.util import pagination_options
 from metaci_cli.cli.util import require_project_config
+from metaci_cli.cli.util import sync_action
+from metaci_cli.cli.util import sync_records
 from metaci_cli.cli.config import pass_config
+from metaci_cli.cli.output import OutputWriter
+from metaci_cli.cli.output import echo_record
+from metaci_cli.cli.output import output_option
 from metaci_cli.metaci_api import ApiClient
 
-@click.group('org')
+@click.group('org', short_help='Manage MetaCI orgs')
 def org():
     pass
 
@@ -40,23 +48,39 @@ def prompt_org_name(repo_id, name, api_client, retry=None):
             return prompt_org_name(repo_id, name, api_client, retry=False)
     return name
 
+def org_config_params(org_config):
+    """ returns the scratch and json params describing a cci keychain org.
+    Scratch orgs only send their definition since MetaCI creates its own """
+    from cumulusci.core.config import ScratchOrgConfig
+    scratch = isinstance(org_config, ScratchOrgConfig)
+    if scratch:
+        clean_org_config = {
+            'config_file': org_config.config_file,
+            'config_name': org_config.config_name,
+            'namespaced': org_config.namespaced,
+            'scratch': org_config.scratch,
+        }
+    else:
+        clean_org_config = org_config.config
+    return {
+        'scratch': scratch,
+        'json': json.dumps(clean_org_config, sort_keys=True),
+    }
+
 @click.command(name='browser', help='Opens the org on the MetaCI site in a browser tab')
 @click.argument('org_name')
 @pass_config
 def org_browser(config, org_name):
+    import webbrowser
     api_client = ApiClient(config)
 
-    params = {
-        'name': org_name,
-    }
-
-    # Look up the build
-    res = api_client('orgs', 'list', params=params)
-    if res['count'] == 0:
+    # Look up the org
+    org_data = lookup_org(api_client, org_name)
+    if org_data is None:
         raise click.ClickException('Org named {} not found.  Use metaci org list to see a list of available org names'.format(org_name))
 
     service = check_current_site(config)
-    url = '{}/orgs/{}'.format(service.url, res['results'][0]['id'])
+    url = '{}/orgs/{}'.format(service.url, org_data['id'])
     click.echo('Opening browser to {}'.format(url))
     webbrowser.open(url)
 
@@ -96,21 +120,11 @@ def org_add(config, name, org, repo):
 
     params['repo_id'] = repo_data['id']
     params['name'] = name
-    params['scratch'] = isinstance(org_config, ScratchOrgConfig)
-    
-    if params['scratch']: 
-        clean_org_config = {
-            'config_file': org_config.config_file,
-            'config_name': org_config.config_name,
-            'namespaced': org_config.namespaced,
-            'scratch': org_config.scratch,
-        }
-    else:
-        clean_org_config = org_config.config
-
-    params['json'] = json.dumps(clean_org_config)
+    params.update(org_config_params(org_config))
 
     res = api_client('orgs', 'create', params=params)
+    api_client.index.put('org', '{}:{}'.format(repo_data['id'], name), res)
+    api_client.index.invalidate('org', '*:{}'.format(name))
     click.echo()
     click.echo('Org {} was successfully created.  Use metaci org info {} to see the org details.'.format(name, name))
 
@@ -118,8 +132,9 @@ def org_add(config, name, org, repo):
 @click.command(name='info', help='Show info on a single org')
 @click.argument('name')
 @click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
+@output_option
 @pass_config
-def org_info(config, name, repo):
+def org_info(config, name, repo, output_format):
     api_client = ApiClient(config)
 
     params = {
@@ -135,23 +150,31 @@ def org_info(config, name, repo):
     if res['count'] == 0:
         raise click.ClickError('Org named {} not found'.format(name))
 
-    click.echo(render_recursive(res['results'][0]))
+    echo_record(res['results'][0], output_format)
    
  
 @click.command(name='list', help='Lists orgs')
 @click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
+@pagination_options
+@local_option
+@output_option
 @pass_config
-def org_list(config, repo):
-    api_client = ApiClient(config)
+def org_list(config, repo, limit, all_pages, local, output_format):
+    api_client = None if local else ApiClient(config)
+    mirror = open_mirror(config) if local else None
 
     params = {}
 
     # Filter by repository
-    repo_data = lookup_repo(api_client, config, repo)
+    repo_data = lookup_repo(api_client, config, repo, no_output=output_format != 'table', mirror=mirror)
     if repo_data:
         params['repo'] = repo_data['id']
 
-    res = api_client('orgs', 'list', params=params)
+    if local:
+        filters = {'repo_id': repo_data['id']} if repo_data else None
+        orgs = iter_local(mirror, 'orgs', filters, limit, all_pages)
+    else:
+        orgs = iter_list(api_client, 'orgs', params, limit, all_pages)
 
     org_list_fmt = '{id:<5} {name:24.24} {scratch:7} {repo[owner]}'
     headers = {
@@ -160,14 +183,60 @@ def org_list(config, repo):
         'scratch': 'Scratch',
         'repo': {'owner': 'Repo'},
     }
-    click.echo(org_list_fmt.format(**headers))
     #org_list_fmt += "/{repo[name]}"
-    for org in res['results']:
-        click.echo(org_list_fmt.format(**org))
+    with OutputWriter(output_format, org_list_fmt, headers) as writer:
+        writer.write_records(orgs)
+
+@click.command(name='sync', help='Creates or updates MetaCI orgs for every org in the local cci keychain.  Orgs already on the site are compared with it the first time they are synced from here, then only pushed when their local config changes.')
+@click.option('--org', 'org_names', multiple=True, help="Only sync this cci keychain org.  Can be repeated")
+@click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
+@click.option('--force', is_flag=True, help="Push every org that exists on the site, changed or not")
+@click.option('--dry-run', is_flag=True, help="Print what would be created or updated without changing anything")
+@output_option
+@pass_config
+def org_sync(config, org_names, repo, force, dry_run, output_format):
+    require_project_config(config)
+
+    api_client = ApiClient(config)
+    repo_data = lookup_repo(api_client, config, repo, required=True)
 
+    names = config.keychain.list_orgs()
+    if org_names:
+        missing = set(org_names) - set(names)
+        if missing:
+            raise click.ClickException('The org(s) {} are not configured in the local cci keychain'.format(', '.join(sorted(missing))))
+        names = [name for name in names if name in org_names]
+
+    # One list call for the repo's orgs rather than a lookup per org
+    existing = dict(
+        (org_data['name'], org_data)
+        for org_data in api_client.iter_results('orgs', 'list', params={'repo': repo_data['id']})
+    )
+
+    # Only configs whose hash differs from the one last pushed are sent
+    hashes = SyncHashes(api_client.service.url, 'orgs')
+    changes = []
+    for name in names:
+        params = org_config_params(config.keychain.get_org(name))
+        key = '{}:{}'.format(repo_data['id'], name)
+        org_data = existing.get(name)
+        changes.append({
+            'name': name,
+            'key': key,
+            'action': sync_action(hashes, key, org_data, params, force),
+            'record': org_data,
+            'params': params,
+            'push_params': params if org_data else dict(params, repo_id=repo_data['id'], name=name),
+        })
+
+    def index_org(change, org_data):
+        api_client.index.put('org', change['key'], org_data)
+        api_client.index.invalidate('org', '*:{}'.format(change['name']))
+
+    sync_records(api_client, 'orgs', changes, hashes, dry_run, output_format, index_org)
 
 org.add_command(org_browser)
 org.add_command(org_add)
 org.add_command(org_info)
 org.add_command(org_list)
-main.add_command(org)
+org.add_command(org_sync)
@@ -4,29 +4,142 @@
 
 import click
 import coreapi
-import webbrowser
-from metaci_cli.cli.commands.main import main
+import fnmatch
+import os
+import time
+from collections import OrderedDict
 from metaci_cli.cli.util import check_current_site
+from metaci_cli.cli.util import fetch_first
 from metaci_cli.cli.util import get_or_create_branch
+from metaci_cli.cli.util import iter_list
+from metaci_cli.cli.util import iter_local
+from metaci_cli.cli.util import local_option
+from metaci_cli.cli.util import lookup_org
 from metaci_cli.cli.util import lookup_repo
-from metaci_cli.cli.util import render_recursive
+from metaci_cli.cli.util import open_mirror
+from metaci_cli.cli.util import pagination_options
+from metaci_cli.cli.util import push_record
 from metaci_cli.cli.config import pass_config
+from metaci_cli.cli.output import OutputWriter
+from metaci_cli.cli.output import echo_record
+from metaci_cli.cli.output import output_option
+from metaci_cli.cli.output import render_recursive
+from metaci_cli import git
 from metaci_cli.metaci_api import ApiClient
 
-def get_plan(api_client, plan_id):
-    """ Workaround for a bug in plans read which causes failure when looking up by plan id """
+def get_plan(api_client, plan_id, fresh=False):
+    """ Workaround for a bug in plans read which causes failure when looking up by plan id.
+    Pass fresh=True to read the whole plan rather than the indexed fields """
     params = {
         'id': plan_id
     }
 
     # Look up the plan
-    res = api_client('plans', 'list', params=params)
-    if res['count'] == 0:
+    if fresh:
+        plan = fetch_first(api_client, 'plans', params)
+    else:
+        plan = api_client.index.resolve('plan', str(plan_id), lambda: fetch_first(api_client, 'plans', params))
+    if plan is None:
         raise click.ClickException('Plan with id {} not found. Use metaci plan list to see a list of plans and their ids'.format(plan_id))
 
-    return res['results'][0]
+    return plan
+
+def get_plans(api_client, plan_ids, fresh=False):
+    """ Looks up many plans with bounded concurrent requests instead of one
+    request after another.  Returns a dict of plan id to plan """
+    plan_ids = list(set(plan_ids))
+    pending = [api_client.spawn(get_plan, api_client, plan_id, fresh) for plan_id in plan_ids]
+    return dict(zip(plan_ids, api_client.gather(*pending)))
+
+def is_glob(branch):
+    return any(char in branch for char in '*?[')
+
+def expand_branches(patterns, heads):
+    """ Returns an OrderedDict of branch name to commit sha for each branch
+    name or glob pattern, given a dict of every branch name to its HEAD """
+    commits = OrderedDict()
+    for pattern in patterns:
+        if is_glob(pattern):
+            matches = sorted(fnmatch.filter(heads, pattern))
+            if not matches:
+                raise click.ClickException('No branches match {}'.format(pattern))
+        elif pattern in heads:
+            matches = [pattern]
+        else:
+            raise click.ClickException('Branch {} not found in the Github repository'.format(pattern))
+        for branch in matches:
+            commits[branch] = heads[branch]
+    return commits
+
+def get_local_commits(config, patterns, ls_remote=False, warnings=None):
+    """ Returns an OrderedDict of branch name to HEAD commit sha from the local
+    git repository, or None if any branch can't be resolved locally.  Uses the
+    remote-tracking refs unless ls_remote is set, in which case the remote is
+    asked directly with git ls-remote.  Glob patterns always use ls-remote
+    since remote-tracking refs of deleted branches linger until a git fetch
+    --prune and would be matched.  Warnings are appended to warnings if
+    given, for callers running this in the background, or echoed otherwise. """
+    if any(is_glob(pattern) for pattern in patterns):
+        ls_remote = True
+    try:
+        repo_root = config.project_config.repo_root
+        if not repo_root:
+            return None
+        remote = git.find_remote(
+            repo_root,
+            config.project_config.repo_owner,
+            config.project_config.repo_name,
+        )
+        if ls_remote:
+            heads = git.ls_remote_heads(repo_root, remote)
+        else:
+            heads = git.remote_heads(repo_root, remote)
+            fetched = git.last_fetched(repo_root)
+    except git.GitError:
+        return None
 
-@click.group('plan')
+    try:
+        commits = expand_branches(patterns, heads)
+    except click.ClickException:
+        return None
+
+    if not ls_remote:
+        stale_after = int(os.environ.get('METACI_GIT_STALE_AFTER', 600))
+        if fetched is None or time.time() - fetched > stale_after:
+            if fetched is None:
+                age = 'have never been fetched'
+            else:
+                age = 'were last fetched {} minutes ago'.format(int((time.time() - fetched) / 60))
+            warning = '- Using commits from the local {} remote-tracking branches, which {}.  Run git fetch or use --ls-remote if a branch may have changed since.'.format(remote, age)
+            if warnings is None:
+                click.echo(click.style(warning, fg='yellow'), err=True)
+            else:
+                warnings.append(warning)
+    return commits
+
+def get_github_commits(config, patterns):
+    """ Returns an OrderedDict of branch name to HEAD commit sha for branch
+    names or glob patterns using the Github API.  Several branches are looked
+    up with a single listing of the repository's branches. """
+    gh = config.project_config.get_github_api()
+    gh_repo = gh.repository(
+        config.project_config.repo_owner,
+        config.project_config.repo_name,
+    )
+    if len(patterns) == 1 and not is_glob(patterns[0]):
+        return OrderedDict([(patterns[0], gh_repo.branch(patterns[0]).commit.sha)])
+    heads = dict((branch.name, branch.commit.sha) for branch in gh_repo.branches())
+    return expand_branches(patterns, heads)
+
+def get_branch_commits(config, patterns, ls_remote=False, warnings=None):
+    """ Returns an OrderedDict of branch name to HEAD commit sha, resolved from
+    the local git repository when possible and the Github API otherwise """
+    commits = get_local_commits(config, patterns, ls_remote, warnings)
+    if commits is None:
+        commits = get_github_commits(config, patterns)
+    return commits
+
+@click.group('plan', short_help='Manage and run build plans')
 def plan():
     pass
 
@@ -49,6 +162,7 @@ def prompt_org(api_client, config, repo_id):
 @click.argument('plan_id')
 @pass_config
 def plan_browser(config, plan_id):
+    import webbrowser
     api_client = ApiClient(config)
 
     params = {
@@ -150,6 +264,7 @@ def plan_add(config):
     }
 
     res = api_client('plans', 'create', params=params)
+    api_client.index.put('plan', str(res['id']), res)
 
     click.echo()
     click.echo(
@@ -158,7 +273,7 @@ def plan_add(config):
             fg='green',
         )
     )
-    render_recursive(res)
+    click.echo(render_recursive(res))
 
     click.echo()
     click.echo('Adding repository {owner}/{name} to plan'.format(**repo_data))
@@ -171,19 +286,24 @@ def plan_add(config):
 
 @click.command(name='info', help='Show info for a plan')
 @click.argument('plan_id')
+@output_option
 @pass_config
-def plan_info(config, plan_id):
+def plan_info(config, plan_id, output_format):
     api_client = ApiClient(config)
-    plan = get_plan(api_client, plan_id)
-    click.echo(render_recursive(plan))
+    plan = get_plan(api_client, plan_id, fresh=True)
+    echo_record(plan, output_format)
 
 
 @click.command(name='list', help='Lists plans')
+@pagination_options
+@local_option
+@output_option
 @pass_config
-def plan_list(config):
-    api_client = ApiClient(config)
-
-    res = api_client('plans', 'list')
+def plan_list(config, limit, all_pages, local, output_format):
+    if local:
+        plans = iter_local(open_mirror(config), 'plans', None, limit, all_pages)
+    else:
+        plans = iter_list(ApiClient(config), 'plans', None, limit, all_pages)
 
     plan_list_fmt = '{id:<5} {name:24.24} {org:12.12} {flows:24.24} {type:7.7} {regex}'
     headers = {
@@ -194,9 +314,8 @@ def plan_list(config):
         'type': 'Trigger',
         'regex': 'Regex',
     }
-    click.echo(plan_list_fmt.format(**headers))
-    for plan in res['results']:
-        click.echo(plan_list_fmt.format(**plan))
+    with OutputWriter(output_format, plan_list_fmt, headers) as writer:
+        writer.write_records(plans)
 
 @click.command(name='repo_add', help='Add a repo to a plan')
 @click.argument('plan_id')
@@ -228,20 +347,22 @@ def plan_repo_add(config, plan_id, repo):
     res = api_client('plan_repos', 'create', params=params)
     click.echo()
     click.echo('Added repo {repo[owner]}/{repo[name]} to plan {plan[name]}'.format(**res))
-    render_recursive(res)
+    click.echo(render_recursive(res))
 
 @click.command(name='repo_list', help='List repos associated with a plan')
 @click.argument('plan_id')
+@pagination_options
+@output_option
 @pass_config
-def plan_repo_list(config, plan_id):
+def plan_repo_list(config, plan_id, limit, all_pages, output_format):
     api_client = ApiClient(config)
     plan = get_plan(api_client, plan_id)
     params = {
         'plan': plan_id,
     }
-    res = api_client('plan_repos', 'list', params=params)
-    click.echo()
-    click.echo('Repos associated with plan {}:')
+    if output_format == 'table':
+        click.echo()
+        click.echo('Repos associated with plan {}:'.format(plan['name']))
     repo_list_fmt = '{id:<5} {repo[id]:<6} {repo[name]:32.32} {repo[owner]}'
     headers = {
         'id': '#',
@@ -251,59 +372,122 @@ def plan_repo_list(config, plan_id):
             'owner': 'Owner',
         },
     }
-    click.echo(repo_list_fmt.format(**headers))
-    for plan_repo in res['results']:
-        click.echo(repo_list_fmt.format(**plan_repo))
-
-@click.command(name='run', help='Run a plan')
-@click.argument('plan_id')
-@click.option('--branch', help="Specify a branch other than the current local branch")
-@click.option('--commit', help="Specify a remote Github commit sha to build instead of the branch HEAD")
+    with OutputWriter(output_format, repo_list_fmt, headers) as writer:
+        writer.write_records(iter_list(api_client, 'plan_repos', params, limit, all_pages))
+
+def resolve_runs(api_client, config, plan_ids, commits):
+    """ Resolves the plan, repo, org and branch ids needed to create a build
+    of each plan on each branch.  commits is an OrderedDict of branch name to
+    commit sha, or a pending result from spawn() which returns one so the
+    commits can be resolved while the plans and repo are looked up.  Every
+    plan, org and branch is only looked up once however many builds use it,
+    and lookups run concurrently.  Returns the plans, commits and runs. """
+    pending_plans = [api_client.spawn(get_plan, api_client, plan_id) for plan_id in plan_ids]
+    pending_repo = api_client.spawn(lookup_repo, api_client, config, None, required=True)
+    if not isinstance(commits, dict):
+        commits = api_client.gather(commits)[0]
+    plans = dict(zip(plan_ids, api_client.gather(*pending_plans)))
+    repo_data = api_client.gather(pending_repo)[0]
+    branches = list(commits)
+
+    # The plan orgs and the branches both need the repo
+    org_names = sorted(set(plan_data['org'] for plan_data in plans.values()))
+    pending_orgs = [api_client.spawn(lookup_org, api_client, name, repo_data['id']) for name in org_names]
+    pending_branches = [api_client.spawn(get_or_create_branch, api_client, branch, repo_data['id']) for branch in branches]
+    orgs = dict(zip(org_names, api_client.gather(*pending_orgs)))
+    branch_ids = dict(zip(branches, [branch_data['id'] for branch_data in api_client.gather(*pending_branches)]))
+    for name, org_data in orgs.items():
+        if org_data is None:
+            raise click.ClickException('The plan org "{}" does not exist in MetaCI.  Use metaci org create to create the org.'.format(name))
+
+    runs = OrderedDict()
+    for plan_id in plan_ids:
+        for branch in branches:
+            runs[(plan_id, branch)] = {
+                'repo_id': repo_data['id'],
+                'org_id': orgs[plans[plan_id]['org']]['id'],
+                'plan_id': plan_id,
+                'branch_id': branch_ids[branch],
+                'commit': commits[branch],
+            }
+    return plans, commits, runs
+
+def create_build(api_client, build_params):
+    """ Creates a build and returns (build, None) or (None, error message) """
+    return push_record(api_client, 'builds', None, build_params)
+
+@click.command(name='run', help='Run one or more plans on one or more branches.  Every plan is run on every branch.')
+@click.argument('plan_ids', nargs=-1, required=True)
+@click.option('--branch', 'branches', multiple=True, help="Specify a branch other than the current local branch.  Can be repeated and can be a glob pattern like feature/* to run on every matching branch")
+@click.option('--commit', help="Specify a remote Github commit sha to build instead of the branch HEAD.  Only valid with a single branch")
+@click.option('--ls-remote', is_flag=True, help="Look up branch HEADs with git ls-remote instead of the local remote-tracking branches, which are only as current as the last git fetch.  Glob patterns always use git ls-remote")
 #@click.option('--keep-org', is_flag=True, help="If set, plans that generate scratch orgs will not delete the org.  This is useful for manual testing and debugging.  Use metaci build org_login <build_id> to log into the org once it is created.")
+@output_option
 @pass_config
-def plan_run(config, plan_id, branch, commit):
+def plan_run(config, plan_ids, branches, commit, ls_remote, output_format):
     api_client = ApiClient(config)
-    plan = get_plan(api_client, plan_id)
-    
-    # Look up the repo
-    repo_data = lookup_repo(api_client, config, None, required=True)
-
-    # Look up the plan org
-    org_params = {
-        'repo': repo_data['id'],
-        'name': plan['org'],
-    }
-    org_res = api_client('orgs', 'list', params=org_params)
-    if org_res['count'] == 0:
-        raise click.ClickException('The plan org "{}" does not exist in MetaCI.  Use metaci org create to create the org.'.format(plan['org']))
-    org_data = org_res['results'][0]
-
-    # Look up the branch
-    if not branch:
-        branch = config.project_config.repo_branch
-    branch_data = get_or_create_branch(api_client, branch, repo_data['id'])
-
-    # Determine the commit
-    if not commit:
-        gh = config.project_config.get_github_api()
-        gh_repo = gh.repository(
-            config.project_config.repo_owner,
-            config.project_config.repo_name,
-        )
-        branch = gh_repo.branch(branch)
-        commit = branch.commit.sha
-
-    # Create the build
-    build_params = {
-        'repo_id': repo_data['id'],
-        'org_id': org_data['id'],
-        'plan_id': plan_id,
-        'branch_id': branch_data['id'],
-        'commit': commit,
+    plan_ids = list(OrderedDict.fromkeys(plan_ids))
+    if not branches:
+        branches = [config.project_config.repo_branch]
+
+    # Determine the commits.  Resolving them can mean a git ls-remote or a
+    # Github API call, so it runs alongside the MetaCI lookups
+    warnings = []
+    if commit:
+        if len(branches) > 1 or is_glob(branches[0]):
+            raise click.UsageError('--commit can only be used with a single branch')
+        commits = OrderedDict([(branches[0], commit)])
+    else:
+        commits = api_client.spawn(get_branch_commits, config, list(branches), ls_remote, warnings)
+
+    plans, commits, runs = resolve_runs(api_client, config, plan_ids, commits)
+    for warning in warnings:
+        click.echo(click.style(warning, fg='yellow'), err=True)
+
+    # Create the builds on the shared API pool, which bounds the number of
+    # requests in flight by METACI_MAX_CONCURRENCY
+    def create_builds(keys):
+        pending = [api_client.spawn(create_build, api_client, runs[key]) for key in keys]
+        return dict(zip(keys, api_client.gather(*pending)))
+
+    results = create_builds(list(runs))
+    failed = [key for key, (resp, error) in results.items() if resp is None]
+    if failed:
+        # Ids from the local resolution index may be stale, so resolve them
+        # against the server once more before giving up
+        for kind in ('plan', 'repo', 'org', 'branch'):
+            api_client.index.invalidate(kind)
+        plans, commits, retry_runs = resolve_runs(api_client, config, plan_ids, commits)
+        for key in failed:
+            runs[key].update(retry_runs[key])
+        results.update(create_builds(failed))
+
+    run_fmt = '{build!s:<7} {plan:<5} {plan_name:24.24} {branch:32.32} {commit:10.10} {status}'
+    headers = {
+        'build': 'Build',
+        'plan': 'Plan',
+        'plan_name': 'Name',
+        'branch': 'Branch',
+        'commit': 'Commit',
+        'status': 'Status',
     }
-    resp = api_client('builds', 'create', params=build_params)
-    click.echo(click.style('Build {} created successfully'.format(resp['id']), bold=True, fg='green'))
-    click.echo('Use metaci build info {} to monitor the build or metaci build list to monitor multiple builds'.format(resp['id']))
+    style = lambda row, line: click.style(line, fg='green' if row['build'] else 'red')
+    errors = 0
+    with OutputWriter(output_format, run_fmt, headers, style) as writer:
+        for (plan_id, branch), (resp, error) in results.items():
+            errors += resp is None
+            writer.write_record({
+                'build': resp['id'] if resp else None,
+                'plan': plan_id,
+                'plan_name': plans[plan_id]['name'],
+                'branch': branch,
+                'commit': runs[(plan_id, branch)]['commit'],
+                'status': 'created' if resp else error,
+            })
+    if errors:
+        raise click.ClickException('{} of {} builds could not be created'.format(errors, len(results)))
+    if output_format == 'table':
+        click.echo('Use metaci build info <id> to monitor a build, metaci build wait to wait for several builds or metaci build list to monitor multiple builds')
 
 
 plan.add_command(plan_add)
@@ -313,4 +497,3 @@ plan.add_command(plan_list)
 plan.add_command(plan_repo_add)
 plan.add_command(plan_repo_list)
 plan.add_command(plan_run)
-main.add_command(plan)
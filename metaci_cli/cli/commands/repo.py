@@ -5,17 +5,23 @@
 import click
 import coreapi
 import json
-import webbrowser
-from metaci_cli.cli.commands.main import main
 from metaci_cli.cli.util import check_current_site
+from metaci_cli.cli.util import iter_list
+from metaci_cli.cli.util import iter_local
+from metaci_cli.cli.util import local_option
 from metaci_cli.cli.util import lookup_repo
-from metaci_cli.cli.util import render_recursive
+from metaci_cli.cli.util import open_mirror
+from metaci_cli.cli.util import pagination_options
 from metaci_cli.cli.util import require_project_config
 from metaci_cli.cli.config import pass_config
+from metaci_cli.cli.output import OutputWriter
+from metaci_cli.cli.output import echo_record
+from metaci_cli.cli.output import output_option
+from metaci_cli.cli.output import render_recursive
 from metaci_cli.metaci_api import ApiClient
-from metaci_cli.cli.commands.plan import get_plan
+from metaci_cli.cli.commands.plan import get_plans
 
-@click.group('repo')
+@click.group('repo', short_help='Manage MetaCI repositories')
 def repo():
     pass
 
@@ -38,6 +44,7 @@ def check_existing_repo(owner, name, api_client):
 @click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
 @pass_config
 def repo_browser(config, repo):
+    import webbrowser
     require_project_config(config)
     api_client = ApiClient(config)
     repo = lookup_repo(api_client, config, repo, required=True)
@@ -98,32 +105,39 @@ def repo_add(config, repo, url, public):
     }
 
     res = api_client('repos', 'create', params=params)
+    api_client.index.put('repo', '{}/{}'.format(owner, name), res)
     click.echo()
     click.echo('Repository {}/{} was successfully created with the following config'.format(owner, name))
-    render_recursive(res)
+    click.echo(render_recursive(res))
 
 
 @click.command(name='info', help='Show info on a single repo')
 @click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
+@output_option
 @pass_config
-def repo_info(config, repo):
+def repo_info(config, repo, output_format):
     api_client = ApiClient(config)
     # Look up repository
-    repo = lookup_repo(api_client, config, repo, required=True)
-    click.echo(render_recursive(repo))
+    repo = lookup_repo(api_client, config, repo, required=True, fresh=True)
+    echo_record(repo, output_format)
 
 
 @click.command(name='list', help='Lists repositories')
 @click.option('--owner', help="List all repositories with a given owner organization or username")
 @click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
+@pagination_options
+@local_option
+@output_option
 @pass_config
-def repo_list(config, owner, repo):
-    api_client = ApiClient(config)
-
+def repo_list(config, owner, repo, limit, all_pages, local, output_format):
     params = {}
     if owner:
         params['owner'] = owner
-    res = api_client('repos', 'list', params=params)
+
+    if local:
+        repos = iter_local(open_mirror(config), 'repos', params, limit, all_pages)
+    else:
+        repos = iter_list(ApiClient(config), 'repos', params, limit, all_pages)
 
     repo_list_fmt = '{id:<3} {owner:20.20} {name:20.20} {public:7} {url}'
     headers = {
@@ -133,21 +147,22 @@ def repo_list(config, owner, repo):
         'public': 'Public?',
         'url': 'Repo URL',
     }
-    click.echo(repo_list_fmt.format(**headers))
-    for repo in res['results']:
-        click.echo(repo_list_fmt.format(**repo))
+    with OutputWriter(output_format, repo_list_fmt, headers) as writer:
+        writer.write_records(repos)
 
 @click.command(name='plans', help='Lists plans connected to this repository')
 @click.option('--repo', help="Specify the repo in format OwnerName/RepoName")
+@output_option
 @pass_config
-def repo_plans(config, repo):
+def repo_plans(config, repo, output_format):
     api_client = ApiClient(config)
 
     params = {}
     repo = lookup_repo(api_client, config, repo, required=True)
     params['repo'] = repo['id']
-    
-    res = api_client('plan_repos', 'list', params=params)
+
+    plan_repos = list(api_client.iter_results('plan_repos', 'list', params=params))
+    plans = get_plans(api_client, [plan_repo['plan']['id'] for plan_repo in plan_repos], fresh=True)
 
     plan_list_fmt = '{id:<5} {name:24.24} {org:12.12} {flows:24.24} {type:7.7} {regex}'
     headers = {
@@ -158,14 +173,12 @@ def repo_plans(config, repo):
         'type': 'Trigger',
         'regex': 'Regex',
     }
-    click.echo(plan_list_fmt.format(**headers))
-    for plan_repo in res['results']:
-        plan = get_plan(api_client, plan_repo['plan']['id'])
-        click.echo(plan_list_fmt.format(**plan))
+    with OutputWriter(output_format, plan_list_fmt, headers) as writer:
+        for plan_repo in plan_repos:
+            writer.write_record(plans[plan_repo['plan']['id']])
 
 repo.add_command(repo_browser)
 repo.add_command(repo_add)
 repo.add_command(repo_info)
 repo.add_command(repo_list)
 repo.add_command(repo_plans)
-main.add_command(repo)
@@ -5,18 +5,25 @@
 import click
 import coreapi
 import json
-import webbrowser
 from cumulusci.core.exceptions import ServiceNotConfigured
 from cumulusci.core.exceptions import ServiceNotValid
-from metaci_cli.cli.commands.main import main
+from metaci_cli.cache import SyncHashes
 from metaci_cli.cli.util import check_current_site
+from metaci_cli.cli.util import iter_list
 from metaci_cli.cli.util import lookup_repo
-from metaci_cli.cli.util import render_recursive
+from metaci_cli.cli.util import lookup_service
+from metaci_cli.cli.util import pagination_options
 from metaci_cli.cli.util import require_project_config
+from metaci_cli.cli.util import sync_action
+from metaci_cli.cli.util import sync_records
 from metaci_cli.cli.config import pass_config
+from metaci_cli.cli.output import OutputWriter
+from metaci_cli.cli.output import echo_record
+from metaci_cli.cli.output import output_option
 from metaci_cli.metaci_api import ApiClient
+from metaci_cli.site_spec import CLI_ONLY_SERVICES
 
-@click.group('service')
+@click.group('service', short_help='Manage MetaCI services')
 def service():
     pass
 
@@ -38,22 +45,25 @@ def prompt_service_name(name, api_client):
 @click.argument('name')
 @pass_config
 def service_browser(config, name):
+    import webbrowser
     api_client = ApiClient(config)
 
-    params = {
-        'name': name,
-    }
-
-    # Look up the build
-    res = api_client('services', 'list', params=params)
-    if res['count'] == 0:
+    # Look up the service
+    service_data = lookup_service(api_client, name)
+    if service_data is None:
         raise click.ClickException('Service named {} not found.  Use metaci service list to see a list of available service names'.format(name))
 
     metaci_service = check_current_site(config)
-    url = '{}/admin/cumulusci/service/{}'.format(metaci_service.url, res['results'][0]['id'])
+    url = '{}/admin/cumulusci/service/{}'.format(metaci_service.url, service_data['id'])
     click.echo('Opening browser to {}'.format(url))
     webbrowser.open(url)
 
+def service_config_params(service_config):
+    """ returns the json param describing a cci keychain service """
+    return {
+        'json': json.dumps(service_config.config, sort_keys=True),
+    }
+
 @click.command(name='add', help='Create a MetaCI service from a local cci keychain service')
 @click.option('--name', help="Specify the service name from your local cci keychain to create in MetaCI")
 @pass_config
@@ -93,50 +103,102 @@ def service_add(config, name):
 
     params = {}
     params['name'] = name
-    params['json'] = json.dumps(service_config.config)
+    params.update(service_config_params(service_config))
     res = api_client('services', 'create', params=params)
+    api_client.index.put('service', name, res)
     click.echo()
     click.echo('Service {} was successfully created.  Use metaci service info {} to see the service details.'.format(name, name))
 
 
 @click.command(name='info', help='Show info on a service')
 @click.argument('name')
+@output_option
 @pass_config
-def service_info(config, name):
+def service_info(config, name, output_format):
     api_client = ApiClient(config)
 
-    params = {
-        'name': name
-    }
-
     # Look up the service
-    res = api_client('services', 'list', params=params)
-    if res['count'] == 0:
-        raise click.ClickError('Service named {} not found'.format(name))
+    service_data = lookup_service(api_client, name, fresh=True)
+    if service_data is None:
+        raise click.ClickException('Service named {} not found'.format(name))
 
-    click.echo(render_recursive(res['results'][0]))
+    echo_record(service_data, output_format)
    
  
 @click.command(name='list', help='Lists services')
+@pagination_options
+@output_option
 @pass_config
-def service_list(config):
+def service_list(config, limit, all_pages, output_format):
     api_client = ApiClient(config)
 
     params = {}
-    res = api_client('services', 'list', params=params)
 
     service_list_fmt = '{id:<3} {name}'
     headers = {
         'id': '#',
         'name': 'Name',
     }
-    click.echo(service_list_fmt.format(**headers))
-    for service in res['results']:
-        click.echo(service_list_fmt.format(**service))
+    with OutputWriter(output_format, service_list_fmt, headers) as writer:
+        writer.write_records(iter_list(api_client, 'services', params, limit, all_pages))
+
+
+@click.command(name='sync', help='Creates or updates MetaCI services for the services in the local cci keychain.  The metaci service, which holds the site credentials of this CLI, is never synced.  Services already on the site are compared with it the first time they are synced from here, then only pushed when their local config changes.')
+@click.option('--service', 'service_names', multiple=True, help="Only sync this cci keychain service.  Can be repeated")
+@click.option('--exclude', multiple=True, help="Don't sync this cci keychain service.  Can be repeated")
+@click.option('--force', is_flag=True, help="Push every service that exists on the site, changed or not")
+@click.option('--dry-run', is_flag=True, help="Print what would be created or updated without changing anything")
+@output_option
+@pass_config
+def service_sync(config, service_names, exclude, force, dry_run, output_format):
+    require_project_config(config)
 
+    excluded = set(CLI_ONLY_SERVICES).union(exclude)
+    names = config.keychain.list_services()
+    if service_names:
+        not_synced = excluded.intersection(service_names)
+        if not_synced:
+            raise click.UsageError('The service(s) {} can not be synced'.format(', '.join(sorted(not_synced))))
+        missing = set(service_names) - set(names)
+        if missing:
+            raise click.ClickException('The service(s) {} are not configured in the local cci keychain'.format(', '.join(sorted(missing))))
+        names = [name for name in names if name in service_names]
+    names = [name for name in names if name not in excluded]
+
+    api_client = ApiClient(config)
+    existing = dict(
+        (service_data['name'], service_data)
+        for service_data in api_client.iter_results('services', 'list')
+    )
+
+    # Only configs whose hash differs from the one last pushed are sent
+    hashes = SyncHashes(api_client.service.url, 'services')
+    changes = []
+    for name in names:
+        service_data = existing.get(name)
+        try:
+            params = service_config_params(config.keychain.get_service(name))
+        except (ServiceNotConfigured, ServiceNotValid):
+            action = 'not configured locally'
+            params = None
+        else:
+            action = sync_action(hashes, name, service_data, params, force)
+        changes.append({
+            'name': name,
+            'key': name,
+            'action': action,
+            'record': service_data,
+            'params': params,
+            'push_params': params if service_data else dict(params or {}, name=name),
+        })
+
+    def index_service(change, service_data):
+        api_client.index.put('service', change['name'], service_data)
+
+    sync_records(api_client, 'services', changes, hashes, dry_run, output_format, index_service)
 
 service.add_command(service_browser)
 service.add_command(service_add)
 service.add_command(service_info)
 service.add_command(service_list)
-main.add_command(service)
+service.add_command(service_sync)
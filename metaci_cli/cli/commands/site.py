@@ -3,19 +3,29 @@
 """Console script for metaci_cli."""
 
 import click
-import heroku3
+import datetime
 import json
 import os
 import requests
 import subprocess
 import time
-import webbrowser
-from cumulusci.core.config import ServiceConfig
 from cumulusci.core.exceptions import ServiceNotConfigured
-from metaci_cli.cli.commands.main import main
+from metaci_cli.autoscale import ScalingPolicy
+from metaci_cli.autoscale import read_trace
+from metaci_cli.autoscale import simulate
+from metaci_cli.autoscale import trace_sample
+from metaci_cli.cli.heroku import current_formation
+from metaci_cli.cli.heroku import diff_formation
+from metaci_cli.cli.heroku import echo_log_stream
+from metaci_cli.cli.heroku import poll
+from metaci_cli.cli.heroku import update_formation
+from metaci_cli.cli.heroku import wait_for_formation
 from metaci_cli.cli.util import check_current_site
-from metaci_cli.cli.util import render_recursive
 from metaci_cli.cli.config import pass_config
+from metaci_cli.cli.output import OutputWriter
+from metaci_cli.cli.output import output_option
+from metaci_cli.cli.output import render_recursive
+from metaci_cli.transport import build_session
 
 app_shape_choice = click.Choice(['dev','staging','prod'])
 
@@ -29,7 +39,7 @@ def prompt_app_shape(shape=None, num_workers=None):
         click.echo('Select the Heroku app shape you want to deploy.  Available options:')
         click.echo('  - dev: Runs on free Heroku resources with build concurrency of 1')
         click.echo('  - staging: Runs on paid Heroku resources with fixed build concurrency of X')
-        click.echo('  - prod: Runs on paid Heroku resources auto-scaled build concurrency via Hirefire.io (paid add on configured separately)')
+        click.echo('  - prod: Runs on paid Heroku resources with build concurrency auto-scaled by metaci site autoscale or Hirefire.io (paid add on configured separately)')
         app_shape = click.prompt('App Shape', type=app_shape_choice, default='dev')
 
     if app_shape == 'staging' and num_workers is None:
@@ -41,50 +51,58 @@ def prompt_app_shape(shape=None, num_workers=None):
 
     return app_shape, num_workers
 
-def set_app_shape(app, shape, num_workers=None):
+def shape_formation(shape, num_workers=None):
+    """ returns the formation of an app shape as a dict of process type to
+    (quantity, size) """
     if shape == 'dev':
-        click.echo(click.style('Setting up dev app shape with free Heroku dynos', fg='yellow'))
-        click.echo(click.style('- Set scale to web=1 dev_worker=1 worker=0 worker_short=0', fg='yellow'))
-        app.batch_scale_formation_processes({
-            'web': 1,
-            'dev_worker': 1,
-            'worker': 0,
-            'worker_short': 0,
-        })
-        click.echo(click.style('- Switching to free dynos', fg='yellow'))
-        app.batch_resize_formation_processes({
-            'web': 'free',
-            'dev_worker': 'free',
-            'worker': 'free',
-            'worker_short': 'free',
-        })
+        return {
+            'web': (1, 'free'),
+            'dev_worker': (1, 'free'),
+            'worker': (0, 'free'),
+            'worker_short': (0, 'free'),
+        }
     elif shape == 'prod' or shape == 'staging':
         if num_workers is None:
             num_workers = 1
-        click.echo(click.style('Setting up {} app shape with paid standard-1x Heroku dynos'.format(shape), fg='yellow'))
-        app.batch_resize_formation_processes({
-            'web': 'standard-1x',
-            'dev_worker': 'standard-1x',
-            'worker': 'standard-1x',
-            'worker_short': 'standard-1x',
-        })
-        app.batch_scale_formation_processes({
-            'web': 1,
-            'dev_worker': 0,
-            'worker': 0,
-        })
-        formation = app.process_formation()
-        formation['worker_short'].scale(1)
-        if shape == 'prod':
-            # Prod shape sets worker scale at 0 to let Hirefire.io scale up/down as needed
-            app.scale_formation_process('worker', 0)
-            click.echo(click.style('- Set scale to web=1 dev_worker=1 worker=0 worker_short=1', fg='yellow'))
-        else:
-            app.scale_formation_process('worker', num_workers)
-            click.echo(click.style('- Set scale to web=1 dev_worker=0 worker={} worker_short=1'.format(num_workers), fg='yellow'))
+        # Prod shape sets worker scale at 0 to let metaci site autoscale or
+        # Hirefire.io scale up/down as needed
+        return {
+            'web': (1, 'standard-1x'),
+            'dev_worker': (0, 'standard-1x'),
+            'worker': (num_workers if shape == 'staging' else 0, 'standard-1x'),
+            'worker_short': (1, 'standard-1x'),
+        }
     else:
         raise click.ClickException('Unknown app shape: {}'.format(shape))
 
+def set_app_shape(app, shape, num_workers=None, dry_run=False):
+    """ reads the app's formation once and applies only the changes needed to
+    reach the shape in a single formation update.  Returns the target dyno
+    count of each process type. """
+    target = shape_formation(shape, num_workers)
+    current = current_formation(app)
+    updates = diff_formation(current, target)
+    counts = dict((process, target[process][0]) for process in current if process in target)
+
+    for process in sorted(set(target) - set(current)):
+        click.echo(click.style('- Skipping {} which the app does not define'.format(process), fg='yellow'))
+    if not updates:
+        click.echo(click.style('App already has the {} app shape'.format(shape), fg='green'))
+        return counts
+
+    click.echo(click.style('{} {} app shape:'.format('Would apply' if dry_run else 'Applying', shape), fg='yellow'))
+    for update in updates:
+        quantity, size = current[update['type']]
+        changes = []
+        if 'quantity' in update:
+            changes.append('scale {} -> {}'.format(quantity, update['quantity']))
+        if 'size' in update:
+            changes.append('size {} -> {}'.format(size, update['size']))
+        click.echo(click.style('- {}: {}'.format(update['type'], ', '.join(changes)), fg='yellow'))
+    if not dry_run:
+        update_formation(app, updates)
+    return counts
+
 def prompt_heroku_token():
     # Heroku API Token
     try:
@@ -99,9 +117,10 @@ def prompt_heroku_token():
         ))
         token = click.prompt('API Token', hide_input=True)
 
-    return heroku3.from_key(token)
+    import heroku3
+    return heroku3.from_key(token, session=build_session())
 
-@click.group('site')
+@click.group('site', short_help='Deploy, connect to and shape MetaCI sites')
 def site():
     pass
 
@@ -126,6 +145,7 @@ def verify_overwrite(config):
 @click.option('--admin', is_flag=True, help='Go directly to the MetaCI admin')
 @pass_config
 def site_browser(config, admin):
+    import webbrowser
     service = check_current_site(config)
     url = service.url
     if admin:
@@ -147,6 +167,7 @@ def site_browser(config, admin):
 )
 @pass_config
 def site_add(config, name, shape):
+    from cumulusci.core.config import ServiceConfig
     if not config.project_config:
         raise click.ClickException('You must be in a CumulusCI configured local git repository.')
    
@@ -259,62 +280,59 @@ def site_add(config, name, shape):
         'Accept': 'application/vnd.heroku+json; version=3',
         'Authorization': 'Bearer {}'.format(token),
     }
-    resp = requests.post('https://api.heroku.com/app-setups', json=payload, headers=headers)
+    session = build_session()
+    resp = session.post('https://api.heroku.com/app-setups', json=payload, headers=headers)
     if resp.status_code != 202:
         raise click.ClickException('Failed to create Heroku App.  Reponse code [{}]: {}'.format(resp.status_code, resp.json()))
     app_setup = resp.json()
     
-    # Check status
-    status = app_setup['status']
+    # Follow the app setup, only reacting when its status or build changes
+    setup_url = 'https://api.heroku.com/app-setups/{id}'.format(**app_setup)
+    def fetch_setup():
+        check_resp = session.get(setup_url, headers=headers)
+        if check_resp.status_code != 200:
+            raise click.ClickException('Failed to check status of app creation.  Reponse code [{}]: {}'.format(check_resp.status_code, check_resp.json()))
+        return check_resp.json()
+
     click.echo()
-    click.echo('Status: {}'.format(status))
     click.echo(click.style('Creating app:', fg='yellow'))
-    i = 1
     build_started = False
-    with click.progressbar(length=200) as bar:
-        while status in ['pending']:
-            check_resp = requests.get(
-                'https://api.heroku.com/app-setups/{id}'.format(**app_setup),
+    for check_data in poll(
+        fetch_setup,
+        lambda data: data['status'] != 'pending',
+        key=lambda data: (data['status'], data['build'] and data['build']['status']),
+        interval=2,
+    ):
+        click.echo('Status: {}'.format(check_data['status']))
+
+        # Stream the build log output once the build starts
+        if not build_started and check_data['build'] != None:
+            build_started = True
+            click.echo()
+            click.echo(click.style('Build {id} Started:'.format(**check_data['build']), fg='yellow'))
+            # Builds can go quiet for minutes, so only bound the connect time
+            build_stream = session.get(
+                check_data['build']['output_stream_url'],
+                stream=True,
                 headers=headers,
+                timeout=(session.timeout[0], None),
             )
-            if check_resp.status_code != 200:
-                raise click.ClickException('Failed to check status of app creation.  Reponse code [{}]: {}'.format(check_resp.status_code, check_resp.json()))
-            check_data = check_resp.json()
-
-            # Stream the build log output once the build starts
-            if not build_started and check_data['build'] != None:
-                build_started = True
-                bar.update(100)
-                click.echo()
-                click.echo()
-                click.echo(click.style('Build {id} Started:'.format(**check_data['build']), fg='yellow'))
-                build_stream = requests.get(check_data['build']['output_stream_url'], stream=True, headers=headers)
-                for chunk in build_stream.iter_content():
-                    click.echo(chunk, nl=False)
-
-            # If app-setup is still pending, sleep and then poll again
-            if check_data['status'] != 'pending':
-                bar.update(100)
-                break
-            if i < 98:
-                i += 1
-                bar.update(i)
-            time.sleep(2)
+            echo_log_stream(build_stream)
 
     click.echo()
     # Success
     if check_data['status'] == 'succeeded':
         click.echo(click.style('Heroku app creation succeeded!', fg='green', bold=True))
-        render_recursive(check_data)
+        click.echo(render_recursive(check_data))
     # Failed
     elif check_data['status'] == 'failed':
         click.echo(click.style('Heroku app creation failed', fg='red', bold=True))
-        render_recursive(check_data)
+        click.echo(render_recursive(check_data))
         if check_data['build']:
             click.echo()
             click.echo('Build Info:')
-            resp = requests.get('https://api.heroku.com/builds/{id}'.format(**check_data['build']), headers=headers)
-            render_recursive(resp.json())
+            resp = session.get('https://api.heroku.com/builds/{id}'.format(**check_data['build']), headers=headers)
+            click.echo(render_recursive(resp.json()))
         return
     else:
         raise click.ClickException('Received an unknown status from the Heroku app-setups API.  Full API response: {}'.format(check_data))
@@ -324,7 +342,13 @@ def site_add(config, name, shape):
     # Apply the app shape
     click.echo()
     click.echo(click.style('# Applying App Shape', bold=True, fg='blue'))
-    set_app_shape(heroku_app, app_shape, num_workers)
+    target = set_app_shape(heroku_app, app_shape, num_workers)
+    # The site works without every dyno up yet, so don't stop setup over it
+    try:
+        wait_for_formation(heroku_app, target)
+    except (click.ClickException, requests.exceptions.RequestException) as e:
+        message = e.format_message() if isinstance(e, click.ClickException) else str(e)
+        click.echo(click.style('- Continuing without waiting for the dynos: {}'.format(message), fg='yellow'))
 
     click.echo()
     click.echo(click.style('# Create Admin User', bold=True, fg='blue'))
@@ -372,6 +396,7 @@ def site_add(config, name, shape):
 @click.option('--app-name', help='Provide the Heroku app name to connect to instead of prompting')
 @pass_config
 def site_connect(config, app_name):
+    from cumulusci.core.config import ServiceConfig
     verify_overwrite(config)
 
     if not app_name:
@@ -403,16 +428,18 @@ def site_connect(config, app_name):
 @pass_config
 def site_info(config):
     service = check_current_site(config)
-    render_recursive(service.config)
+    click.echo(render_recursive(service.config))
 
 @click.command(name='shape', help='Applies an app shape to the current Heroku app')
-@click.option('--num-workers', help='Specify the number of workers for the staging app shape instead of prompting')
+@click.option('--num-workers', type=int, help='Specify the number of workers for the staging app shape instead of prompting')
 @click.option('--shape', 
     help='Specify an app shape instead of prompting for it', 
     type=app_shape_choice,
 )
+@click.option('--wait/--no-wait', default=True, help='Wait for the dynos of the new shape to be up before exiting')
+@click.option('--dry-run', is_flag=True, help='Print the formation changes the shape needs without applying them')
 @pass_config
-def site_shape(config, shape, num_workers):
+def site_shape(config, shape, num_workers, wait, dry_run):
     service = check_current_site(config)
     if not service.app_name:
         raise click.ClickException('The current site is not configured as a Heroku App.  You can only run metaci site shape against MetaCI running on Heroku.  If your MetaCI site is running on Heroku, use metaci site connect to re-connect to the site.')
@@ -420,12 +447,117 @@ def site_shape(config, shape, num_workers):
     heroku_api = prompt_heroku_token()
     heroku_app = heroku_api.app(service.app_name)
     app_shape, num_workers = prompt_app_shape(shape, num_workers)
-    set_app_shape(heroku_app, app_shape, num_workers)
+    target = set_app_shape(heroku_app, app_shape, num_workers, dry_run=dry_run)
+    if wait and not dry_run:
+        wait_for_formation(heroku_app, target)
+
+def count_builds(api_client):
+    """ returns the number of queued and in progress builds from the counts
+    of two concurrent list calls """
+    pending = [
+        api_client.submit('builds', 'list', params={'status': status}, omit=['log'])
+        for status in ('queued', 'in_progress')
+    ]
+    return [res['count'] for res in api_client.gather(*pending)]
+
+def format_clock(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+@click.command(name='autoscale', help='Scales the worker dynos of the current Heroku app with the build queue until interrupted.  Use with the prod app shape instead of Hirefire.io.  Workers are only scaled down while no builds are queued and never below the workers the running builds need, but Heroku chooses which dynos to stop, so a scale down can still stop a dyno that is running a build.  Errors reading the queue or scaling the app are logged and retried on the next interval.')
+@click.option('--min-workers', type=click.IntRange(min=0), default=0, help='Fewest worker dynos to run')
+@click.option('--max-workers', type=click.IntRange(min=0), default=4, help='Most worker dynos to run')
+@click.option('--builds-per-worker', type=click.IntRange(min=1), default=1, help='Queued or running builds each worker dyno handles')
+@click.option('--scale-up-step', type=click.IntRange(min=1), default=2, help='Most worker dynos to add at once')
+@click.option('--cooldown', type=click.IntRange(min=0), default=120, help='Seconds to wait after scaling before scaling again')
+@click.option('--scale-down-delay', type=click.IntRange(min=0), default=600, help='Seconds the queue must stay below the running workers before scaling down')
+@click.option('--interval', type=click.IntRange(min=1), default=30, help='Seconds between reads of the build queue')
+@click.option('--dry-run', is_flag=True, help='Print the scaling decisions without applying them')
+@click.option('--record', type=click.File('a'), help='Append each queue reading to a trace file for --simulate')
+@click.option('--simulate', 'trace', type=click.File('r'), help='Replay a trace recorded with --record through the policy instead of scaling the app')
+@click.option('--workers', type=click.IntRange(min=0), default=0, help='Worker dynos running at the start of a --simulate run')
+@output_option
+@pass_config
+def site_autoscale(config, min_workers, max_workers, builds_per_worker, scale_up_step, cooldown, scale_down_delay, interval, dry_run, record, trace, workers, output_format):
+    try:
+        policy = ScalingPolicy(min_workers, max_workers, builds_per_worker, scale_up_step, cooldown, scale_down_delay)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if trace:
+        try:
+            samples = read_trace(trace)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        rows = simulate(policy, samples, workers)
+        simulate_fmt = '{time:19} {queued!s:>6} {in_progress!s:>11} {workers!s:>7} {change!s:>6}'
+        headers = {
+            'time': 'Time',
+            'queued': 'Queued',
+            'in_progress': 'In Progress',
+            'workers': 'Workers',
+            'change': 'Change',
+        }
+        with OutputWriter(output_format, simulate_fmt, headers) as writer:
+            for row in rows:
+                if output_format == 'table':
+                    row['time'] = format_clock(row['time'])
+                writer.write_record(row)
+        if output_format == 'table':
+            click.echo()
+            click.echo('{} changes, {:.1f} worker hours, {:.1f} build hours queued'.format(
+                sum(1 for row in rows if row['change']),
+                sum(row['worker_seconds'] for row in rows) / 3600,
+                sum(row['queued_seconds'] for row in rows) / 3600,
+            ))
+        return
 
+    service = check_current_site(config)
+    if not service.app_name:
+        raise click.ClickException('The current site is not configured as a Heroku App.  You can only run metaci site autoscale against MetaCI running on Heroku.  If your MetaCI site is running on Heroku, use metaci site connect to re-connect to the site.')
+
+    from metaci_cli.metaci_api import ApiClient
+    api_client = ApiClient(config)
+    heroku_app = prompt_heroku_token().app(service.app_name)
+    if 'worker' not in current_formation(heroku_app):
+        raise click.ClickException('The app does not define a worker process type')
+
+    workers = None
+    while True:
+        now = time.time()
+        policy_state = None
+        # A long running loop shouldn't die on one failed read or update, so
+        # errors are logged and the next interval tries again
+        try:
+            queued, in_progress = count_builds(api_client)
+            if record:
+                record.write(trace_sample(now, queued, in_progress))
+                record.flush()
+
+            # A dry run keeps its own count since it never changes the app
+            if workers is None or not dry_run:
+                workers = current_formation(heroku_app)['worker'][0]
+
+            policy_state = (policy.last_change, policy.below_since)
+            target = policy.decide(workers, queued, in_progress, now)
+            line = '{} queued={} in_progress={} workers={}'.format(format_clock(now), queued, in_progress, workers)
+            if target != workers:
+                click.echo(click.style('{} -> {}{}'.format(line, target, ' (dry run)' if dry_run else ''), fg='yellow'))
+                if not dry_run:
+                    update_formation(heroku_app, [{'type': 'worker', 'quantity': target}])
+                workers = target
+            else:
+                click.echo(line)
+        except Exception as e:
+            # Forget a decision that wasn't applied so it isn't in cooldown
+            if policy_state:
+                policy.last_change, policy.below_since = policy_state
+            message = e.format_message() if isinstance(e, click.ClickException) else '{}: {}'.format(type(e).__name__, e)
+            click.echo(click.style('{} Error, retrying in {} seconds: {}'.format(format_clock(now), interval, message), fg='red'), err=True)
+        time.sleep(interval)
 
 site.add_command(site_add)
+site.add_command(site_autoscale)
 site.add_command(site_browser)
 site.add_command(site_connect)
 site.add_command(site_info)
 site.add_command(site_shape)
-main.add_command(site)
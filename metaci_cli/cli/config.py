@@ -8,14 +8,9 @@ except ImportError:
     import dbm
 
 import click
-import pkg_resources
-import requests
 
-from cumulusci.core.config import BaseGlobalConfig
-from cumulusci.core.config import BaseProjectConfig
-from cumulusci.core.exceptions import NotInProject
-from cumulusci.core.exceptions import ProjectConfigNotFound
-from cumulusci.core.utils import import_class
+# cumulusci, pkg_resources and requests are imported where they are used so
+# importing this module (and so every command) stays cheap
 
 
 def dbm_cache():
@@ -23,6 +18,7 @@ def dbm_cache():
     context manager for accessing simple dbm cache
     located at ~/.cumlusci/cache.dbm
     """
+    from cumulusci.core.config import BaseGlobalConfig
     config_dir = os.path.join(
         os.path.expanduser('~'),
         BaseGlobalConfig.config_local_dir,
@@ -38,6 +34,7 @@ def dbm_cache():
 
 def get_installed_version():
     """ returns the version name (e.g. 2.0.0b58) that is installed """
+    import pkg_resources
     req = pkg_resources.Requirement.parse('metaci_cli')
     dist = pkg_resources.WorkingSet().find(req)
     return pkg_resources.parse_version(dist.version)
@@ -46,6 +43,8 @@ def get_installed_version():
 def get_latest_version():
     """ return the latest version of metaci_cli in pypi, be defensive """
     # use the pypi json api https://wiki.python.org/moin/PyPIJSON
+    import pkg_resources
+    import requests
     res = requests.get('https://pypi.python.org/pypi/metaci_cli/json', timeout=5).json()
     with dbm_cache() as cache:
         cache['metaci_cli-latest-timestamp'] = str(time.time())
@@ -85,6 +84,8 @@ class CliConfig(object):
         return self._global_config
         
     def _load_global_config(self):
+        from cumulusci.core.config import BaseGlobalConfig
+        from cumulusci.core.exceptions import NotInProject
         try:
             self._global_config = BaseGlobalConfig()
         except NotInProject as e:
@@ -97,6 +98,9 @@ class CliConfig(object):
         return self._project_config
         
     def _load_project_config(self):
+        from cumulusci.core.exceptions import ConfigError
+        from cumulusci.core.exceptions import NotInProject
+        from cumulusci.core.exceptions import ProjectConfigNotFound
         try:
             self._project_config = self.global_config.get_project_config()
         except ProjectConfigNotFound:
@@ -119,6 +123,7 @@ class CliConfig(object):
         return self._keychain
 
     def _load_keychain(self):
+        from cumulusci.core.utils import import_class
         self.keychain_key = os.environ.get('CUMULUSCI_KEY')
         if self.project_config:
             keychain_class = os.environ.get(
@@ -130,6 +135,13 @@ class CliConfig(object):
                 self.project_config, self.keychain_key)
             self.project_config.set_keychain(self.keychain)
 
+    def reset(self):
+        """ drops the loaded configs and keychain so they are loaded again,
+        e.g. by the agent after a git checkout or a CUMULUSCI_KEY change """
+        for attr in ('_global_config', '_project_config', '_keychain'):
+            if hasattr(self, attr):
+                delattr(self, attr)
+
 def make_pass_instance_decorator(obj, ensure=False):
     """Given an object type this creates a decorator that will work
     similar to :func:`pass_obj` but instead of passing the object of the
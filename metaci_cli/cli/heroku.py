@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers for following long running Heroku operations"""
+
+import click
+import codecs
+import time
+from metaci_cli.cli.util import Backoff
+
+# Heroku streams build output with chunked encoding, so a read returns as
+# soon as a chunk arrives rather than waiting for the whole 64KB
+LOG_CHUNK_SIZE = 64 * 1024
+
+def poll(fetch, done, key=None, interval=1, max_interval=15, timeout=None):
+    """ Calls fetch() until done(state) is true, yielding each state whose
+    key(state) differs from the last one so callers only react to changes.
+    The final state is always yielded.  The poll interval backs off while
+    nothing changes and drops back to interval as soon as something does. """
+    if key is None:
+        key = lambda state: state
+    backoff = Backoff(interval, max_interval)
+    start = time.time()
+    last = object()
+    while True:
+        state = fetch()
+        finished = done(state)
+        current = key(state)
+        if current != last or finished:
+            backoff.reset()
+            last = current
+            yield state
+        if finished:
+            return
+        if timeout is not None and time.time() - start > timeout:
+            raise click.ClickException('Timed out after {} seconds waiting for Heroku'.format(timeout))
+        time.sleep(backoff.next())
+
+def iter_log_blocks(resp, chunk_size=LOG_CHUNK_SIZE):
+    """ Yields text from a streaming log response in blocks of whole lines as
+    they arrive, so output can be echoed once per chunk rather than once per
+    byte without splitting lines or multi-byte characters """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    pending = u''
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        text = pending + decoder.decode(chunk)
+        end = text.rfind(u'\n') + 1
+        if end:
+            yield text[:end]
+        pending = text[end:]
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def echo_log_stream(resp):
+    for block in iter_log_blocks(resp):
+        click.echo(block, nl=False)
+
+def current_formation(app):
+    """ returns a dict of process type to (quantity, size) read in one call """
+    return dict(
+        (formation.type, (formation.quantity, formation.size))
+        for formation in app.process_formation()
+    )
+
+def diff_formation(current, target):
+    """ returns the formation updates needed to turn the current formation
+    into the target, both dicts of process type to (quantity, size), as a
+    list of dicts with only the fields that change.  Process types the app
+    doesn't define are skipped since Heroku rejects them. """
+    updates = []
+    for process, (quantity, size) in sorted(target.items()):
+        if process not in current:
+            continue
+        current_quantity, current_size = current[process]
+        update = {}
+        if quantity != current_quantity:
+            update['quantity'] = quantity
+        # Heroku can report no size for a process type that has never run
+        if size.lower() != (current_size or '').lower():
+            update['size'] = size
+        if update:
+            update['type'] = process
+            updates.append(update)
+    return updates
+
+def update_formation(app, updates):
+    """ applies formation updates with heroku3's batch formation helpers,
+    which take either sizes or quantities, so this is one request for the
+    sizes and one for the quantities that change.  Sizes go first so dynos
+    started by a scale up already have the new size. """
+    sizes = dict((update['type'], update['size']) for update in updates if 'size' in update)
+    quantities = dict((update['type'], update['quantity']) for update in updates if 'quantity' in update)
+    if sizes:
+        app.batch_resize_formation_processes(sizes)
+    if quantities:
+        app.batch_scale_formation_processes(quantities)
+
+def formation_counts(app):
+    """ returns a dict of process type to the number of dynos it should run """
+    return dict((formation.type, formation.quantity) for formation in app.process_formation())
+
+def running_counts(app):
+    """ returns a dict of process type to the number of dynos that are up """
+    counts = {}
+    for dyno in app.dynos():
+        if dyno.state == 'up':
+            counts[dyno.type] = counts.get(dyno.type, 0) + 1
+    return counts
+
+def wait_for_formation(app, target=None, timeout=600):
+    """ waits until every process type is running at least as many dynos as
+    its formation asks for, echoing progress whenever the counts change.
+    Dynos being stopped after a scale down still count while they shut down.
+    target is a dict of process type to quantity, read from the app if not
+    given """
+    if target is None:
+        target = formation_counts(app)
+    for running in poll(
+        lambda: running_counts(app),
+        lambda running: all(running.get(process, 0) >= quantity for process, quantity in target.items()),
+        timeout=timeout,
+    ):
+        click.echo('- Dynos up: {}'.format(' '.join(
+            '{}={}/{}'.format(process, running.get(process, 0), quantity)
+            for process, quantity in sorted(target.items())
+        )))
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""Table, JSON, NDJSON and CSV output for metaci list and info commands"""
+
+import click
+import csv
+import json
+import re
+import string
+import time
+from collections import OrderedDict
+
+OUTPUT_FORMATS = ['table', 'json', 'ndjson', 'csv']
+
+BUFFER_SIZE = 64 * 1024
+
+# Buffered rows are written out at least this often so rows from a slow
+# source of records still show up promptly.  Paged results are also written
+# out at the end of each page, before the next page is requested.
+FLUSH_INTERVAL = 0.5
+
+def output_option(func):
+    """ Adds the --format option shared by list and info commands """
+    return click.option(
+        '--format',
+        'output_format',
+        type=click.Choice(OUTPUT_FORMATS),
+        default='table',
+        help="Output format.  json, ndjson and csv output only the records so it can be piped into other tools",
+    )(func)
+
+def parse_template(template):
+    """ returns the field paths used in a str.format template,
+    e.g. '{id:<5} {plan[name]:24.24}' -> [['id'], ['plan', 'name']] """
+    paths = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if field is not None:
+            paths.append(re.findall(r'[^\[\]]+', field))
+    return paths
+
+def get_path(data, path):
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+def flatten(data, prefix=''):
+    """ flattens nested dicts into one dict with dotted keys, e.g.
+    {'plan': {'name': 'Feature'}} -> {'plan.name': 'Feature'} """
+    flat = OrderedDict()
+    for key, value in data.items():
+        key = u'{}{}'.format(prefix, key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, key + '.'))
+        elif isinstance(value, list):
+            flat[key] = json.dumps(value, default=str)
+        else:
+            flat[key] = value
+    return flat
+
+def render_recursive(data, indent=0):
+    """ returns nested data rendered as indented `key: value` lines """
+    lines = []
+    _render(data, indent, lines)
+    return u'\n'.join(lines)
+
+def _render(data, indent, lines):
+    indent_str = u' ' * indent
+    if isinstance(data, list):
+        for item in data:
+            if isinstance(item, (dict, list)):
+                _render(item, indent, lines)
+            else:
+                lines.append(u'{}- {}'.format(indent_str, item))
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            key_str = click.style(u'{}:'.format(key), bold=True)
+            if isinstance(value, (dict, list)) and value:
+                lines.append(u'{}{}'.format(indent_str, key_str))
+                _render(value, indent + 2, lines)
+            else:
+                lines.append(u'{}{} {}'.format(indent_str, key_str, value))
+    else:
+        lines.append(u'{}{}'.format(indent_str, data))
+
+def echo_record(record, output_format):
+    """ outputs a single record for info commands """
+    if output_format == 'json':
+        click.echo(json.dumps(record, indent=2, default=str))
+    elif output_format == 'ndjson':
+        click.echo(json.dumps(record, default=str))
+    elif output_format == 'csv':
+        with OutputWriter('csv') as writer:
+            flat = flatten(record)
+            writer.write_row(list(flat.keys()))
+            writer.write_row(list(flat.values()))
+    else:
+        click.echo(render_recursive(record))
+
+class OutputWriter(object):
+    """ Streams records to stdout in one of OUTPUT_FORMATS.  Output is
+    buffered and written BUFFER_SIZE at a time rather than line by line.
+
+    The table layout is a str.format template with a matching dict of
+    headers, and csv output uses the same fields as the table.  style, if
+    given, is called with each record and its table line to color it. """
+
+    def __init__(self, output_format, template=None, headers=None, style=None):
+        self.output_format = output_format
+        self.template = template
+        self.headers = headers
+        self.style = style
+        self.paths = parse_template(template) if template else None
+        self.count = 0
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+        self._csv = None
+        self._started = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= BUFFER_SIZE or time.time() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            click.echo(u''.join(self._buffer), nl=False)
+            self._buffer = []
+            self._buffered = 0
+        self._last_flush = time.time()
+
+    def write_row(self, values):
+        """ writes a csv row of values """
+        if self._csv is None:
+            self._csv = csv.writer(self, lineterminator='\n')
+        self._csv.writerow([u'' if value is None else value for value in values])
+
+    def _start(self):
+        self._started = True
+        if self.output_format == 'table' and self.template:
+            self.write(self.template.format(**self.headers) + u'\n')
+        elif self.output_format == 'csv' and self.paths:
+            self.write_row([get_path(self.headers, path) for path in self.paths])
+
+    def write_record(self, record):
+        if not self._started:
+            self._start()
+        if self.output_format == 'table':
+            line = self.template.format(**record)
+            if self.style:
+                line = self.style(record, line)
+            self.write(line + u'\n')
+        elif self.output_format == 'json':
+            self.write(u'[\n' if not self.count else u',\n')
+            self.write(json.dumps(record, default=str))
+        elif self.output_format == 'ndjson':
+            self.write(json.dumps(record, default=str) + u'\n')
+        elif self.output_format == 'csv':
+            if self.paths:
+                self.write_row([get_path(record, path) for path in self.paths])
+            else:
+                self.write_row(list(flatten(record).values()))
+        self.count += 1
+
+    def write_records(self, records):
+        """ writes an iterable of records.  If it has a pages() method, like
+        the results of iter_list, buffered rows are flushed after each page
+        so they show up while the next page is fetched. """
+        if not hasattr(records, 'pages'):
+            for record in records:
+                self.write_record(record)
+            return
+        for page in records.pages():
+            for record in page:
+                self.write_record(record)
+            self.flush()
+
+    def close(self):
+        if not self._started:
+            self._start()
+        if self.output_format == 'json':
+            self.write(u'\n]\n' if self.count else u'[]\n')
+        self.flush()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""Runs metaci commands inside an already running process"""
+
+import sys
+import threading
+
+import click
+
+from metaci_cli.cli.commands.main import main
+
+
+class ThreadLocalStream(object):
+    """ Stands in for sys.stdout, sys.stderr or sys.stdin and forwards to the
+    stream set for the current thread, or the original stream if none is set.
+    This lets several commands run at once without mixing their output. """
+
+    def __init__(self, original):
+        self._original = original
+        self._local = threading.local()
+
+    def set(self, stream):
+        """ redirects the current thread to stream and returns the stream it
+        was redirected to before, if any, so nested invocations can restore it """
+        previous = getattr(self._local, 'stream', None)
+        self._local.stream = stream
+        return previous
+
+    def _target(self):
+        return getattr(self._local, 'stream', None) or self._original
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    # click caches its text stream wrapper per sys.stdout object, so the proxy
+    # must always look like a proper text stream whatever it forwards to
+    @property
+    def encoding(self):
+        return getattr(self._target(), 'encoding', None) or 'utf-8'
+
+    @property
+    def errors(self):
+        return getattr(self._target(), 'errors', None) or 'strict'
+
+    def isatty(self):
+        # Redirected output is never a terminal, even if the original is
+        if getattr(self._local, 'stream', None) is None:
+            return self._original.isatty()
+        return False
+
+
+_lock = threading.Lock()
+_streams = None
+
+
+def _install_streams():
+    global _streams
+    with _lock:
+        if _streams is None:
+            _streams = (
+                ThreadLocalStream(sys.stdin),
+                ThreadLocalStream(sys.stdout),
+                ThreadLocalStream(sys.stderr),
+            )
+            sys.stdin, sys.stdout, sys.stderr = _streams
+    return _streams
+
+
+def invoke(argv, stdout, stderr=None, stdin=None, color=None, banner=True):
+    """ Runs `metaci <argv>` in this process with output written to the given
+    file-like objects and returns the exit code the command would have exited
+    the process with.  Safe to call from several threads at once.  Pass
+    banner=False to leave the version banner out of the output. """
+    if stderr is None:
+        stderr = stdout
+    if stdin is None:
+        # There is nobody to answer prompts, so make them abort immediately
+        from io import StringIO
+        stdin = StringIO()
+
+    streams = _install_streams()
+    previous = [
+        stream.set(target)
+        for stream, target in zip(streams, (stdin, stdout, stderr))
+    ]
+    try:
+        try:
+            rv = main.main(
+                args=list(argv),
+                prog_name='metaci',
+                standalone_mode=False,
+                color=color,
+                obj={'banner': banner},
+            )
+            # click >= 7 returns the code from ctx.exit() in non-standalone mode
+            return rv if isinstance(rv, int) else 0
+        except click.ClickException as e:
+            e.show(file=stderr)
+            return e.exit_code
+        except click.Abort:
+            click.echo('Aborted!', file=stderr)
+            return 1
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            click.echo(e.code, file=stderr)
+            return 1
+        except Exception as e:
+            click.echo('Error: {}: {}'.format(type(e).__name__, e), file=stderr)
+            return 1
+    finally:
+        for stream, target in zip(streams, previous):
+            stream.set(target)
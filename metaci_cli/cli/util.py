@@ -3,16 +3,50 @@
 """Command line utils for metaci"""
 
 import click
+import json
 import requests
 from collections import OrderedDict
 from cumulusci.core.exceptions import NotInProject
 from cumulusci.core.exceptions import ProjectConfigNotFound
+from cumulusci.core.exceptions import ServiceNotConfigured
+from metaci_cli.cache import ACTIVE_STATUSES
+from metaci_cli.cache import TERMINAL_STATUSES
+from metaci_cli.cli.output import OutputWriter
+
+# Exit codes used by commands that follow builds to completion
+BUILD_EXIT_CODES = {
+    'success': 0,
+    'fail': 1,
+    'error': 2,
+}
+
+# Records listed by --local commands when neither --limit nor --all is given
+LOCAL_PAGE_SIZE = 50
+
+class Backoff(object):
+    """ A poll interval that grows while nothing changes and drops back to the
+    initial interval as soon as something does """
+
+    def __init__(self, initial=1, maximum=30, factor=2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.interval = initial
+
+    def next(self):
+        """ returns the interval to sleep now and grows the next one """
+        interval = self.interval
+        self.interval = min(self.interval * self.factor, self.maximum)
+        return interval
+
+    def reset(self):
+        self.interval = self.initial
 
 def color_status(status, line=None):
     if not line:
         line = status
     output = line
-    if status in ['queued','waiting','in_progress']:
+    if status in ACTIVE_STATUSES:
         output = click.style(line, fg='cyan')
         output += click.style('', reset=True)
     elif status == 'success':
@@ -33,22 +67,57 @@ def check_current_site(config):
         raise click.UsageError('No site is currently connected.  Use metaci site connect or metaci site create to connect to a site')
     return service
 
-def get_or_create_branch(api_client, name, repo_id):
+def fetch_first(api_client, resource, params):
+    """ returns the first result of a filtered list call or None """
+    res = api_client(resource, 'list', params=params)
+    if res['count']:
+        return res['results'][0]
+
+def lookup_branch(api_client, name, repo_id):
+    """ returns the branch with name in a repo or None """
     params = {
-        'repo': 'id',
+        'repo': repo_id,
         'name': name,
     }
-    resp = api_client('branches', 'list', params=params)
-    if resp['count'] == 0:
+    key = '{}:{}'.format(repo_id, name)
+    return api_client.index.resolve('branch', key, lambda: fetch_first(api_client, 'branches', params))
+
+def get_or_create_branch(api_client, name, repo_id):
+    key = '{}:{}'.format(repo_id, name)
+    branch = lookup_branch(api_client, name, repo_id)
+    if branch is None:
         params = {
             'repo_id': repo_id,
             'name': name,
         }
-        return api_client('branches', 'create', params=params)
-    else:
-        return resp['results'][0]
+        branch = api_client('branches', 'create', params=params)
+        api_client.index.put('branch', key, branch)
+    return branch
 
-def lookup_repo(api_client, config, repo=None, required=None, no_output=None):
+def lookup_org(api_client, name, repo_id=None):
+    """ returns the org with name, optionally scoped to a repo, or None """
+    params = {
+        'name': name,
+    }
+    if repo_id:
+        params['repo'] = repo_id
+    key = '{}:{}'.format(repo_id or '*', name)
+    return api_client.index.resolve('org', key, lambda: fetch_first(api_client, 'orgs', params))
+
+def lookup_service(api_client, name, fresh=False):
+    """ returns the service with name or None.  Pass fresh=True to read the
+    whole record from the server rather than the indexed id and name. """
+    params = {
+        'name': name,
+    }
+    if fresh:
+        return fetch_first(api_client, 'services', params)
+    return api_client.index.resolve('service', name, lambda: fetch_first(api_client, 'services', params))
+
+def lookup_repo(api_client, config, repo=None, required=None, no_output=None, mirror=None, fresh=False):
+    """ returns the repo given as OwnerName/RepoName or the local project's
+    repo.  Pass fresh=True to read the whole record from the server rather
+    than the indexed id, owner and name. """
     repo_info = {
         'name': None,
         'owner': None,
@@ -75,10 +144,16 @@ def lookup_repo(api_client, config, repo=None, required=None, no_output=None):
         except ProjectConfigNotFound:
             raise click.ClickException('Your local git repository does not appear to be configured for CumulusCI.  Configure CumulusCI for your project first using the documentation at http://cumulusci.readthedocs.io so you can use metaci on this repository.')
     
-    if repo_info['name'] and repo_info['owner']:
-        res = api_client('repos', 'list', params=repo_info)
-        if res['count'] == 1:
-            repo_data = res['results'][0]
+    if repo_info['name'] and repo_info['owner'] and mirror is not None:
+        repo_data = mirror.get_repo(repo_info['owner'], repo_info['name'])
+    elif repo_info['name'] and repo_info['owner'] and fresh:
+        repo_data = fetch_first(api_client, 'repos', repo_info)
+    elif repo_info['name'] and repo_info['owner']:
+        repo_data = api_client.index.resolve(
+            'repo',
+            '{owner}/{name}'.format(**repo_info),
+            lambda: fetch_first(api_client, 'repos', repo_info),
+        )
 
     if required and not repo_data: 
         if config.project_config.repo_user:
@@ -108,24 +183,183 @@ def lookup_repo(api_client, config, repo=None, required=None, no_output=None):
 
     return repo_data
 
-def render_recursive(data, indent=None):
-    if indent is None:
-        indent = 0
-    indent_str = ' ' * indent
-    if isinstance(data, list):
-        for item in data:
-            render_recursive(item, indent=indent+2)
-    elif isinstance(data, dict):
-        for key, value in data.items():
-            key_str = click.style(unicode(key) + ':', bold=True)
-            if isinstance(value, list):
-                render_recursive(value, indent=indent+2)
-            elif isinstance(value, dict):
-                click.echo('{}{}'.format(indent_str, key_str))
-                render_recursive(value, indent=indent+2)
-            else:
-                click.echo('{}{} {}'.format(indent_str, key_str, value))
+def pagination_options(func):
+    """ Adds the --limit and --all options shared by all list commands """
+    func = click.option('--all', 'all_pages', is_flag=True, help="If set, follows pagination to list all matching records")(func)
+    func = click.option('--limit', type=int, help="Maximum number of records to list, following pagination as needed")(func)
+    return func
+
+class PagedResults(object):
+    """ Results from a list action which iterate like a flat list of records
+    and can also be read page by page with pages(), so OutputWriter can write
+    out each page's rows before the next page is requested """
+
+    def __init__(self, pages):
+        self._pages = pages
+
+    def pages(self):
+        return self._pages
+
+    def __iter__(self):
+        for page in self._pages:
+            for result in page:
+                yield result
+
+def _iter_list_pages(api_client, resource, params, limit, all_pages, omit):
+    if limit is not None or all_pages:
+        for results in api_client.iter_result_pages(resource, 'list', params=params, limit=limit, omit=omit):
+            yield results
+        return
+
+    res = api_client(resource, 'list', params=params, omit=omit)
+    yield res['results']
+    if res.get('next'):
+        click.echo(
+            click.style(
+                '- Showing the first {} of {} results.  Use --limit or --all to list more.'.format(len(res['results']), res['count']),
+                fg='yellow',
+            ),
+            err=True,
+        )
+
+def iter_list(api_client, resource, params=None, limit=None, all_pages=None, omit=None):
+    """ Returns the results from a list action as PagedResults, fetching each
+    page as it is needed.  Without limit or all_pages only the first page is
+    listed, as the API returns it """
+    return PagedResults(_iter_list_pages(api_client, resource, params, limit, all_pages, omit))
+
+def local_option(func):
+    """ Adds the --local option to commands that can answer from the mirror """
+    return click.option('--local', is_flag=True, help="Answer from the local mirror kept up to date by metaci mirror sync instead of the MetaCI site")(func)
+
+def open_mirror(config):
+    """ returns the local mirror for the current site, which must have been
+    synced at least once """
+    from metaci_cli.mirror import Mirror
+    service = check_current_site(config)
+    mirror = Mirror(service.url)
+    if mirror.last_synced() is None:
+        raise click.ClickException('The local mirror of {} is empty.  Use metaci mirror sync to populate it.'.format(service.url))
+    return mirror
+
+def iter_local(mirror, table, filters=None, limit=None, all_pages=None):
+    """ Yields records from the local mirror with the same paging options as
+    iter_list.  Without limit or all_pages only LOCAL_PAGE_SIZE are listed """
+    if limit is None and not all_pages:
+        limit = LOCAL_PAGE_SIZE
+        count = mirror.count(table, filters)
+        if count > limit:
+            click.echo(
+                click.style(
+                    '- Showing the first {} of {} results.  Use --limit or --all to list more.'.format(limit, count),
+                    fg='yellow',
+                ),
+                err=True,
+            )
+    for record in mirror.query(table, filters, limit):
+        yield record
 
 def require_project_config(config):
     if not config.project_config:
         raise click.UsageError('You must be in a CumulusCI configured git repository.  No CumulusCI project configuration could be detected')
+
+def api_error(e):
+    """ returns the message of a coreapi ErrorMessage for display """
+    return u'{}'.format(getattr(e.error, 'title', None) or e.error)
+
+def push_record(api_client, resource, record_id, params):
+    """ creates a record, or updates the one with record_id, and returns
+    (record, None) or (None, error message) """
+    import coreapi
+    try:
+        if record_id is None:
+            return api_client(resource, 'create', params=params), None
+        return api_client(resource, 'partial_update', params=dict(params, id=record_id)), None
+    except coreapi.exceptions.ErrorMessage as e:
+        return None, api_error(e)
+
+def same_config(record, params):
+    """ returns whether a record from the site already has the params, with
+    json params compared by value, or None if the site doesn't return them """
+    for field, value in params.items():
+        if field not in record:
+            return None
+        current = record[field]
+        if field == 'json':
+            if not isinstance(current, dict):
+                current = json.loads(current or 'null')
+            value = json.loads(value)
+        if current != value:
+            return False
+    return True
+
+def sync_action(hashes, key, record, params, force=False):
+    """ returns create, update or unchanged for a config to sync.  The first
+    time a record is synced from here there is no hash to compare against,
+    so it is compared with the site and its hash seeded rather than pushing
+    every existing record.  force pushes every existing record. """
+    if record is None:
+        return 'create'
+    if force:
+        return 'update'
+    if key in hashes:
+        return 'update' if hashes.changed(key, params) else 'unchanged'
+    if same_config(record, params) is False:
+        return 'update'
+    hashes.update(key, params)
+    return 'unchanged'
+
+def sync_records(api_client, resource, changes, hashes, dry_run, output_format, on_synced=None):
+    """ pushes and reports the changes found by org sync and service sync.
+    Each change is a dict with the name, the hashes key, an action of create,
+    update, unchanged or why it was skipped, the existing record, the params
+    to hash and the push_params to send.  Pushed params have their hash
+    saved and on_synced(change, record) is called for each pushed record. """
+    results = {}
+    if not dry_run:
+        pending = {}
+        for change in changes:
+            if change['action'] in ('create', 'update'):
+                record_id = change['record']['id'] if change['record'] else None
+                pending[change['name']] = api_client.spawn(push_record, api_client, resource, record_id, change['push_params'])
+        results = dict(zip(pending, api_client.gather(*pending.values())))
+
+    sync_fmt = '{id!s:<5} {name:24.24} {status}'
+    headers = {
+        'id': '#',
+        'name': 'Name',
+        'status': 'Status',
+    }
+    colors = {
+        'create': 'yellow',
+        'update': 'yellow',
+        'created': 'green',
+        'updated': 'green',
+        'unchanged': None,
+    }
+    style = lambda row, line: click.style(line, fg=colors.get(row['status'], 'red'))
+    errors = 0
+    with OutputWriter(output_format, sync_fmt, headers, style) as writer:
+        for change in changes:
+            record = change['record']
+            status = change['action']
+            if change['name'] in results:
+                resp, error = results[change['name']]
+                if resp is None:
+                    errors += 1
+                    status = error
+                else:
+                    record = resp
+                    status += 'd'
+                    hashes.update(change['key'], change['params'])
+                    if on_synced:
+                        on_synced(change, resp)
+            writer.write_record({
+                'id': record['id'] if record else None,
+                'name': change['name'],
+                'status': status,
+            })
+    if not dry_run:
+        hashes.save()
+    if errors:
+        raise click.ClickException('{} of {} {} could not be synced'.format(errors, len(results), resource))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""Reads branch heads from a local git checkout"""
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+
+from metaci_cli.cache import get_cache_dir
+from metaci_cli.cache import write_atomic
+
+class GitError(Exception):
+    pass
+
+def run_git(repo_root, *args):
+    """ returns the output of a git command.  stderr is kept out of the
+    output so warnings can't be parsed as results, and git never prompts
+    for credentials since nothing would answer. """
+    env = dict(os.environ)
+    env['GIT_TERMINAL_PROMPT'] = '0'
+    try:
+        process = subprocess.Popen(
+            ['git'] + list(args),
+            cwd=repo_root,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        output, error = process.communicate()
+    except OSError as e:
+        raise GitError('git {} failed: {}'.format(' '.join(args), e))
+    if process.returncode:
+        raise GitError('git {} failed: {}'.format(' '.join(args), error.decode('utf-8', 'replace').strip()))
+    return output.decode('utf-8')
+
+def split_line(line, separator, command):
+    """ splits a line of git output in two, raising GitError if it doesn't
+    have the expected format """
+    parts = line.split(separator, 1)
+    if len(parts) != 2:
+        raise GitError('Unexpected output from git {}: {}'.format(command, line))
+    return parts
+
+def find_remote(repo_root, owner, name):
+    """ returns the name of the remote pointing at the Github repository
+    owner/name, or origin if none does """
+    pattern = r'[:/]{}/{}(\.git)?/?$'.format(re.escape(owner), re.escape(name))
+    for line in run_git(repo_root, 'remote', '-v').splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and re.search(pattern, parts[1], re.IGNORECASE):
+            return parts[0]
+    return 'origin'
+
+def remote_heads(repo_root, remote):
+    """ returns a dict of branch name to sha from the remote-tracking refs,
+    which are as current as the last git fetch """
+    prefix = 'refs/remotes/{}/'.format(remote)
+    output = run_git(repo_root, 'for-each-ref', '--format=%(objectname) %(refname)', prefix)
+    heads = {}
+    for line in output.splitlines():
+        sha, ref = split_line(line, ' ', 'for-each-ref')
+        branch = ref[len(prefix):]
+        if branch != 'HEAD':
+            heads[branch] = sha
+    return heads
+
+def last_fetched(repo_root):
+    """ returns when the repository was last fetched, or None if never """
+    git_dir = run_git(repo_root, 'rev-parse', '--git-dir').strip()
+    path = os.path.join(repo_root, git_dir, 'FETCH_HEAD')
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+
+def ls_remote_heads(repo_root, remote, ttl=None):
+    """ returns a dict of branch name to sha straight from the remote with
+    git ls-remote.  Results are cached for METACI_LS_REMOTE_TTL seconds
+    (default 60) so a burst of commands only asks the remote once. """
+    if ttl is None:
+        ttl = int(os.environ.get('METACI_LS_REMOTE_TTL', 60))
+    key = hashlib.sha1(u'{}:{}'.format(os.path.realpath(repo_root), remote).encode('utf-8')).hexdigest()
+    path = os.path.join(get_cache_dir('git'), '{}.json'.format(key))
+    if os.path.isfile(path) and time.time() - os.path.getmtime(path) < ttl:
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    heads = {}
+    for line in run_git(repo_root, 'ls-remote', '--heads', remote).splitlines():
+        sha, ref = split_line(line, '\t', 'ls-remote')
+        heads[ref[len('refs/heads/'):]] = sha
+    write_atomic(path, json.dumps(heads))
+    return heads
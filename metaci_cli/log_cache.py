@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""Compressed on-disk cache of logs from finished MetaCI builds"""
+
+import codecs
+import hashlib
+import json
+import mmap
+import os
+import re
+import zlib
+
+from metaci_cli.cache import get_site_cache_dir
+from metaci_cli.cache import write_atomic
+
+CHUNK_SIZE = 256 * 1024
+
+
+class LogCache(object):
+    """ Caches build and flow logs for builds in a terminal state.  Those logs
+    never change so entries never need revalidation.  Logs are stored zlib
+    compressed, streamed back out of a memory map, and evicted least recently
+    used first once the cache grows past METACI_LOG_CACHE_MAX_MB (default 512).
+    """
+
+    def __init__(self, site_url, max_size=None):
+        if max_size is None:
+            max_size = int(os.environ.get('METACI_LOG_CACHE_MAX_MB', 512)) * 1024 * 1024
+        self.max_size = max_size
+        self.path = get_site_cache_dir(site_url, 'logs')
+
+    def _log_path(self, build_id, flow=None):
+        if flow is None:
+            name = 'build-{}.log.z'.format(build_id)
+        else:
+            # Hashed rather than sanitized so names like ci/beta and ci_beta
+            # never share a file
+            flow_key = hashlib.sha1(flow.encode('utf-8')).hexdigest()
+            name = 'build-{}-flow-{}.log.z'.format(build_id, flow_key)
+        return os.path.join(self.path, name)
+
+    def _flows_path(self, build_id):
+        # v2 since flow log names changed, so older cached flows are missed
+        # and left for prune to evict
+        return os.path.join(self.path, 'build-{}-flows-v2.json'.format(build_id))
+
+    def has_log(self, build_id):
+        return os.path.isfile(self._log_path(build_id))
+
+    def has_flows(self, build_id):
+        return os.path.isfile(self._flows_path(build_id))
+
+    def put_log(self, build_id, log, prune=True):
+        self._write(self._log_path(build_id), log)
+        if prune:
+            self.prune()
+
+    def put_flows(self, build_id, flows, prune=True):
+        """ caches a list of (flow name, log) pairs in the order given.  Pass
+        prune=False when caching many builds and call prune() once after. """
+        for flow, log in flows:
+            self._write(self._log_path(build_id, flow), log)
+        # Written last so a partially cached set of flows is never used
+        write_atomic(self._flows_path(build_id), json.dumps([flow for flow, log in flows]))
+        if prune:
+            self.prune()
+
+    def get_flows(self, build_id):
+        """ returns the names of the cached flows for a build in order """
+        path = self._flows_path(build_id)
+        self._touch(path)
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def iter_log(self, build_id, flow=None):
+        """ yields the decompressed text of a cached log in chunks """
+        path = self._log_path(build_id, flow)
+        self._touch(path)
+        decompressor = zlib.decompressobj()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for start in range(0, len(data), CHUNK_SIZE):
+                    chunk = decompressor.decompress(data[start:start + CHUNK_SIZE])
+                    if chunk:
+                        yield decoder.decode(chunk)
+                yield decoder.decode(decompressor.flush(), final=True)
+            finally:
+                data.close()
+
+    def read_log(self, build_id, flow=None):
+        return u''.join(self.iter_log(build_id, flow))
+
+    def _write(self, path, log):
+        write_atomic(path, zlib.compress((log or u'').encode('utf-8')))
+
+    def _touch(self, path):
+        # Reads bump the mtime which is what eviction orders by
+        os.utime(path, None)
+
+    def entries(self):
+        """ returns a list of (path, size, mtime) for every cached file """
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            stat = os.stat(path)
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def cached_builds(self):
+        """ returns the set of build ids with any cached log """
+        builds = set()
+        for name in os.listdir(self.path):
+            match = re.match(r'build-(\d+)[.-]', name)
+            if match:
+                builds.add(int(match.group(1)))
+        return builds
+
+    def size(self):
+        return sum(size for path, size, mtime in self.entries())
+
+    def prune(self, max_size=None):
+        """ evicts least recently used logs until the cache fits in max_size
+        bytes.  A build's flow logs are evicted together so a partial set is
+        never served.  Returns the number of files removed. """
+        if max_size is None:
+            max_size = self.max_size
+
+        # Group files into units of (build log) or (all flow logs for a build)
+        units = {}
+        total = 0
+        for path, size, mtime in self.entries():
+            match = re.match(r'build-(\d+)(\.log|-flow)', os.path.basename(path))
+            key = match.groups() if match else path
+            unit = units.setdefault(key, {'paths': [], 'size': 0, 'mtime': 0})
+            unit['paths'].append(path)
+            unit['size'] += size
+            unit['mtime'] = max(unit['mtime'], mtime)
+            total += size
+
+        removed = 0
+        for unit in sorted(units.values(), key=lambda unit: unit['mtime']):
+            if total <= max_size:
+                break
+            # Remove the flows index first so readers never see missing flows
+            for path in sorted(unit['paths'], key=lambda path: not path.endswith('.json')):
+                os.remove(path)
+                removed += 1
+            total -= unit['size']
+        return removed
+
+    def clear(self):
+        return self.prune(0)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""Full text index over cached build and flow logs"""
+
+import os
+import re
+import sqlite3
+
+from metaci_cli.cache import get_site_cache_dir
+
+SCHEMA_VERSION = 1
+
+def has_fts5():
+    """ returns True if the sqlite3 module was built with FTS5 """
+    db = sqlite3.connect(':memory:')
+    try:
+        db.execute('CREATE VIRTUAL TABLE test USING fts5(line)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        db.close()
+
+def fts_query(text):
+    """ returns an FTS5 query matching lines containing the words in text,
+    in order, with the last word allowed to be a prefix.  Returns None if
+    text has no words to search for. """
+    words = re.findall(r'\w+', text, re.UNICODE)
+    if not words:
+        return None
+    return ' + '.join('"{}"'.format(word) for word in words) + ' *'
+
+def like_pattern(text):
+    """ returns a LIKE pattern matching text anywhere, with LIKE's wildcards
+    in text escaped by a backslash """
+    for char in ('\\', '%', '_'):
+        text = text.replace(char, '\\' + char)
+    return u'%{}%'.format(text)
+
+class LogIndex(object):
+    """ Indexes logs line by line so searches return matching lines without
+    reading the logs back.  Uses SQLite FTS5 when available, otherwise falls
+    back to scanning an ordinary table. """
+
+    def __init__(self, site_url):
+        self.path = os.path.join(get_site_cache_dir(site_url), 'log_index.db')
+        self.db = sqlite3.connect(self.path)
+        self.fts = has_fts5()
+        self._create_schema()
+
+    def _create_schema(self):
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        # Versions 1 and -1 are the FTS5 and plain layouts of the same schema
+        expected = SCHEMA_VERSION if self.fts else -SCHEMA_VERSION
+        if version == expected:
+            return
+        with self.db:
+            self.db.execute('DROP TABLE IF EXISTS lines')
+            self.db.execute('DROP TABLE IF EXISTS logs')
+            if self.fts:
+                self.db.execute('CREATE VIRTUAL TABLE lines USING fts5(text, build_id UNINDEXED, flow UNINDEXED, line_number UNINDEXED)')
+            else:
+                self.db.execute('CREATE TABLE lines (text TEXT, build_id INTEGER, flow TEXT, line_number INTEGER)')
+            self.db.execute('CREATE TABLE logs (build_id INTEGER, flow TEXT, PRIMARY KEY (build_id, flow))')
+            self.db.execute('PRAGMA user_version = {}'.format(expected))
+
+    def close(self):
+        self.db.close()
+
+    def indexed_builds(self):
+        """ returns the set of build ids with indexed logs """
+        return set(row[0] for row in self.db.execute('SELECT DISTINCT build_id FROM logs'))
+
+    def add(self, build_id, logs):
+        """ indexes a build's logs, a list of (flow name, log) pairs where the
+        build log itself has a flow name of '' """
+        build_id = int(build_id)
+        with self.db:
+            # build_id isn't indexed in FTS5 so only pay for the scan when
+            # the build really is being indexed again
+            if self.db.execute('SELECT 1 FROM logs WHERE build_id = ?', [build_id]).fetchone():
+                self.db.execute('DELETE FROM lines WHERE build_id = ?', [build_id])
+                self.db.execute('DELETE FROM logs WHERE build_id = ?', [build_id])
+            for flow, log in logs:
+                self.db.executemany(
+                    'INSERT INTO lines (text, build_id, flow, line_number) VALUES (?, ?, ?, ?)',
+                    (
+                        (line, build_id, flow, number)
+                        for number, line in enumerate((log or u'').splitlines(), 1)
+                        if line.strip()
+                    ),
+                )
+                self.db.execute('INSERT INTO logs VALUES (?, ?)', [build_id, flow])
+
+    def search(self, text, build_ids=None):
+        """ yields (build_id, flow, line_number, line) for each line containing
+        text, ignoring case, newest build first.  build_ids limits the search
+        to a set of builds. """
+        query = fts_query(text) if self.fts else None
+        if query:
+            rows = self.db.execute(
+                'SELECT build_id, flow, line_number, text FROM lines WHERE lines MATCH ? ORDER BY build_id DESC, flow, line_number',
+                [u'text: ' + query],
+            )
+        else:
+            rows = self.db.execute(
+                "SELECT build_id, flow, line_number, text FROM lines WHERE text LIKE ? ESCAPE '\\' ORDER BY build_id DESC, flow, line_number",
+                [like_pattern(text)],
+            )
+        # The index matches words, so check for the exact text as well
+        text = text.lower()
+        for build_id, flow, line_number, line in rows:
+            if build_ids is not None and build_id not in build_ids:
+                continue
+            if text in line.lower():
+                yield build_id, flow, line_number, line
+
+    def prune(self, keep_build_ids):
+        """ drops the lines of every build not in keep_build_ids, e.g. builds
+        whose logs the LogCache has evicted, so the index stays within the
+        log cache's size limit.  Returns the number of builds dropped. """
+        dropped = self.indexed_builds() - set(int(build_id) for build_id in keep_build_ids)
+        if not dropped:
+            return 0
+        with self.db:
+            # One scan of the unindexed FTS5 build_id column for all builds
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS dropped (build_id INTEGER PRIMARY KEY)')
+            self.db.execute('DELETE FROM dropped')
+            self.db.executemany('INSERT INTO dropped VALUES (?)', [(build_id,) for build_id in dropped])
+            self.db.execute('DELETE FROM lines WHERE build_id IN (SELECT build_id FROM dropped)')
+            self.db.execute('DELETE FROM logs WHERE build_id IN (SELECT build_id FROM dropped)')
+        return len(dropped)
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM lines')
+            self.db.execute('DELETE FROM logs')
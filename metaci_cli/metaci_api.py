@@ -1,34 +1,218 @@
 import click
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from requests.exceptions import ConnectionError
+from requests.exceptions import Timeout
 import coreapi
+from coreapi.utils import negotiate_decoder
 from cumulusci.core.exceptions import ServiceNotConfigured
+from metaci_cli.cache import ResolutionIndex
+from metaci_cli.cache import SchemaCache
+from metaci_cli.transport import get_session
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Decoded schema documents by site url, so long running processes like the
+# agent or batch mode only decode the schema once per TTL
+_documents = {}
+
+# Resolution indexes by site url, so concurrent commands in one process share
+# an index and its lock rather than overwriting each other's entries
+_indexes = {}
+
+def get_pool():
+    """ returns the process wide thread pool used for concurrent API calls.
+    METACI_MAX_CONCURRENCY bounds how many requests are in flight at once """
+    global _pool
+    # Commands run in parallel by metaci batch can get here at once
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(int(os.environ.get('METACI_MAX_CONCURRENCY', 8)))
+    return _pool
 
 class ApiClient(object):
     def __init__(self, config):
         headers = {}
         try:
-            self.service = config.keychain.get_service('metaci')            
+            self.service = config.keychain.get_service('metaci')
         except ServiceNotConfigured:
             raise click.ClickException('You must have a MetaCI site configured.  Use metaci site connect to configure an existing site or metaci site create to deploy a new Heroku app running MetaCI.')
-           
+
         auth = coreapi.auth.TokenAuthentication(self.service.token, scheme='Token')
-        self.client = coreapi.Client(auth=auth)
+        self.session = get_session(self.service.url)
+        transport = coreapi.transports.HTTPTransport(auth=auth, session=self.session)
+        self.client = coreapi.Client(transports=[transport])
+        self.schema_cache = SchemaCache(self.service.url)
+        if self.service.url not in _indexes:
+            _indexes[self.service.url] = ResolutionIndex(self.service.url)
+        self.index = _indexes[self.service.url]
         self._load_document()
 
-    def _load_document(self):
-        try:
-            self.document = self.client.get(self.service.url + '/api/schema')
-        except ConnectionError as e:
-            self._handle_connection_error(e)
-    
+    def _load_document(self, refresh=False):
+        """ Loads the schema document from the local schema cache, revalidating
+        it against the site with If-None-Match once the cache TTL expires """
+        url = self.service.url
+        if not refresh and url in _documents:
+            document, loaded = _documents[url]
+            if time.time() - loaded < self.schema_cache.ttl:
+                self.document = document
+                self.document_from_cache = True
+                return
+
+        entry = None if refresh else self.schema_cache.get()
+        self.document_from_cache = bool(entry and self.schema_cache.is_fresh(entry))
+        if not self.document_from_cache:
+            try:
+                entry = self._fetch_schema(entry)
+            except ConnectionError as e:
+                self._handle_connection_error(e)
+            except Timeout as e:
+                self._handle_timeout(e)
+        self.document = self._decode_schema(entry)
+        _documents[url] = (self.document, entry['fetched'])
+
+    def _fetch_schema(self, entry):
+        url = self.service.url + '/api/schema'
+        media_types = self.client.decoders[0].get_media_types()
+        headers = {'Accept': ', '.join(media_types + ['*/*'])}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+
+        resp = self.session.get(url, headers=headers)
+        if resp.status_code == 304:
+            return self.schema_cache.touch(entry)
+        if resp.status_code != 200:
+            raise click.ClickException('Failed to load the MetaCI API schema from {}.  Response code [{}]'.format(url, resp.status_code))
+        return self.schema_cache.save(
+            resp.url,
+            resp.content.decode('utf-8'),
+            content_type=resp.headers.get('content-type'),
+            etag=resp.headers.get('etag'),
+        )
+
+    def _decode_schema(self, entry):
+        codec = negotiate_decoder(self.client.decoders, entry['content_type'])
+        return codec.load(entry['content'].encode('utf-8'), base_url=entry['url'])
+
     def __call__(self, *args, **kwargs):
-        """ A shortcut to allow api_client('action') instead of api_client.client.action(self.document, 'action') """
+        """ A shortcut to allow api_client('action') instead of api_client.client.action(self.document, 'action')
+
+        Pass omit=['field', ...] to ask the server to leave large fields like
+        a build's log out of the response """
+        omit = kwargs.pop('omit', None)
+        if omit:
+            kwargs = self._omit_params(args, kwargs, omit)
         try:
-            resp = self.client.action(self.document, args, **kwargs)
+            try:
+                resp = self.client.action(self.document, args, **kwargs)
+            except coreapi.exceptions.LinkLookupError:
+                # The cached schema may predate a server upgrade, so refresh
+                # it and retry once before giving up on the action
+                if not self.document_from_cache:
+                    raise
+                self._load_document(refresh=True)
+                resp = self.client.action(self.document, args, **kwargs)
         except ConnectionError as e:
-            self.handle_connection_error(e)
+            self._handle_connection_error(e)
+        except Timeout as e:
+            self._handle_timeout(e)
+        if omit:
+            self._omit_fields(resp, omit)
         return resp
 
+    def has_param(self, keys, name):
+        """ returns whether the schema declares the parameter name for the
+        action at keys, e.g. (['builds', 'list'], 'omit') """
+        link = self.document
+        try:
+            for key in keys:
+                link = link[key]
+        except (KeyError, TypeError):
+            return False
+        return name in [field.name for field in getattr(link, 'fields', [])]
+
+    def _omit_params(self, keys, kwargs, omit):
+        # Older schemas don't declare the omit field and coreapi would reject
+        # it, so it is only sent when declared.  Otherwise the fields are
+        # still dropped from the response by _omit_fields.
+        if not self.has_param(keys, 'omit'):
+            return kwargs
+        kwargs = dict(kwargs)
+        params = dict(kwargs.get('params') or {})
+        params['omit'] = ','.join(omit)
+        kwargs['params'] = params
+        return kwargs
+
+    def _omit_fields(self, resp, omit):
+        """ drops omitted fields the server sent anyway so output is the same
+        whether or not the server supports omit """
+        records = resp.get('results', [resp]) if isinstance(resp, dict) else resp
+        for record in records:
+            for field in omit:
+                record.pop(field, None)
+
+    def submit(self, *args, **kwargs):
+        """ Starts api_client(*args, **kwargs) in the background and returns a
+        pending result to pass to gather() """
+        return self.spawn(self, *args, **kwargs)
+
+    def spawn(self, func, *args, **kwargs):
+        """ Starts func(*args, **kwargs) in the background, for lookups like
+        lookup_repo() that wrap one or more API calls """
+        return get_pool().apply_async(func, args, kwargs)
+
+    def gather(self, *pending):
+        """ Waits for pending results from submit() or spawn() and returns their
+        values in order, re-raising the first exception encountered """
+        return [result.get() for result in pending]
+
+    def iter_pages(self, *args, **kwargs):
+        """ Yields each page of a paginated list action.  The next page is only
+        requested once the previous page has been consumed """
+        omit = kwargs.get('omit')
+        page = self(*args, **kwargs)
+        while True:
+            yield page
+            next_url = page.get('next') if isinstance(page, dict) else None
+            if not next_url:
+                break
+            try:
+                page = self.client.get(next_url)
+                if omit:
+                    self._omit_fields(page, omit)
+            except ConnectionError as e:
+                self._handle_connection_error(e)
+            except Timeout as e:
+                self._handle_timeout(e)
+
+    def iter_result_pages(self, *args, **kwargs):
+        """ Yields the list of results on each page of a list action.  Pass
+        limit=N to stop after N results without fetching further pages """
+        limit = kwargs.pop('limit', None)
+        if limit is not None and limit <= 0:
+            return
+        count = 0
+        for page in self.iter_pages(*args, **kwargs):
+            results = page['results'] if isinstance(page, dict) else page
+            if limit is not None:
+                results = results[:limit - count]
+            yield results
+            count += len(results)
+            if limit is not None and count >= limit:
+                return
+
+    def iter_results(self, *args, **kwargs):
+        """ Yields individual results across all pages of a list action.  Pass
+        limit=N to stop after N results without fetching further pages """
+        for results in self.iter_result_pages(*args, **kwargs):
+            for result in results:
+                yield result
+
     def _handle_connection_error(self, e):
         raise click.ClickException('Could not connect to MetaCI site.  Try metaci site browser to open the site in a browser')
 
+    def _handle_timeout(self, e):
+        raise click.ClickException('Timed out waiting for a response from the MetaCI site.  Set METACI_READ_TIMEOUT to allow slower responses')
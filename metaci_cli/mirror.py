@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""A local SQLite mirror of the records on a MetaCI site"""
+
+import coreapi
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from metaci_cli.cache import ACTIVE_STATUSES
+from metaci_cli.cache import TERMINAL_STATUSES
+from metaci_cli.cache import get_site_cache_dir
+
+SCHEMA_VERSION = 1
+
+# Indexed columns for each mirrored resource as (column, record field).
+# Columns ending in _id hold the id of a related record, which the API
+# returns either as an id or as a nested object.  Every table also stores
+# the full record as JSON in its data column.
+TABLES = OrderedDict([
+    ('repos', [('owner', 'owner'), ('name', 'name')]),
+    ('plans', [('name', 'name')]),
+    ('orgs', [('repo_id', 'repo'), ('name', 'name')]),
+    ('branches', [('repo_id', 'repo'), ('name', 'name')]),
+    ('builds', [('repo_id', 'repo'), ('plan_id', 'plan'), ('branch_id', 'branch'), ('status', 'status'), ('commit_sha', 'commit')]),
+    ('build_flows', [('build_id', 'build'), ('flow', 'flow'), ('status', 'status')]),
+])
+
+INDEXES = [
+    ('repos', ['owner', 'name']),
+    ('orgs', ['repo_id', 'name']),
+    ('branches', ['repo_id', 'name']),
+    ('builds', ['repo_id', 'id']),
+    ('builds', ['plan_id', 'id']),
+    ('builds', ['branch_id', 'id']),
+    ('builds', ['status', 'id']),
+    ('build_flows', ['build_id']),
+]
+
+# Small tables that are listed in full on every sync so edits and deletes
+# are picked up.  Everything else is synced incrementally by id.
+REFERENCE_TABLES = ['repos', 'plans', 'orgs']
+
+def ref_id(value):
+    if isinstance(value, dict):
+        return value.get('id')
+    return value
+
+class Mirror(object):
+    """ Mirrors repos, plans, orgs, branches, builds and build flows from a
+    site into SQLite so list commands can answer locally with --local.
+
+    sync() only fetches what changed since the last sync: new branches and
+    builds are paged newest first until reaching the id cursor saved by the
+    previous sync, builds the mirror last saw queued or running are re-read,
+    and the flows of builds that finished since are paged in one pass.  Logs are never
+    mirrored, see LogCache for those. """
+
+    def __init__(self, site_url):
+        self.path = os.path.join(get_site_cache_dir(site_url), 'mirror.db')
+        self.db = sqlite3.connect(self.path)
+        self._create_schema()
+
+    def _create_schema(self):
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        with self.db:
+            # The mirror can always be rebuilt so older schemas are dropped
+            for table in list(TABLES) + ['cursors', 'flow_syncs']:
+                self.db.execute('DROP TABLE IF EXISTS {}'.format(table))
+            for table, columns in TABLES.items():
+                self.db.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY, {}, data TEXT NOT NULL)'.format(
+                    table,
+                    ', '.join(column for column, field in columns),
+                ))
+            for table, columns in INDEXES:
+                self.db.execute('CREATE INDEX {0}_{1} ON {0} ({2})'.format(
+                    table,
+                    '_'.join(columns),
+                    ', '.join(columns),
+                ))
+            self.db.execute('CREATE TABLE cursors (resource TEXT PRIMARY KEY, last_id INTEGER, synced REAL)')
+            self.db.execute('CREATE TABLE flow_syncs (build_id INTEGER PRIMARY KEY)')
+            self.db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+    def close(self):
+        self.db.close()
+
+    # Queries
+
+    def _where(self, filters):
+        clauses = []
+        args = []
+        for column, value in sorted((filters or {}).items()):
+            if isinstance(value, (list, tuple)):
+                clauses.append('{} IN ({})'.format(column, ', '.join('?' * len(value))))
+                args.extend(value)
+            else:
+                clauses.append('{} = ?'.format(column))
+                args.append(value)
+        if not clauses:
+            return '', args
+        return ' WHERE ' + ' AND '.join(clauses), args
+
+    def query(self, table, filters=None, limit=None):
+        """ yields records from table matching filters, a dict of column to
+        value or list of values, newest first """
+        where, args = self._where(filters)
+        sql = 'SELECT data FROM {}{} ORDER BY id DESC'.format(table, where)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        for row in self.db.execute(sql, args):
+            yield json.loads(row[0])
+
+    def count(self, table, filters=None):
+        where, args = self._where(filters)
+        return self.db.execute('SELECT COUNT(*) FROM {}{}'.format(table, where), args).fetchone()[0]
+
+    def get(self, table, record_id):
+        """ returns the record with record_id or None, also for ids that
+        aren't numbers """
+        try:
+            record_id = int(record_id)
+        except (TypeError, ValueError):
+            return None
+        for record in self.query(table, {'id': record_id}):
+            return record
+
+    def get_repo(self, owner, name):
+        for record in self.query('repos', {'owner': owner, 'name': name}):
+            return record
+
+    def last_synced(self):
+        """ returns the time of the last completed sync or None """
+        row = self.db.execute("SELECT synced FROM cursors WHERE resource = 'builds'").fetchone()
+        return row[0] if row else None
+
+    # Sync
+
+    def _upsert(self, table, records):
+        columns = TABLES[table]
+        rows = []
+        for record in records:
+            row = [record['id']]
+            for column, field in columns:
+                value = record.get(field)
+                row.append(ref_id(value) if column.endswith('_id') else value)
+            row.append(json.dumps(record))
+            rows.append(row)
+        self.db.executemany('INSERT OR REPLACE INTO {} VALUES ({})'.format(
+            table,
+            ', '.join('?' * (len(columns) + 2)),
+        ), rows)
+
+    def _get_cursor(self, table):
+        row = self.db.execute('SELECT last_id FROM cursors WHERE resource = ?', [table]).fetchone()
+        return row[0] if row else 0
+
+    def _set_cursor(self, table, last_id):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)', [table, last_id, time.time()])
+
+    def sync(self, api_client, full=False):
+        """ brings the mirror up to date and returns the number of records
+        fetched for each table.  full=True ignores the saved cursors. """
+        stats = OrderedDict()
+        for table in REFERENCE_TABLES:
+            stats[table] = self._sync_all(api_client, table)
+        stats['branches'] = self._sync_new(api_client, 'branches', full)[0]
+        stats['builds'], seen = self._sync_new(api_client, 'builds', full, omit=['log'])
+        stats['builds'] += self._sync_open_builds(api_client, seen)
+        stats['build_flows'] = self._sync_flows(api_client)
+        # Stamps the builds cursor with the time the whole sync finished
+        self._set_cursor('builds', self._get_cursor('builds'))
+        return stats
+
+    def _sync_all(self, api_client, table):
+        records = list(api_client.iter_results(table, 'list'))
+        ids = set(record['id'] for record in records)
+        deleted = [row for row in self.db.execute('SELECT id FROM {}'.format(table)) if row[0] not in ids]
+        with self.db:
+            self._upsert(table, records)
+            self.db.executemany('DELETE FROM {} WHERE id = ?'.format(table), deleted)
+        return len(records)
+
+    def _sync_new(self, api_client, table, full, omit=None):
+        """ pages through table newest first until reaching records older than
+        the last sync.  Returns the number of records fetched and their ids """
+        last_id = 0 if full else self._get_cursor(table)
+        max_id = last_id
+        seen = set()
+        # Servers without ordering support ignore it.  The page order is
+        # checked below before relying on it to stop early.
+        pages = api_client.iter_pages(table, 'list', params={'ordering': '-id'}, validate=False, omit=omit)
+        for page in pages:
+            records = page['results']
+            with self.db:
+                self._upsert(table, records)
+            ids = [record['id'] for record in records]
+            seen.update(ids)
+            if not ids:
+                break
+            max_id = max(max_id, max(ids))
+            if ids == sorted(ids, reverse=True) and ids[-1] <= last_id:
+                break
+        # Only saved once the whole delta is in so an interrupted sync
+        # picks up where the previous complete sync left off
+        self._set_cursor(table, max_id)
+        return len(seen), seen
+
+    def _sync_open_builds(self, api_client, seen):
+        """ re-reads builds last seen queued or running that weren't already
+        refreshed by this sync """
+        open_ids = [
+            row[0] for row in self.db.execute(
+                'SELECT id FROM builds WHERE status IN ({})'.format(', '.join('?' * len(ACTIVE_STATUSES))),
+                ACTIVE_STATUSES,
+            ) if row[0] not in seen
+        ]
+        pending = [api_client.spawn(read_build, api_client, build_id) for build_id in open_ids]
+        builds = api_client.gather(*pending)
+        with self.db:
+            self._upsert('builds', [build for build in builds if build])
+            deleted = [build_id for build_id, build in zip(open_ids, builds) if build is None]
+            self.db.executemany('DELETE FROM builds WHERE id = ?', [[build_id] for build_id in deleted])
+        return len(open_ids)
+
+    def _sync_flows(self, api_client):
+        """ fetches the flows of finished builds whose flows haven't been
+        fetched yet, paging the flows newest first in a single pass """
+        build_ids = set(row[0] for row in self.db.execute(
+            'SELECT id FROM builds WHERE status IN ({}) AND id NOT IN (SELECT build_id FROM flow_syncs)'.format(
+                ', '.join('?' * len(TERMINAL_STATUSES)),
+            ),
+            TERMINAL_STATUSES,
+        ))
+        if not build_ids:
+            return 0
+        first_id = min(build_ids)
+        params = {'ordering': '-id'}
+        if api_client.has_param(['build_flows', 'list'], 'build__gte'):
+            params['build__gte'] = first_id
+        count = 0
+        pages = api_client.iter_pages('build_flows', 'list', params=params, validate=False, omit=['log'])
+        for page in pages:
+            records = page['results']
+            flows = [flow for flow in records if ref_id(flow.get('build')) in build_ids]
+            with self.db:
+                self._upsert('build_flows', flows)
+            count += len(flows)
+            if not records:
+                break
+            # Flows are created as builds run, so once an ordered page only
+            # holds flows of older builds the rest of the table is older too
+            ids = [flow['id'] for flow in records]
+            if ids == sorted(ids, reverse=True) and max(ref_id(flow.get('build')) for flow in records) < first_id:
+                break
+        with self.db:
+            self.db.executemany('INSERT INTO flow_syncs VALUES (?)', [[build_id] for build_id in build_ids])
+        return count
+
+def read_build(api_client, build_id):
+    """ returns a build without its log, or None if it no longer exists """
+    try:
+        return api_client('builds', 'read', params={'id': build_id}, omit=['log'])
+    except coreapi.exceptions.ErrorMessage:
+        return None
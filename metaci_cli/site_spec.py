@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""Declarative site specs for metaci apply and the diff against a site"""
+
+from collections import OrderedDict
+
+KINDS = ['repo', 'org', 'service', 'plan', 'plan_repo']
+
+# Kinds are created stage by stage since each depends on the ids of the
+# previous ones.  Kinds within a stage are created concurrently.
+STAGES = [
+    ['repo'],
+    ['org', 'service'],
+    ['plan'],
+    ['plan_repo'],
+]
+
+TRIGGER_TYPES = ['commit', 'tag', 'manual']
+
+# Services only this CLI uses, which must never be copied to a site
+CLI_ONLY_SERVICES = ['metaci']
+
+class SpecError(Exception):
+    pass
+
+def load_spec(path):
+    """ reads a site spec from a YAML file and returns it normalized """
+    import yaml
+    with open(path, 'r') as f:
+        try:
+            data = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise SpecError('{} is not valid YAML: {}'.format(path, e))
+    return normalize_spec(data or {})
+
+def _as_list(data, section):
+    items = data.get(section) or []
+    if not isinstance(items, list):
+        raise SpecError('{} must be a list'.format(section))
+    return items
+
+def _default_repo(repos, what):
+    if len(repos) != 1:
+        raise SpecError('{} must specify a repo in the format OwnerName/RepoName'.format(what))
+    return list(repos)[0]
+
+def _repo_key(value, what):
+    parts = (value or '').split('/')
+    if len(parts) != 2 or not all(parts):
+        raise SpecError('{} repo must be in the format OwnerName/RepoName, not {}'.format(what, value))
+    return value
+
+def normalize_spec(data):
+    """ validates a spec and fills in defaults, returning an OrderedDict of
+    kind to an OrderedDict of key to item.  Repos and orgs may be given as
+    strings, services as names.  Orgs and plans default to the spec's repo
+    when it declares exactly one. """
+    if not isinstance(data, dict):
+        raise SpecError('The spec must be a mapping with repos, orgs, services and plans sections')
+    unknown = set(data) - set(['repos', 'orgs', 'services', 'plans'])
+    if unknown:
+        raise SpecError('Unknown sections in spec: {}'.format(', '.join(sorted(unknown))))
+
+    spec = OrderedDict((kind, OrderedDict()) for kind in KINDS)
+
+    for item in _as_list(data, 'repos'):
+        if not isinstance(item, dict):
+            item = {'repo': item}
+        if 'repo' in item:
+            owner, name = _repo_key(item['repo'], 'repos').split('/')
+        else:
+            owner, name = item.get('owner'), item.get('name')
+            if not owner or not name:
+                raise SpecError('repos need an owner and name or a repo in the format OwnerName/RepoName')
+        spec['repo']['{}/{}'.format(owner, name)] = OrderedDict([
+            ('owner', owner),
+            ('name', name),
+            ('url', item.get('url') or 'https://github.com/{}/{}'.format(owner, name)),
+            ('public', bool(item.get('public', False))),
+        ])
+
+    for item in _as_list(data, 'services'):
+        if not isinstance(item, dict):
+            item = {'name': item}
+        if not item.get('name'):
+            raise SpecError('services need a name')
+        if item['name'] in CLI_ONLY_SERVICES:
+            raise SpecError('The service {} is only used by this CLI and can not be applied to a site'.format(item['name']))
+        spec['service'][item['name']] = OrderedDict([
+            ('name', item['name']),
+        ])
+
+    for item in _as_list(data, 'orgs'):
+        if not isinstance(item, dict):
+            item = {'name': item}
+        if not item.get('name'):
+            raise SpecError('orgs need a name')
+        what = 'org {}'.format(item['name'])
+        repo = _repo_key(item['repo'], what) if item.get('repo') else _default_repo(spec['repo'], what)
+        spec['org'][(repo, item['name'])] = OrderedDict([
+            ('repo', repo),
+            ('name', item['name']),
+            # The org in the local cci keychain to copy, if named differently
+            ('org', item.get('org') or item['name']),
+        ])
+
+    for item in _as_list(data, 'plans'):
+        if not isinstance(item, dict) or not item.get('name'):
+            raise SpecError('plans need a name')
+        what = 'plan {}'.format(item['name'])
+        for field in ('org', 'flows'):
+            if not item.get(field):
+                raise SpecError('{} needs {}'.format(what, field))
+        trigger_type = item.get('type', 'manual')
+        if trigger_type not in TRIGGER_TYPES:
+            raise SpecError('{} has an invalid type {}.  Valid choices are: {}'.format(what, trigger_type, ', '.join(TRIGGER_TYPES)))
+        if trigger_type != 'manual' and not item.get('regex'):
+            raise SpecError('{} needs a regex for {} triggers'.format(what, trigger_type))
+        flows = item['flows']
+        if isinstance(flows, list):
+            flows = ','.join(flows)
+        repos = item.get('repos') or item.get('repo')
+        if not repos:
+            repos = [_default_repo(spec['repo'], what)]
+        elif not isinstance(repos, list):
+            repos = [repos]
+        spec['plan'][item['name']] = OrderedDict([
+            ('name', item['name']),
+            ('description', item.get('description') or ''),
+            ('org', item['org']),
+            ('flows', flows),
+            ('type', trigger_type),
+            ('regex', item.get('regex') if trigger_type != 'manual' else None),
+            ('context', item.get('context')),
+            ('active', bool(item.get('active', True))),
+            ('public', bool(item.get('public', False))),
+        ])
+        for repo in repos:
+            repo = _repo_key(repo, what)
+            spec['plan_repo'][(item['name'], repo)] = OrderedDict([
+                ('plan', item['name']),
+                ('repo', repo),
+            ])
+
+    return spec
+
+def index_state(state):
+    """ keys the records listed from a site the same way as a spec.  state
+    maps repos, orgs, services, plans and plan_repos to lists of records. """
+    repos = OrderedDict()
+    repos_by_id = {}
+    for repo in state.get('repos', []):
+        key = '{}/{}'.format(repo['owner'], repo['name'])
+        repos[key] = repo
+        repos_by_id[repo['id']] = key
+
+    orgs = OrderedDict()
+    for org in state.get('orgs', []):
+        repo = org.get('repo') or {}
+        key = repos_by_id.get(repo.get('id')) or '{}/{}'.format(repo.get('owner'), repo.get('name'))
+        orgs[(key, org['name'])] = org
+
+    services = OrderedDict((service['name'], service) for service in state.get('services', []))
+
+    # Plan names aren't unique on the server, so the oldest plan wins
+    plans = OrderedDict()
+    for plan in sorted(state.get('plans', []), key=lambda plan: plan['id']):
+        plans.setdefault(plan['name'], plan)
+    plans_by_id = dict((plan['id'], name) for name, plan in plans.items())
+
+    plan_repos = OrderedDict()
+    for plan_repo in state.get('plan_repos', []):
+        plan = plans_by_id.get(plan_repo['plan']['id'])
+        repo = repos_by_id.get(plan_repo['repo']['id'])
+        if plan and repo:
+            plan_repos[(plan, repo)] = plan_repo
+
+    return {
+        'repo': repos,
+        'org': orgs,
+        'service': services,
+        'plan': plans,
+        'plan_repo': plan_repos,
+    }
+
+def diff_spec(spec, state):
+    """ returns a list of changes, one per item in the spec, in dependency
+    order.  Each change is a dict with the kind, key and item from the spec,
+    an action of create or exists, and the existing record if any. """
+    existing = index_state(state)
+
+    # Plans can only use orgs and repos that exist or will be created
+    for (repo, name), org in spec['org'].items():
+        if repo not in spec['repo'] and repo not in existing['repo']:
+            raise SpecError('org {} uses repo {} which is neither in the spec nor on the site'.format(name, repo))
+    org_names = set(name for repo, name in spec['org']) | set(name for repo, name in existing['org'])
+    for name, plan in spec['plan'].items():
+        if plan['org'] not in org_names:
+            raise SpecError('plan {} uses org {} which is neither in the spec nor on the site'.format(name, plan['org']))
+    for (plan, repo) in spec['plan_repo']:
+        if repo not in spec['repo'] and repo not in existing['repo']:
+            raise SpecError('plan {} uses repo {} which is neither in the spec nor on the site'.format(plan, repo))
+
+    changes = []
+    for stage in STAGES:
+        for kind in stage:
+            for key, item in spec[kind].items():
+                record = existing[kind].get(key)
+                changes.append({
+                    'kind': kind,
+                    'key': key,
+                    'item': item,
+                    'action': 'exists' if record else 'create',
+                    'record': record,
+                })
+    return changes
+
+def change_name(change):
+    """ returns a readable name for a change's key """
+    key = change['key']
+    if change['kind'] == 'org':
+        return u'{1} ({0})'.format(*key)
+    if change['kind'] == 'plan_repo':
+        return u'{} -> {}'.format(*key)
+    return key
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""Pooled HTTP sessions with timeouts and retries for MetaCI and Heroku API calls"""
+
+import os
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+# Only reads are retried.  Creating builds, orgs, etc twice is worse than failing.
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+_sessions = {}
+
+
+class JitteredRetry(Retry):
+    """ Exponential backoff with full jitter so many metaci processes retrying
+    against a struggling site don't all retry in lockstep.  A Retry-After
+    header on 429/503 responses still takes precedence over the backoff. """
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, backoff)
+
+
+class TimeoutSession(requests.Session):
+    """ A requests.Session that applies a default (connect, read) timeout to
+    every request that doesn't specify its own """
+
+    def __init__(self, timeout=None):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutSession, self).send(request, **kwargs)
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def get_retry(max_retries=None, backoff_factor=None):
+    if max_retries is None:
+        max_retries = int(_env_float('METACI_MAX_RETRIES', 3))
+    if backoff_factor is None:
+        backoff_factor = _env_float('METACI_RETRY_BACKOFF', 0.5)
+    kwargs = {
+        'total': max_retries,
+        'connect': max_retries,
+        'read': max_retries,
+        'status': max_retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': RETRY_STATUSES,
+        'respect_retry_after_header': True,
+        'raise_on_status': False,
+    }
+    # urllib3 1.26 renamed method_whitelist to allowed_methods
+    if 'allowed_methods' in Retry.DEFAULT.__dict__:
+        kwargs['allowed_methods'] = RETRY_METHODS
+    else:
+        kwargs['method_whitelist'] = RETRY_METHODS
+    return JitteredRetry(**kwargs)
+
+
+def build_session(connect_timeout=None, read_timeout=None, max_retries=None,
+                  backoff_factor=None, pool_maxsize=None):
+    """ Returns a new keep-alive session configured from the arguments or the
+    METACI_CONNECT_TIMEOUT, METACI_READ_TIMEOUT, METACI_MAX_RETRIES and
+    METACI_RETRY_BACKOFF environment variables """
+    if connect_timeout is None:
+        connect_timeout = _env_float('METACI_CONNECT_TIMEOUT', 5)
+    if read_timeout is None:
+        read_timeout = _env_float('METACI_READ_TIMEOUT', 60)
+    if pool_maxsize is None:
+        pool_maxsize = 10
+
+    session = TimeoutSession(timeout=(connect_timeout, read_timeout))
+    adapter = HTTPAdapter(
+        max_retries=get_retry(max_retries, backoff_factor),
+        pool_connections=pool_maxsize,
+        pool_maxsize=pool_maxsize,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(key):
+    """ Returns the process wide session for key (usually a site url) so every
+    ApiClient talking to the same site shares one connection pool """
+    if key not in _sessions:
+        _sessions[key] = build_session()
+    return _sessions[key]
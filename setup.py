@@ -26,6 +26,7 @@ requirements = [
     'coreapi-cli==1.0.6',
     'cumulusci>=2.2.1',
     'heroku3==3.4.0',
+    'PyYAML',
 ]
 
 setup_requirements = [
@@ -48,7 +49,8 @@ setup(
     package_dir={'metaci_cli': 'metaci_cli'},
     entry_points={
         'console_scripts': [
-            'metaci=metaci_cli.cli:main'
+            'metaci=metaci_cli.cli:main',
+            'metaci-client=metaci_cli.agent:client_main',
         ]
     },
     include_package_data=True,
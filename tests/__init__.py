@@ -1,3 +1,30 @@
 # -*- coding: utf-8 -*-
 
 """Unit test package for metaci_cli."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from metaci_cli import cache
+
+
+class CacheDirTestCase(unittest.TestCase):
+    """ points cache.get_cache_dir at a temporary directory for each test """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.get_cache_dir = cache.get_cache_dir
+        cache.get_cache_dir = self.fake_cache_dir
+
+    def tearDown(self):
+        cache.get_cache_dir = self.get_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def fake_cache_dir(self, *parts):
+        # Stands in for the CumulusCI config dir so cumulusci isn't needed
+        path = os.path.join(self.cache_dir, *parts)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.autoscale`."""
+
+import unittest
+
+from metaci_cli.autoscale import ScalingPolicy
+from metaci_cli.autoscale import read_trace
+from metaci_cli.autoscale import simulate
+from metaci_cli.autoscale import trace_sample
+
+
+class TestScalingPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = ScalingPolicy(
+            min_workers=1,
+            max_workers=5,
+            scale_up_step=2,
+            cooldown=60,
+            scale_down_delay=300,
+        )
+
+    def test_demand(self):
+        self.assertEqual(self.policy.demand(0, 0), 1)
+        self.assertEqual(self.policy.demand(2, 1), 3)
+        self.assertEqual(self.policy.demand(20, 4), 5)
+        self.assertEqual(ScalingPolicy(builds_per_worker=2).demand(3, 0), 2)
+
+    def test_scale_up_in_steps_after_cooldown(self):
+        self.assertEqual(self.policy.decide(1, 10, 0, 0), 3)
+        self.assertEqual(self.policy.decide(3, 10, 0, 30), 3)
+        self.assertEqual(self.policy.decide(3, 10, 0, 60), 5)
+
+    def test_scale_down_after_delay(self):
+        self.assertEqual(self.policy.decide(4, 0, 1, 0), 4)
+        self.assertEqual(self.policy.decide(4, 0, 1, 200), 4)
+        # Demand coming back resets the delay
+        self.assertEqual(self.policy.decide(4, 3, 1, 250), 4)
+        self.assertEqual(self.policy.decide(4, 0, 1, 300), 4)
+        self.assertEqual(self.policy.decide(4, 0, 1, 600), 1)
+
+    def test_no_scale_down_while_builds_are_queued(self):
+        self.assertEqual(self.policy.decide(5, 1, 1, 0), 5)
+        self.assertEqual(self.policy.decide(5, 1, 1, 600), 5)
+        self.assertEqual(self.policy.decide(5, 0, 2, 660), 2)
+
+    def test_invalid_bounds(self):
+        self.assertRaises(ValueError, ScalingPolicy, min_workers=3, max_workers=2)
+
+    def test_simulate_trace(self):
+        lines = [trace_sample(t, queued, 0) for t, queued in [(60, 0), (0, 4), (120, 0)]]
+        samples = read_trace(['# recorded trace\n'] + lines)
+        self.assertEqual(samples[0], (0, 4, 0))
+        rows = simulate(ScalingPolicy(max_workers=4, cooldown=0, scale_down_delay=60), samples)
+        self.assertEqual([row['workers'] for row in rows], [2, 2, 0])
+        self.assertEqual(rows[0]['queued_seconds'], 120)
+        self.assertEqual(sum(row['worker_seconds'] for row in rows), 240)
+        self.assertRaises(ValueError, read_trace, ['{"time": 1}'])
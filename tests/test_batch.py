@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.cli.commands.batch`."""
+
+import unittest
+
+from metaci_cli.cli.commands.batch import parse_line
+from metaci_cli.cli.commands.batch import read_commands
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_parse_line(self):
+        self.assertIsNone(parse_line('   \n'))
+        self.assertIsNone(parse_line('# build info 1'))
+        self.assertEqual(parse_line('build info 123 --log'), ['build', 'info', '123', '--log'])
+        self.assertEqual(parse_line('metaci org add "dev org"'), ['org', 'add', 'dev org'])
+        self.assertEqual(parse_line('{"args": ["build", "info", 123]}'), ['build', 'info', '123'])
+
+    def test_read_commands_reports_bad_lines(self):
+        commands = read_commands([
+            'build list\n',
+            '\n',
+            '{"args": "build list"}\n',
+            'batch other.txt\n',
+        ])
+        self.assertEqual(commands[0], (1, ['build', 'list'], None))
+        self.assertEqual([number for number, args, error in commands], [1, 3, 4])
+        self.assertTrue(all(error for number, args, error in commands[1:]))
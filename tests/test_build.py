@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.cli.commands.build`."""
+
+import unittest
+from click.testing import CliRunner
+
+build = None
+
+
+def setUpModule():
+    # Imported here so a missing cumulusci fails these tests rather than
+    # the collection of the whole suite
+    global build
+    from metaci_cli.cli.commands import build
+
+
+class FakeTailApi(object):
+    """ Serves a build whose deploy flow log grows over three polls """
+
+    def __init__(self):
+        self.polls = 0
+        self.flow_reads = []
+
+    def __call__(self, resource, action, params=None, omit=None):
+        if resource == 'builds':
+            if omit:
+                self.polls += 1
+            return {'id': 1, 'status': 'success' if self.polls >= 3 else 'in_progress', 'log': u'' if omit else u'done\n'}
+        self.flow_reads.append(params['id'])
+        if params['id'] == 10:
+            return {'log': u'setup\n'}
+        return {'log': [u'a\n', u'a\n', u'a\nb\n'][self.polls - 1]}
+
+    def iter_results(self, resource, action, params=None, omit=None):
+        return iter([
+            {'id': 10, 'flow': 'setup', 'status': 'success'},
+            {'id': 11, 'flow': 'deploy', 'status': 'success' if self.polls >= 3 else 'in_progress'},
+        ])
+
+
+class FakeWaitApi(object):
+    """ Serves builds whose statuses advance one step per poll """
+
+    def __init__(self, statuses, id_filter=False):
+        self.statuses = statuses
+        self.id_filter = id_filter
+        self.polls = 0
+        self.calls = []
+
+    def status(self, build_id):
+        history = self.statuses[build_id]
+        return history[min(self.polls, len(history) - 1)]
+
+    def has_param(self, keys, name):
+        return self.id_filter
+
+    def __call__(self, resource, action, params=None, omit=None):
+        self.calls.append((resource, action, params))
+        if params['id'] not in self.statuses:
+            raise build.coreapi.exceptions.ErrorMessage('Not found')
+        return {'id': int(params['id']), 'status': self.status(params['id'])}
+
+    def iter_results(self, resource, action, params=None, omit=None):
+        self.calls.append((resource, action, params))
+        ids = params['id__in'].split(',')
+        return iter([{'id': int(build_id), 'status': self.status(build_id)} for build_id in ids])
+
+    def spawn(self, func, *args):
+        result = func(*args)
+        return type('Pending', (), {'get': lambda pending: result})()
+
+    def gather(self, *pending):
+        self.polls += 1
+        return [result.get() for result in pending]
+
+
+class PatchedCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.api_client = build.ApiClient
+        self.sleep = build.time.sleep
+        build.ApiClient = lambda config: self.api
+        build.time.sleep = self.sleeps.append
+
+    def tearDown(self):
+        build.ApiClient = self.api_client
+        build.time.sleep = self.sleep
+
+
+class TestBuildWait(PatchedCommandTest):
+
+    def test_waits_for_every_build(self):
+        self.api = FakeWaitApi({
+            '1': ['queued', 'in_progress', 'success'],
+            '2': ['in_progress', 'fail'],
+        })
+        result = CliRunner().invoke(build.build_wait, ['1', '2', '--interval', '1'])
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn('Build 2: fail', result.output)
+        self.assertIn('Build 1: success', result.output)
+        # Only the waited builds are read, and finished ones stop being read
+        self.assertEqual([params['id'] for resource, action, params in self.api.calls], ['1', '2', '1', '2', '1'])
+
+    def test_filters_one_list_call_by_id(self):
+        self.api = FakeWaitApi({'1': ['success'], '2': ['error']}, id_filter=True)
+        result = CliRunner().invoke(build.build_wait, ['2', '1'])
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertEqual(self.api.calls, [('builds', 'list', {'id__in': '1,2'})])
+
+    def test_timeout(self):
+        self.api = FakeWaitApi({'1': ['in_progress']})
+        # Each reading of the clock is three seconds after the last
+        clock = iter(range(0, 1000, 3))
+        time = build.time.time
+        build.time.time = lambda: next(clock)
+        try:
+            result = CliRunner().invoke(build.build_wait, ['1', '--timeout', '10', '--interval', '1'])
+        finally:
+            build.time.time = time
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Timed out waiting for builds: 1', result.output)
+        self.assertEqual(self.sleeps, [1])
+
+    def test_unknown_build(self):
+        self.api = FakeWaitApi({'1': ['success']})
+        result = CliRunner().invoke(build.build_wait, ['1', '3'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Build(s) with id 3 not found', result.output)
+
+
+class TestBuildTail(PatchedCommandTest):
+
+    def setUp(self):
+        super(TestBuildTail, self).setUp()
+        self.api = FakeTailApi()
+
+    def test_prints_only_new_output(self):
+        result = CliRunner().invoke(build.build_tail, ['1', '--interval', '1', '--max-interval', '8'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output.count(u'a\n'), 1)
+        self.assertIn(u'deploy:\na\nb\n', result.output)
+        self.assertIn(u'done\n', result.output)
+        # The finished setup flow is only read once
+        self.assertEqual(self.api.flow_reads, [10, 11, 11, 11])
+        # New output resets the backoff, a quiet poll doubles it
+        self.assertEqual(self.sleeps, [1, 2])
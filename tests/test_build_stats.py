@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.build_stats`."""
+
+import random
+import unittest
+
+from metaci_cli import build_stats
+from metaci_cli.build_stats import BuildColumns
+from metaci_cli.build_stats import group_key
+from metaci_cli.build_stats import parse_time
+from metaci_cli.build_stats import percentile
+
+
+class TestBuildStats(unittest.TestCase):
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time('1970-01-02T00:00:01Z'), 86401)
+        self.assertEqual(parse_time('1970-01-02T00:00:01.5Z'), 86401.5)
+        self.assertEqual(parse_time('1970-01-02T02:00:01+02:00'), 86401)
+        self.assertNotEqual(parse_time(None), parse_time(None))
+
+    def test_percentile(self):
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(percentile([1, 2, 3, 4], 99), 3.97)
+        self.assertIsNone(percentile([], 50))
+
+    def test_aggregate(self):
+        columns = BuildColumns(group_key(['plan']))
+        for status, duration in [('success', 60), ('fail', 120), ('success', 180), ('in_progress', 0)]:
+            columns.add({
+                'status': status,
+                'plan': {'name': 'feature'},
+                'time_queue': '2017-10-12T10:00:00Z',
+                'time_start': '2017-10-12T10:00:30Z',
+                'time_end': '2017-10-12T10:{:02}:30Z'.format(duration // 60),
+            })
+        columns.add({'status': 'error', 'plan': {'name': 'beta'}})
+
+        beta, feature = columns.aggregate()
+        self.assertEqual(beta['builds'], 1)
+        self.assertIsNone(beta['duration_p50'])
+        self.assertEqual(feature['builds'], 3)
+        self.assertEqual(feature['success_rate'], 66.7)
+        self.assertEqual(feature['duration_p50'], 120)
+        self.assertEqual(feature['queue_wait_p90'], 30)
+
+    @unittest.skipIf(build_stats.numpy is None, 'numpy is not installed')
+    def test_numpy_matches_python(self):
+        columns = BuildColumns(lambda build: build['plan'])
+        rand = random.Random(1)
+        for i in range(1000):
+            start = rand.randint(0, 59)
+            columns.add({
+                'status': rand.choice(['success', 'fail', 'error']),
+                'plan': rand.choice(['feature', 'beta', 'release', 'nightly']),
+                'time_queue': '2017-10-12T10:00:00Z',
+                'time_start': '2017-10-12T10:{:02}:00Z'.format(start) if i % 7 else None,
+                'time_end': '2017-10-12T11:{:02}:{:02}Z'.format(rand.randint(0, 59), rand.randint(0, 59)),
+            })
+        columns.add({'status': 'error', 'plan': 'empty'})
+        self.assertEqual(columns._aggregate_numpy(), columns._aggregate_python())
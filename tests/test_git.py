@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.git`."""
+
+import shutil
+import tempfile
+
+from metaci_cli import git
+
+from . import CacheDirTestCase
+
+
+class TestGit(CacheDirTestCase):
+
+    def setUp(self):
+        super(TestGit, self).setUp()
+        self.run_git = git.run_git
+        self.output = ''
+        git.run_git = lambda repo_root, *args: self.output
+        git.get_cache_dir = self.fake_cache_dir
+
+    def tearDown(self):
+        git.run_git = self.run_git
+        git.get_cache_dir = self.get_cache_dir
+        super(TestGit, self).tearDown()
+
+    def test_ls_remote_heads(self):
+        self.output = 'abc\trefs/heads/master\ndef\trefs/heads/feature/one\n'
+        self.assertEqual(git.ls_remote_heads(self.cache_dir, 'origin'), {
+            'master': 'abc',
+            'feature/one': 'def',
+        })
+
+    def test_ls_remote_heads_malformed_output(self):
+        self.output = 'warning: redirecting to https://github.com/SFDO/Cumulus.git/\nabc\trefs/heads/master\n'
+        with self.assertRaises(git.GitError):
+            git.ls_remote_heads(self.cache_dir, 'origin')
+        # Nothing is cached so the next call asks the remote again
+        self.output = 'abc\trefs/heads/master\n'
+        self.assertEqual(git.ls_remote_heads(self.cache_dir, 'origin'), {'master': 'abc'})
+
+    def test_run_git_reports_stderr(self):
+        repo_root = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(git.GitError) as context:
+                self.run_git(repo_root, 'rev-parse', '--git-dir')
+        finally:
+            shutil.rmtree(repo_root)
+        self.assertIn('not a git repository', str(context.exception))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.cli.heroku` and the site app shapes using it."""
+
+import unittest
+
+from click.testing import CliRunner
+
+heroku = None
+site = None
+
+def setUpModule():
+    # Imported here so a missing cumulusci fails these tests rather than
+    # the collection of the whole suite
+    global heroku, site
+    from metaci_cli.cli import heroku
+    from metaci_cli.cli.commands import site
+
+
+class Attributes(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeApp(object):
+    """ a heroku3 app with a formation of process type to (quantity, size)
+    recording the batch updates it gets """
+
+    def __init__(self, formation):
+        self.formation = formation
+        self.updates = []
+
+    def process_formation(self):
+        return [
+            Attributes(type=process, quantity=quantity, size=size)
+            for process, (quantity, size) in sorted(self.formation.items())
+        ]
+
+    def batch_resize_formation_processes(self, updates):
+        self.updates.append(('resize', updates))
+        for process, size in updates.items():
+            self.formation[process] = (self.formation[process][0], size)
+
+    def batch_scale_formation_processes(self, updates):
+        self.updates.append(('scale', updates))
+        for process, quantity in updates.items():
+            self.formation[process] = (quantity, self.formation[process][1])
+
+
+class TestFormation(unittest.TestCase):
+
+    def test_diff_formation(self):
+        current = {
+            'web': (1, 'Free'),
+            'worker': (2, 'standard-1x'),
+            'worker_short': (0, None),
+        }
+        target = {
+            'web': (1, 'free'),
+            'worker': (0, 'standard-1x'),
+            'worker_short': (1, 'standard-1x'),
+            'dev_worker': (1, 'free'),
+        }
+        self.assertEqual(heroku.diff_formation(current, target), [
+            {'type': 'worker', 'quantity': 0},
+            {'type': 'worker_short', 'quantity': 1, 'size': 'standard-1x'},
+        ])
+        self.assertEqual(heroku.diff_formation(target, target), [])
+
+    def test_update_formation(self):
+        app = FakeApp({'web': (1, 'free'), 'worker': (0, 'free')})
+        heroku.update_formation(app, [
+            {'type': 'web', 'size': 'standard-1x'},
+            {'type': 'worker', 'quantity': 2, 'size': 'standard-1x'},
+        ])
+        self.assertEqual(app.updates, [
+            ('resize', {'web': 'standard-1x', 'worker': 'standard-1x'}),
+            ('scale', {'worker': 2}),
+        ])
+
+    def test_set_app_shape(self):
+        app = FakeApp({
+            'web': (1, 'free'),
+            'dev_worker': (1, 'free'),
+            'worker': (0, 'free'),
+        })
+        counts = site.set_app_shape(app, 'staging', num_workers=2)
+        self.assertEqual(counts, {'web': 1, 'dev_worker': 0, 'worker': 2})
+        self.assertEqual(app.formation, {
+            'web': (1, 'standard-1x'),
+            'dev_worker': (0, 'standard-1x'),
+            'worker': (2, 'standard-1x'),
+        })
+
+        # Already in shape, so nothing more is sent
+        app.updates = []
+        site.set_app_shape(app, 'staging', num_workers=2)
+        self.assertEqual(app.updates, [])
+
+    def test_set_app_shape_dry_run(self):
+        app = FakeApp({'web': (1, 'free'), 'worker': (0, 'free')})
+        counts = site.set_app_shape(app, 'prod', dry_run=True)
+        self.assertEqual(counts, {'web': 1, 'worker': 0})
+        self.assertEqual(app.updates, [])
+
+
+class TestAutoscaleOptions(unittest.TestCase):
+
+    def test_interval_must_be_positive(self):
+        # A zero interval would poll and retry errors without pausing
+        result = CliRunner().invoke(site.site_autoscale, ['--interval', '0'])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('--interval', result.output)
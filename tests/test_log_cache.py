@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.log_cache`."""
+
+import os
+import time
+
+from metaci_cli.log_cache import LogCache
+
+from . import CacheDirTestCase
+
+
+class TestLogCache(CacheDirTestCase):
+
+    def setUp(self):
+        super(TestLogCache, self).setUp()
+        self.log_cache = LogCache('https://metaci.herokuapp.com', max_size=1024 * 1024)
+
+    def test_log_round_trip(self):
+        log = u'Running flow ci_feature ✓\n' * 10000
+        self.assertFalse(self.log_cache.has_log(1))
+        self.log_cache.put_log(1, log)
+        self.assertTrue(self.log_cache.has_log(1))
+        self.assertEqual(self.log_cache.read_log(1), log)
+        self.assertLess(self.log_cache.size(), len(log))
+
+    def test_flows_round_trip(self):
+        self.log_cache.put_flows(1, [('dev_org', u'one'), ('ci/beta', u'two')])
+        self.assertTrue(self.log_cache.has_flows(1))
+        self.assertEqual(self.log_cache.get_flows(1), ['dev_org', 'ci/beta'])
+        self.assertEqual(self.log_cache.read_log(1, 'ci/beta'), u'two')
+
+    def test_flow_names_do_not_collide(self):
+        self.log_cache.put_flows(1, [('ci/beta', u'one'), ('ci_beta', u'two')])
+        self.assertEqual(self.log_cache.read_log(1, 'ci/beta'), u'one')
+        self.assertEqual(self.log_cache.read_log(1, 'ci_beta'), u'two')
+
+    def test_prune_evicts_least_recently_used(self):
+        self.log_cache.put_log(1, u'a' * 100)
+        self.log_cache.put_flows(2, [('dev_org', u'b' * 100)])
+        self.log_cache.put_log(3, u'c' * 100)
+        past = time.time() - 60
+        for path, size, mtime in self.log_cache.entries():
+            os.utime(path, (past, past))
+        # Reading build 1 makes build 2's flows the least recently used
+        self.log_cache.read_log(1)
+        self.log_cache.read_log(3)
+
+        self.log_cache.prune(self.log_cache.size() - 1)
+        self.assertTrue(self.log_cache.has_log(1))
+        self.assertFalse(self.log_cache.has_flows(2))
+        self.assertEqual(len(self.log_cache.entries()), 2)
+
+    def test_clear(self):
+        self.log_cache.put_log(1, u'a')
+        self.log_cache.put_flows(1, [('dev_org', u'b')])
+        self.assertEqual(self.log_cache.clear(), 3)
+        self.assertEqual(self.log_cache.entries(), [])
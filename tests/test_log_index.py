@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.log_index`."""
+
+from metaci_cli.log_index import LogIndex
+
+from . import CacheDirTestCase
+
+
+class TestLogIndex(CacheDirTestCase):
+
+    def setUp(self):
+        super(TestLogIndex, self).setUp()
+        self.log_index = LogIndex('https://metaci.herokuapp.com')
+
+    def tearDown(self):
+        self.log_index.close()
+        super(TestLogIndex, self).tearDown()
+
+    def search(self, text):
+        return [(build_id, line) for build_id, flow, line_number, line in self.log_index.search(text)]
+
+    def test_like_wildcards_are_literal(self):
+        self.log_index.fts = False
+        self.log_index.add(1, [('', u'coverage 100%\nran test_one\nran testXone')])
+        self.assertEqual(self.search(u'100%'), [(1, u'coverage 100%')])
+        self.assertEqual(self.search(u'test_one'), [(1, u'ran test_one')])
+        self.assertEqual(self.search(u'%'), [(1, u'coverage 100%')])
+
+    def test_prune_drops_builds_not_kept(self):
+        self.log_index.add(1, [('', u'deploy failed')])
+        self.log_index.add(2, [('', u'deploy failed')])
+        self.assertEqual(self.log_index.prune([2]), 1)
+        self.assertEqual(self.log_index.indexed_builds(), set([2]))
+        self.assertEqual(self.search(u'deploy'), [(2, u'deploy failed')])
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.metaci_api`."""
+
+import unittest
+
+import coreapi
+
+ApiClient = None
+
+
+def setUpModule():
+    # Imported here so a missing cumulusci fails these tests rather than
+    # the collection of the whole suite
+    global ApiClient
+    from metaci_cli.metaci_api import ApiClient
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def action(self, document, keys, **kwargs):
+        self.calls.append((keys, kwargs))
+        return {'results': [{'id': 1, 'log': u'long log'}]}
+
+
+def make_api_client(fields):
+    """ returns an ApiClient for a schema with a builds list action taking
+    fields, without loading a site """
+    api_client = ApiClient.__new__(ApiClient)
+    api_client.document = coreapi.Document(content={
+        'builds': {
+            'list': coreapi.Link(url='/api/builds/', action='get', fields=[
+                coreapi.Field(name) for name in fields
+            ]),
+        },
+    })
+    api_client.document_from_cache = False
+    api_client.client = FakeClient()
+    return api_client
+
+
+class TestOmit(unittest.TestCase):
+
+    def test_omit_sent_when_schema_declares_it(self):
+        api_client = make_api_client(['status', 'omit'])
+        resp = api_client('builds', 'list', params={'status': 'success'}, omit=['log'])
+        keys, kwargs = api_client.client.calls[0]
+        self.assertEqual(kwargs, {'params': {'status': 'success', 'omit': 'log'}})
+        self.assertEqual(resp['results'], [{'id': 1}])
+
+    def test_omit_dropped_on_client_when_schema_lacks_it(self):
+        api_client = make_api_client(['status'])
+        resp = api_client('builds', 'list', params={'status': 'success'}, omit=['log'])
+        keys, kwargs = api_client.client.calls[0]
+        # Validation of the other params stays on
+        self.assertEqual(kwargs, {'params': {'status': 'success'}})
+        self.assertEqual(resp['results'], [{'id': 1}])
+        self.assertFalse(api_client.has_param(['builds', 'read'], 'omit'))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.mirror`."""
+
+import coreapi
+
+from metaci_cli.mirror import Mirror
+
+from . import CacheDirTestCase
+
+
+class FakeApi(object):
+    """ serves the records in tables newest first, page_size at a time, and
+    records each page and read requested """
+
+    page_size = 2
+
+    def __init__(self, tables, params=None):
+        self.tables = tables
+        self.params = params or {}
+        self.requests = []
+
+    def has_param(self, keys, name):
+        return name in self.params.get(keys[0], [])
+
+    def iter_results(self, table, action, **kwargs):
+        return iter(self.tables.get(table, []))
+
+    def iter_pages(self, table, action, params=None, **kwargs):
+        records = sorted(self.tables.get(table, []), key=lambda record: record['id'], reverse=True)
+        build_gte = (params or {}).get('build__gte')
+        if build_gte is not None:
+            records = [record for record in records if record['build'] >= build_gte]
+        for start in range(0, len(records) + 1, self.page_size):
+            self.requests.append((table, start))
+            yield {'results': records[start:start + self.page_size]}
+
+    def __call__(self, table, action, params=None, **kwargs):
+        self.requests.append((table, params['id']))
+        for record in self.tables.get(table, []):
+            if record['id'] == params['id']:
+                return record
+        raise coreapi.exceptions.ErrorMessage('Not found')
+
+    def spawn(self, func, *args):
+        return func(*args)
+
+    def gather(self, *results):
+        return list(results)
+
+
+def build(build_id, status='success', repo=1):
+    return {'id': build_id, 'repo': {'id': repo}, 'plan': 1, 'branch': 1, 'status': status, 'commit': 'abc'}
+
+def flow(flow_id, build_id):
+    return {'id': flow_id, 'build': build_id, 'flow': 'ci_feature', 'status': 'success'}
+
+
+class TestMirror(CacheDirTestCase):
+
+    def setUp(self):
+        super(TestMirror, self).setUp()
+        self.mirror = Mirror('https://metaci.herokuapp.com')
+        self.api = FakeApi({
+            'repos': [{'id': 1, 'owner': 'SFDO', 'name': 'Cumulus'}],
+            'builds': [build(1), build(2), build(3, 'running')],
+            'build_flows': [flow(1, 1), flow(2, 2)],
+        })
+
+    def tearDown(self):
+        self.mirror.close()
+        super(TestMirror, self).tearDown()
+
+    def build_ids(self, filters=None):
+        return [record['id'] for record in self.mirror.query('builds', filters)]
+
+    def test_sync_resumes_from_cursor(self):
+        self.mirror.sync(self.api)
+        self.api.tables['builds'] += [build(4), build(5)]
+        self.api.requests = []
+
+        stats = self.mirror.sync(self.api)
+        # The second page reaches build 3, the newest build already synced
+        self.assertEqual([request for request in self.api.requests if request[0] == 'builds'], [
+            ('builds', 0),
+            ('builds', 2),
+        ])
+        self.assertEqual(self.build_ids(), [5, 4, 3, 2, 1])
+        self.assertEqual(stats['builds'], 4)
+
+    def test_sync_updates_existing_rows(self):
+        self.mirror.sync(self.api)
+        self.api.tables['builds'][2] = build(3, 'fail')
+        self.api.tables['build_flows'].append(flow(3, 3))
+        self.api.tables['repos'] = [{'id': 1, 'owner': 'SFDO', 'name': 'NPSP'}]
+
+        self.mirror.sync(self.api)
+        self.assertEqual(self.mirror.get('builds', 3)['status'], 'fail')
+        self.assertEqual(self.build_ids({'status': 'running'}), [])
+        self.assertEqual(self.mirror.count('build_flows', {'build_id': 3}), 1)
+        self.assertEqual(self.mirror.get_repo('SFDO', 'NPSP')['id'], 1)
+        self.assertIsNone(self.mirror.get_repo('SFDO', 'Cumulus'))
+
+    def test_flows_paged_once(self):
+        self.api.tables['build_flows'] += [flow(3, 3)]
+        self.api.params = {'build_flows': ['build__gte']}
+        self.mirror.sync(self.api)
+        self.assertEqual([request for request in self.api.requests if request[0] == 'build_flows'], [
+            ('build_flows', 0),
+            ('build_flows', 2),
+        ])
+        # Build 3 is still running so its flows wait for a later sync
+        self.assertEqual(self.mirror.count('build_flows'), 2)
+
+    def test_local_queries(self):
+        self.mirror.sync(self.api)
+        self.assertEqual(self.build_ids({'repo_id': 1, 'status': ['success', 'running']}), [3, 2, 1])
+        self.assertEqual(self.build_ids({'status': 'success'}), [2, 1])
+        self.assertEqual([record['id'] for record in self.mirror.query('builds', limit=1)], [3])
+        self.assertEqual(self.mirror.count('builds', {'repo_id': 2}), 0)
+        self.assertEqual(self.mirror.get('builds', '2')['id'], 2)
+        self.assertIsNone(self.mirror.get('builds', 'abc'))
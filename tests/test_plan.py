@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.cli.commands.plan`."""
+
+import unittest
+from collections import OrderedDict
+
+from . import CacheDirTestCase
+
+plan = None
+
+def setUpModule():
+    # Imported here so a missing cumulusci fails these tests rather than
+    # the collection of the whole suite
+    global plan
+    from metaci_cli.cli.commands import plan
+
+
+class Attributes(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeGithub(object):
+    """ a Github API with a single repository holding heads, a dict of branch
+    name to sha """
+
+    def __init__(self, heads):
+        self.heads = heads
+
+    def repository(self, owner, name):
+        return self
+
+    def branch(self, name):
+        return Attributes(name=name, commit=Attributes(sha=self.heads[name]))
+
+    def branches(self):
+        return [self.branch(name) for name in sorted(self.heads)]
+
+
+class TestBranchCommits(CacheDirTestCase):
+
+    def setUp(self):
+        super(TestBranchCommits, self).setUp()
+        self.git_calls = []
+        self.git_output = {
+            'remote': 'origin\tgit@github.com:SFDO/Cumulus.git (fetch)\n',
+            'ls-remote': 'abc\trefs/heads/feature/one\n',
+        }
+        self.run_git = plan.git.run_git
+        self.get_cache_dir = plan.git.get_cache_dir
+        plan.git.run_git = self.fake_run_git
+        plan.git.get_cache_dir = self.fake_cache_dir
+        self.config = Attributes(project_config=Attributes(
+            repo_root=self.cache_dir,
+            repo_owner='SFDO',
+            repo_name='Cumulus',
+            get_github_api=lambda: FakeGithub({'feature/one': 'github', 'feature/two': 'github'}),
+        ))
+
+    def tearDown(self):
+        plan.git.run_git = self.run_git
+        plan.git.get_cache_dir = self.get_cache_dir
+        super(TestBranchCommits, self).tearDown()
+
+    def fake_run_git(self, repo_root, *args):
+        self.git_calls.append(args[0])
+        output = self.git_output[args[0]]
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+    def test_local_git_first(self):
+        commits = plan.get_branch_commits(self.config, ['feature/*'])
+        self.assertEqual(commits, OrderedDict([('feature/one', 'abc')]))
+        self.assertEqual(self.git_calls, ['remote', 'ls-remote'])
+
+    def test_github_when_git_fails(self):
+        self.git_output['ls-remote'] = plan.git.GitError('git ls-remote failed')
+        commits = plan.get_branch_commits(self.config, ['feature/*'])
+        self.assertEqual(list(commits.items()), [('feature/one', 'github'), ('feature/two', 'github')])
+
+    def test_github_when_ls_remote_output_is_malformed(self):
+        self.git_output['ls-remote'] = 'warning: redirecting to https://github.com/SFDO/Cumulus.git/\nabc\trefs/heads/feature/one\n'
+        commits = plan.get_branch_commits(self.config, ['feature/*'])
+        self.assertEqual(list(commits.items()), [('feature/one', 'github'), ('feature/two', 'github')])
+
+    def test_github_when_branch_missing_locally(self):
+        commits = plan.get_branch_commits(self.config, ['feature/two'], ls_remote=True)
+        self.assertEqual(commits, OrderedDict([('feature/two', 'github')]))
+
+
+class FakeApi(object):
+
+    def spawn(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def gather(self, *results):
+        return list(results)
+
+
+class TestResolveRuns(unittest.TestCase):
+
+    def setUp(self):
+        self.lookups = []
+        self.patched = {}
+        self.patch('get_plan', lambda api_client, plan_id: self.lookup('plan', plan_id, {
+            'id': plan_id,
+            'org': {'1': 'feature', '2': 'beta'}.get(plan_id, 'feature'),
+        }))
+        self.patch('lookup_repo', lambda api_client, config, repo, required=None: self.lookup('repo', repo, {'id': 10}))
+        self.patch('lookup_org', lambda api_client, name, repo_id: self.lookup('org', name, {
+            'id': {'feature': 20, 'beta': 21}[name],
+        } if name != 'missing' else None))
+        self.patch('get_or_create_branch', lambda api_client, branch, repo_id: self.lookup('branch', branch, {
+            'id': {'master': 30, 'feature/one': 31}[branch],
+        }))
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(plan, name, value)
+
+    def patch(self, name, value):
+        self.patched[name] = getattr(plan, name)
+        setattr(plan, name, value)
+
+    def lookup(self, kind, key, result):
+        self.lookups.append((kind, key))
+        return result
+
+    def test_every_plan_on_every_branch(self):
+        commits = OrderedDict([('master', 'abc'), ('feature/one', 'def')])
+        plans, resolved, runs = plan.resolve_runs(FakeApi(), None, ['1', '2', '3'], commits)
+        self.assertEqual(resolved, commits)
+        self.assertEqual(list(runs), [
+            ('1', 'master'), ('1', 'feature/one'),
+            ('2', 'master'), ('2', 'feature/one'),
+            ('3', 'master'), ('3', 'feature/one'),
+        ])
+        self.assertEqual(runs[('2', 'feature/one')], {
+            'repo_id': 10,
+            'org_id': 21,
+            'plan_id': '2',
+            'branch_id': 31,
+            'commit': 'def',
+        })
+        self.assertEqual(runs[('3', 'master')]['org_id'], 20)
+        # Each plan, org and branch is looked up once however many runs use it
+        self.assertEqual(sorted(self.lookups), sorted([
+            ('plan', '1'), ('plan', '2'), ('plan', '3'),
+            ('repo', None),
+            ('org', 'beta'), ('org', 'feature'),
+            ('branch', 'master'), ('branch', 'feature/one'),
+        ]))
+
+    def test_pending_commits(self):
+        api_client = FakeApi()
+        pending = api_client.spawn(OrderedDict, [('master', 'abc')])
+        plans, commits, runs = plan.resolve_runs(api_client, None, ['1'], pending)
+        self.assertEqual(commits, OrderedDict([('master', 'abc')]))
+        self.assertEqual(runs[('1', 'master')]['commit'], 'abc')
+
+    def test_missing_org(self):
+        self.patch('get_plan', lambda api_client, plan_id: {'id': plan_id, 'org': 'missing'})
+        with self.assertRaises(plan.click.ClickException):
+            plan.resolve_runs(FakeApi(), None, ['1'], OrderedDict([('master', 'abc')]))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metaci_cli.site_spec`."""
+
+import unittest
+
+from metaci_cli.site_spec import SpecError
+from metaci_cli.site_spec import diff_spec
+from metaci_cli.site_spec import normalize_spec
+
+
+class TestSiteSpec(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = normalize_spec({
+            'repos': ['Org/Repo', {'owner': 'Org', 'name': 'New', 'public': True}],
+            'services': ['github'],
+            'orgs': [{'name': 'feature', 'repo': 'Org/Repo'}],
+            'plans': [{
+                'name': 'Feature Test',
+                'org': 'feature',
+                'flows': ['dev_org', 'ci_feature'],
+                'type': 'commit',
+                'regex': 'feature/.*',
+                'repos': ['Org/Repo', 'Org/New'],
+            }],
+        })
+
+    def test_normalize_spec(self):
+        self.assertEqual(self.spec['repo']['Org/Repo']['url'], 'https://github.com/Org/Repo')
+        self.assertTrue(self.spec['repo']['Org/New']['public'])
+        self.assertEqual(self.spec['plan']['Feature Test']['flows'], 'dev_org,ci_feature')
+        self.assertEqual(list(self.spec['plan_repo']), [('Feature Test', 'Org/Repo'), ('Feature Test', 'Org/New')])
+        self.assertRaises(SpecError, normalize_spec, {'plans': [{'name': 'x', 'org': 'y', 'flows': 'z', 'type': 'tag'}]})
+        self.assertRaises(SpecError, normalize_spec, {'orgs': ['feature']})
+        self.assertRaises(SpecError, normalize_spec, {'services': ['metaci']})
+        self.assertRaises(SpecError, normalize_spec, {'services': [{'name': 'metaci'}]})
+
+    def test_diff_spec(self):
+        state = {
+            'repos': [{'id': 1, 'owner': 'Org', 'name': 'Repo'}],
+            'orgs': [{'id': 2, 'name': 'feature', 'repo': {'id': 1}}],
+            'services': [],
+            'plans': [{'id': 4, 'name': 'Feature Test'}, {'id': 3, 'name': 'Feature Test'}],
+            'plan_repos': [{'id': 5, 'plan': {'id': 3}, 'repo': {'id': 1}}],
+        }
+        changes = diff_spec(self.spec, state)
+        actions = [(change['kind'], change['action']) for change in changes]
+        self.assertEqual(actions, [
+            ('repo', 'exists'),
+            ('repo', 'create'),
+            ('org', 'exists'),
+            ('service', 'create'),
+            ('plan', 'exists'),
+            ('plan_repo', 'exists'),
+            ('plan_repo', 'create'),
+        ])
+        self.assertEqual(changes[4]['record']['id'], 3)
+
+    def test_diff_spec_unknown_org(self):
+        spec = normalize_spec({'repos': ['Org/Repo'], 'plans': [{'name': 'Beta', 'org': 'packaging', 'flows': 'ci_beta'}]})
+        self.assertRaises(SpecError, diff_spec, spec, {})
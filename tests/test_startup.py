@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Startup regression tests for the `metaci` command."""
+
+import os
+import subprocess
+import importlib
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only specific subcommands need.  metaci --help must not import them.
+HEAVY_MODULES = ['coreapi', 'cumulusci', 'heroku3', 'requests', 'webbrowser']
+
+HELP_SCRIPT = """
+import sys
+from metaci_cli.cli import main
+try:
+    main(['--help'])
+except SystemExit:
+    pass
+sys.stderr.write(' '.join(sorted(sys.modules)))
+"""
+
+
+class TestStartup(unittest.TestCase):
+
+    def run_help(self):
+        process = subprocess.Popen(
+            [sys.executable, '-c', HELP_SCRIPT],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        return stdout.decode('utf-8'), stderr.decode('utf-8').split()
+
+    def test_help_lists_commands_without_importing_them(self):
+        output, modules = self.run_help()
+        self.assertIn('build', output)
+        self.assertIn('site', output)
+        self.assertNotIn('metaci_cli.cli.commands.build', modules)
+        for heavy in HEAVY_MODULES:
+            imported = [name for name in modules if name.split('.')[0] == heavy]
+            self.assertEqual(imported, [], '{} was imported by metaci --help'.format(heavy))
+
+    def test_help_imports_no_command_modules(self):
+        output, modules = self.run_help()
+        imported = [
+            name for name in modules
+            if name.startswith('metaci_cli.cli.commands.') and name != 'metaci_cli.cli.commands.main'
+        ]
+        self.assertEqual(imported, [])
+
+    def test_lazy_help_matches_commands(self):
+        from metaci_cli.cli.commands.main import main
+        for name, (path, short_help) in main.lazy_commands.items():
+            module_name, attr = path.split(':')
+            command = getattr(importlib.import_module(module_name), attr)
+            self.assertEqual(command.name, name)
+            self.assertEqual(command.short_help, short_help, '{} help differs from lazy_commands'.format(name))